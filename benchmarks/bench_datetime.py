@@ -0,0 +1,114 @@
+# coding: UTF-8
+"""
+日時の解析（resolve_search_datetime など）のベンチマーク。
+
+SetDateTime から検索までの1ターンで行う日時の処理（スロットの解析、Yahoo!路線情報のGETパラメータ、
+キャッシュのキー、検索条件の確認メッセージ）について、以前の正規表現による文字列の変換と、
+JSTの datetime を1回だけ作る現在の処理の時間を比較する。
+
+ランダムな日時、期間での性質（以前の処理と一致するかなど）は tests/test_datetime.py で確認する。
+
+使い方:
+    $ python benchmarks/bench_datetime.py --iterations 100000
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import re
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+GV_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GV_ROOT_DIR)
+
+import yahoo_transit
+from yahoo_transit import GV_TZ_JST
+
+
+# --------------- 以前の処理 ----------------------
+
+def legacy_duration_to_datetime(duration, now):
+    delta_hours = re.sub(r'^P.*T(\d+)H.*', r'\1', duration)
+    delta_minutes = re.sub(r'^P.*[TH](\d+)M.*', r'\1', duration)
+    converted_datetime = now
+    if delta_hours[0] != 'P':
+        converted_datetime = converted_datetime + timedelta(hours=int(delta_hours))
+    if delta_minutes[0] != 'P':
+        converted_datetime = converted_datetime + timedelta(minutes=int(delta_minutes))
+    return converted_datetime.strftime('%Y-%m-%d %H:%M')
+
+
+def legacy_payload(search_date_time, search_type):
+    dt = re.split('[- :]', search_date_time)
+    return {
+        'from': '', 'to': '', 'y': dt[0], 'm': dt[1], 'd': dt[2], 'hh': dt[3], 'm2': dt[4][1], 'm1': dt[4][0],
+        'type': yahoo_transit.GV_SEARCH_TYPES.get(search_type, yahoo_transit.GV_TYPE_ARRIVE),
+        'expkind': 1, 'ws': yahoo_transit.GV_WALK_SPEED, 's': 0, 'lb': 1, 'kw': '',
+    }
+
+
+def legacy_cache_key(search_date_time, search_type):
+    search_date, _, search_time = search_date_time.partition(' ')
+    if search_type == '始発' or search_type == '終電':
+        search_time = ''
+    else:
+        hh, mm = search_time.split(':')
+        minutes = int(hh) * 60 + int(mm)
+        minutes -= minutes % max(yahoo_transit.GV_CACHE_BUCKET_MINUTES, 1)
+        search_time = '%02d:%02d' % divmod(minutes, 60)
+    return '|'.join(['', '', search_date, search_time, search_type, str(yahoo_transit.GV_WALK_SPEED)])
+
+
+def legacy_speech(search_date_time, search_type):
+    text = re.sub(r'(\d+)-(\d+)-(\d+) (\d+):(\d+)', r'\1年\2月\3日 \4時\5分', search_date_time) + '、に' + search_type
+    if search_type == '始発' or search_type == '終電':
+        text = re.sub('00時.*$', 'の、' + search_type, text)
+    return text
+
+
+def legacy_turn(slots, search_type, now):
+    if 'value' in slots['Date']:
+        search_time = slots['Time']['value'] if 'value' in slots['Time'] else '00:00'
+        search_date_time = slots['Date']['value'] + ' ' + search_time
+    else:
+        search_date_time = legacy_duration_to_datetime(slots['Duration']['value'], now)
+    return (legacy_payload(search_date_time, search_type), legacy_cache_key(search_date_time, search_type),
+            legacy_speech(search_date_time, search_type), search_date_time)
+
+
+def current_turn(slots, search_type, now):
+    search_date_time = yahoo_transit.format_search_datetime(yahoo_transit.resolve_search_datetime(slots, now))
+    return (yahoo_transit.make_search_payload('', '', search_date_time, search_type),
+            yahoo_transit.make_cache_key('', '', search_date_time, search_type),
+            yahoo_transit.speak_search_datetime(search_date_time, search_type),
+            search_date_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the date/time resolution.')
+    parser.add_argument('--iterations', type=int, default=100000)
+    args = parser.parse_args()
+
+    now = datetime(2018, 6, 1, 8, 0, tzinfo=GV_TZ_JST)
+    cases = {
+        'date': {'Date': {'value': '2018-06-01'}, 'Time': {'value': '08:45'}, 'Duration': {}},
+        'duration': {'Date': {}, 'Time': {}, 'Duration': {'value': 'PT1H30M'}},
+    }
+    result = {}
+    for name, slots in cases.items():
+        legacy_us = timeit.timeit(lambda: legacy_turn(slots, '到着', now), number=args.iterations)
+        current_us = timeit.timeit(lambda: current_turn(slots, '到着', now), number=args.iterations)
+        result[name] = {
+            'legacyUs': legacy_us / args.iterations * 1e6,
+            'currentUs': current_us / args.iterations * 1e6,
+        }
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+# coding: UTF-8
+"""
+Progressive Response のベンチマーク。
+
+Yahoo!路線情報の応答が遅い場合に、SetDateTime で最初に発話するまでの時間（TimeToFirstAudio）と
+応答までの時間（Total）を、Progressive Response を使う場合と使わない場合で比較する。
+Yahoo!路線情報とAlexaのDirective Service（/v1/directives）は、bench_request_path.py と同じ
+ローカルのスタブサーバーが応答する。計測値は metrics_middleware が出力するログから取り出す。
+
+使い方:
+    $ python benchmarks/bench_progressive.py --delay-ms 1500 --iterations 10
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_request_path import (GV_FIXTURE_DIR, GV_ROOT_DIR, StubHandler, load_events, start_stub_server,
+                                stub_environ, summarize)
+
+
+def run(module, event, iterations):
+    """SetDateTime を iterations 回処理し、TimeToFirstAudio と Total（ミリ秒）を返す。"""
+    first_audio, total = [], []
+    for _ in range(iterations):
+        module.GV_RESULT_CACHE.clear()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            module.lambda_handler(json.loads(json.dumps(event)), None)
+        for line in output.getvalue().splitlines():
+            if line.startswith('{') and '"TimeToFirstAudio"' in line:
+                record = json.loads(line)
+                first_audio.append(record['TimeToFirstAudio'])
+                total.append(record['Total'])
+    return {'timeToFirstAudioMs': summarize(first_audio), 'totalMs': summarize(total)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare time-to-first-audio with and without progressive responses.')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--delay-ms', type=float, default=1500.0, help='スタブサーバーの応答遅延（ミリ秒）')
+    parser.add_argument('--threshold-ms', type=int, default=800, help='progressive_threshold_ms')
+    args = parser.parse_args()
+
+    with open(os.path.join(GV_FIXTURE_DIR, 'search_result.html'), 'rb') as f:
+        server, base_url = start_stub_server(f.read(), args.delay_ms / 1000.0)
+    os.environ.update(stub_environ(base_url))
+    os.environ['progressive_threshold_ms'] = str(args.threshold_ms)
+    sys.path.insert(0, GV_ROOT_DIR)
+    import yahoo_transit
+
+    event = load_events(base_url)['SetDateTime']
+    event['context']['System'].update(apiEndpoint=base_url, apiAccessToken='benchmark')
+
+    result = {'delayMs': args.delay_ms, 'thresholdMs': args.threshold_ms}
+    yahoo_transit.GV_PROGRESSIVE = False
+    result['withoutProgressive'] = run(yahoo_transit, event, args.iterations)
+    yahoo_transit.GV_PROGRESSIVE = True
+    result['withProgressive'] = run(yahoo_transit, event, args.iterations)
+    result['directives'] = StubHandler.posts.count('/v1/directives')
+    result['stats'] = yahoo_transit.GV_PROGRESSIVE_STATS
+    server.shutdown()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+# coding: UTF-8
+"""
+yahoo_transit のリクエスト処理のベンチマーク。
+
+resources/AlexaIntent*.json のイベントを lambda_handler で処理し、
+Yahoo!路線情報、IFTTT の代わりにローカルのスタブサーバーから
+benchmarks/fixtures の検索結果ページを返す。
+IFTTTのWebhooksキーは、KMSを使わずに環境変数 ifttt_webhook_key_plaintext で渡す。
+
+計測項目:
+    - コールドスタート（モジュールのimport）時間
+    - インテント毎のレイテンシ（p50, p95, p99）
+    - そのうちのHTTP通信時間、検索結果ページの解析時間
+    - 1リクエストの処理中に追加で使用したメモリの最大値（tracemalloc のピーク）
+    - 1リクエストの処理後に残ったメモリブロック数（sys.getallocatedblocks の増分）
+
+結果はJSONで出力する。--baseline に以前の結果を指定すると、
+p95 が --threshold 以上悪化したインテントを報告し、終了コード 1 を返す。
+
+使い方:
+    $ python benchmarks/bench_request_path.py --iterations 200 --output bench.json
+    $ python benchmarks/bench_request_path.py --baseline bench.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import gc
+import glob
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+GV_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GV_FIXTURE_DIR = os.path.join(GV_ROOT_DIR, 'benchmarks', 'fixtures')
+GV_EVENT_PATTERN = os.path.join(GV_ROOT_DIR, 'resources', 'AlexaIntent*.json')
+GV_YAHOO_HOST = 'https://transit.yahoo.co.jp'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """検索結果ページ、IFTTTのWebhookの代わりに応答するハンドラ。"""
+
+    page = b''
+    # -- 応答までの遅延（秒）: ネットワークの往復時間の代わり
+    delay = 0.0
+    # -- 受け取ったPOSTリクエストのパス（IFTTTのWebhook、AlexaのDirective Service）
+    posts = []
+    # -- Directive Service（/v1/directives）の応答までの遅延（秒）
+    directive_delay = 0.05
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=UTF-8')
+        self.send_header('Content-Length', str(len(self.page)))
+        self.end_headers()
+        self.wfile.write(self.page)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.posts.append(self.path)
+        if self.path == '/v1/directives':
+            time.sleep(self.directive_delay)
+            self.send_response(204)
+        else:
+            time.sleep(self.delay)
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_stub_server(page, delay):
+    StubHandler.page = page
+    StubHandler.delay = delay
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+def stub_environ(base_url):
+    return {
+        'ifttt_webhook_key_plaintext': 'benchmark',
+        'yahoo_base_url': base_url,
+        'ifttt_base_url': base_url,
+    }
+
+
+def measure_cold_start(base_url, repeat):
+    """新しいPythonプロセスで yahoo_transit を import する時間（ミリ秒）を計測する。"""
+    code = '''
+import time
+start = time.perf_counter()
+import yahoo_transit
+print((time.perf_counter() - start) * 1000)
+'''
+    env = dict(os.environ)
+    env.update(stub_environ(base_url))
+    samples = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=GV_ROOT_DIR, env=env)
+        samples.append(float(output.decode('utf-8').strip().splitlines()[-1]))
+    return summarize(samples)
+
+
+def load_events(base_url):
+    """イベントのJSONファイルを読み込み、セッション内のYahoo!路線情報のURLをスタブサーバーに置き換える。"""
+    events = {}
+    for path in sorted(glob.glob(GV_EVENT_PATTERN)):
+        with open(path, encoding='utf-8') as f:
+            event = json.load(f)
+        attributes = event['session'].get('attributes') or {}
+        if 'url' in attributes:
+            attributes['url'] = attributes['url'].replace(GV_YAHOO_HOST, base_url)
+        events[os.path.basename(path)[len('AlexaIntent'):-len('.json')]] = event
+    return events
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples),
+        'p50': percentile(samples, 50),
+        'p95': percentile(samples, 95),
+        'p99': percentile(samples, 99),
+    }
+
+
+@contextlib.contextmanager
+def instrument(module, timings):
+    """metrics_middleware が計測したHTTP通信（本文の受信を含む）、検索結果ページの解析の時間を timings に加算する。
+    検索結果ページを受信しながら解析する場合、本文の受信と解析は http_request が返った後の read_transit_page で行うため、
+    関数を包むのではなく、リクエスト毎の計測値（finish_metrics の結果）を使う。
+    """
+    original = module.finish_metrics
+
+    def finish_metrics():
+        metrics = original()
+        for name in timings:
+            timings[name] += metrics.get(name, 0.0)
+        return metrics
+
+    module.finish_metrics = finish_metrics
+    try:
+        yield
+    finally:
+        module.finish_metrics = original
+
+
+def run_event(module, event, warm_cache):
+    if not warm_cache:
+        module.GV_RESULT_CACHE.clear()
+        module.GV_TIMETABLE_CACHE.clear()
+    with contextlib.redirect_stdout(io.StringIO()):
+        return module.lambda_handler(json.loads(json.dumps(event)), None)
+
+
+def bench_intent(module, event, iterations, warm_cache):
+    latencies, http_times, parse_times = [], [], []
+    for _ in range(iterations):
+        timings = {'http': 0.0, 'parse': 0.0}
+        with instrument(module, timings):
+            start = time.perf_counter()
+            run_event(module, event, warm_cache)
+            latencies.append((time.perf_counter() - start) * 1000)
+        http_times.append(timings['http'] * 1000)
+        parse_times.append(timings['parse'] * 1000)
+
+    # メモリは計測のオーバーヘッドが大きいため、レイテンシとは別に計測する
+    # 処理中に一時的に使用したメモリ: リクエスト毎にピークをリセットし、開始時からの増分の最大値を記録する
+    peak_bytes = []
+    tracemalloc.start()
+    try:
+        for _ in range(min(iterations, 20)):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            run_event(module, event, warm_cache)
+            peak_bytes.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+
+    # 処理後に残ったメモリブロック数（キャッシュなど）: tracemalloc 自体の割り当てを含めないよう、停止してから計測する
+    retained_blocks = []
+    for _ in range(min(iterations, 20)):
+        gc.collect()
+        before = sys.getallocatedblocks()
+        run_event(module, event, warm_cache)
+        gc.collect()
+        retained_blocks.append(sys.getallocatedblocks() - before)
+
+    return {
+        'latencyMs': summarize(latencies),
+        'httpMs': summarize(http_times),
+        'parseMs': summarize(parse_times),
+        'peakTracedBytesPerRequest': summarize(peak_bytes),
+        'retainedBlocksPerRequest': summarize(retained_blocks),
+    }
+
+
+def compare(result, baseline, threshold):
+    """baseline と比べて p95 が threshold（割合）以上悪化したインテントを返す。"""
+    regressions = []
+    for name, stats in result['intents'].items():
+        base = baseline.get('intents', {}).get(name)
+        if base is None:
+            continue
+        before, after = base['latencyMs']['p95'], stats['latencyMs']['p95']
+        if before > 0 and (after - before) / before > threshold:
+            regressions.append({'intent': name, 'p95Before': before, 'p95After': after})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the yahoo_transit request path offline.')
+    parser.add_argument('--iterations', type=int, default=100, help='intent毎の実行回数')
+    parser.add_argument('--cold-start-runs', type=int, default=5, help='コールドスタートの計測回数')
+    parser.add_argument('--fixture', default=os.path.join(GV_FIXTURE_DIR, 'search_result.html'),
+                        help='スタブサーバーが返す検索結果ページ')
+    parser.add_argument('--delay-ms', type=float, default=0.0, help='スタブサーバーの応答遅延（ミリ秒）')
+    parser.add_argument('--warm-cache', action='store_true', help='検索結果キャッシュを毎回クリアしない')
+    parser.add_argument('--intent', action='append', help='計測するインテント（ファイル名の AlexaIntent 以降）')
+    parser.add_argument('--output', help='結果を書き込むJSONファイル（省略時は標準出力）')
+    parser.add_argument('--baseline', help='比較対象の以前の結果（JSON）')
+    parser.add_argument('--threshold', type=float, default=0.2, help='p95 の悪化を回帰とみなす割合')
+    args = parser.parse_args()
+
+    with open(args.fixture, 'rb') as f:
+        server, base_url = start_stub_server(f.read(), args.delay_ms / 1000.0)
+    os.environ.update(stub_environ(base_url))
+    sys.path.insert(0, GV_ROOT_DIR)
+
+    result = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'fixture': os.path.basename(args.fixture),
+        'iterations': args.iterations,
+        'warmCache': args.warm_cache,
+        'coldStartMs': measure_cold_start(base_url, args.cold_start_runs),
+        'intents': {},
+    }
+
+    import yahoo_transit
+
+    for name, event in load_events(base_url).items():
+        if args.intent and name not in args.intent:
+            continue
+        run_event(yahoo_transit, event, args.warm_cache)
+        result['intents'][name] = bench_intent(yahoo_transit, event, args.iterations, args.warm_cache)
+    server.shutdown()
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            result['regressions'] = compare(result, json.load(f), args.threshold)
+        status = 1 if result['regressions'] else 0
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+# coding: UTF-8
+"""
+セッション情報の形式（encode_session_state）のベンチマーク。
+
+SetDateTime、次の電車、次の電車、と続けた各時点のセッション情報について、
+変更前の形式（GV_BASELINE_KEYS の6項目: URL、検索結果テキストなどをそのまま保存）と、
+実際に応答する形式（encode_session_state の結果）のJSONのサイズを比較する。
+あわせて、最後の時点のJSONへの変換（json.dumps）、JSONからの変換（json.loads）の時間を比較する。
+変更後の形式は、他のルート、前後の電車のリンク、履歴も保持する。
+検索結果ページは bench_request_path.py と同じローカルのスタブサーバーから返す。
+
+使い方:
+    $ python benchmarks/bench_session_state.py --iterations 10000
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_request_path import GV_FIXTURE_DIR, GV_ROOT_DIR, load_events, start_stub_server, stub_environ
+
+# -- 変更前（セッション情報をそのまま保存していた形式）の sessionAttributes の項目
+GV_BASELINE_KEYS = ['stationFrom', 'stationTo', 'url', 'searchDateTime', 'searchType', 'searchResult']
+
+
+def make_sessions(module, events):
+    """SetDateTime、次の電車、次の電車を処理した各時点の、応答の sessionAttributes を返す。"""
+    sessions = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = module.lambda_handler(events['SetDateTime'], None)
+        sessions.append(('SetDateTime', response['sessionAttributes']))
+        for i in range(2):
+            event = json.loads(json.dumps(events['Next']))
+            event['session']['attributes'] = response['sessionAttributes']
+            response = module.lambda_handler(event, None)
+            sessions.append(('Next%d' % (i + 1), response['sessionAttributes']))
+    return sessions
+
+
+def make_baseline(module, attributes):
+    """応答の sessionAttributes から、変更前の形式のセッション情報を作る。"""
+    decoded = module.decode_session_state(attributes)
+    return dict((key, decoded.get(key)) for key in GV_BASELINE_KEYS)
+
+
+def size(attributes):
+    return len(json.dumps(attributes, ensure_ascii=False).encode('utf-8'))
+
+
+def measure(attributes, iterations):
+    text = json.dumps(attributes, ensure_ascii=False)
+    return {
+        'bytes': len(text.encode('utf-8')),
+        'dumpsUs': timeit.timeit(lambda: json.dumps(attributes, ensure_ascii=False), number=iterations)
+        / iterations * 1e6,
+        'loadsUs': timeit.timeit(lambda: json.loads(text), number=iterations) / iterations * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the baseline and compact session attribute formats.')
+    parser.add_argument('--iterations', type=int, default=10000)
+    args = parser.parse_args()
+
+    with open(os.path.join(GV_FIXTURE_DIR, 'search_result.html'), 'rb') as f:
+        server, base_url = start_stub_server(f.read(), 0.0)
+    os.environ.update(stub_environ(base_url))
+    sys.path.insert(0, GV_ROOT_DIR)
+    import yahoo_transit
+
+    sessions = make_sessions(yahoo_transit, load_events(base_url))
+    server.shutdown()
+
+    result = {'bytes': {}}
+    for name, compact in sessions:
+        baseline_bytes, compact_bytes = size(make_baseline(yahoo_transit, compact)), size(compact)
+        result['bytes'][name] = {'baseline': baseline_bytes, 'compact': compact_bytes,
+                                 'delta': compact_bytes - baseline_bytes}
+
+    compact = sessions[-1][1]
+    baseline = make_baseline(yahoo_transit, compact)
+    decoded = yahoo_transit.decode_session_state(compact)
+    result.update({
+        'baseline': measure(baseline, args.iterations),
+        'compact': measure(compact, args.iterations),
+        'encodeUs': timeit.timeit(lambda: yahoo_transit.encode_session_state(decoded), number=args.iterations)
+        / args.iterations * 1e6,
+        'decodeUs': timeit.timeit(lambda: yahoo_transit.decode_session_state(compact), number=args.iterations)
+        / args.iterations * 1e6,
+        'lossless': yahoo_transit.encode_session_state(decoded) == compact,
+    })
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# coding: UTF-8
+"""
+検索結果ページを受信しながら解析し、必要な項目がそろった時点で受信を打ち切る処理（GV_STREAM）のベンチマーク。
+
+帯域を制限したローカルのサーバーから検索結果ページ（benchmarks/fixtures、または --fixture）を返し、
+search_transit_info の所要時間と受信したバイト数を、ページ全体を受信してから解析する場合と比較する。
+--gzip を指定すると、Accept-Encoding に gzip を含むリクエストには圧縮したページを返す。
+
+使い方:
+    $ python benchmarks/bench_streaming.py --bandwidth-kbps 512 --iterations 10
+    $ python benchmarks/bench_streaming.py --bandwidth-kbps 512 --gzip
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_request_path import GV_FIXTURE_DIR, GV_ROOT_DIR, stub_environ, summarize
+
+
+class ThrottledHandler(BaseHTTPRequestHandler):
+    """検索結果ページを、1秒あたり bandwidth バイトに制限して返すハンドラ。"""
+
+    page = b''
+    compressed = None
+    bandwidth = 512 * 1024
+    # -- 送信するページのバイト数（gzip の場合は圧縮後）
+    last_length = 0
+    # -- 1回に送信するバイト数
+    chunk_size = 1024
+
+    def do_GET(self):
+        body, encoding = self.page, None
+        if self.compressed is not None and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body, encoding = self.compressed, 'gzip'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+        try:
+            for i in range(0, len(body), self.chunk_size):
+                self.wfile.write(body[i:i + self.chunk_size])
+                self.wfile.flush()
+                time.sleep(self.chunk_size / float(self.bandwidth))
+        except (BrokenPipeError, ConnectionResetError):
+            # 受信を打ち切られた
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class ThrottledServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def run(module, stream, iterations):
+    """search_transit_info を iterations 回実行し、所要時間（ミリ秒）と受信したバイト数を返す。"""
+    module.GV_STREAM = stream
+    latencies, bytes_read = [], []
+    for _ in range(iterations):
+        before = module.GV_STREAM_STATS['bytesRead']
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            transit_info = module.search_transit_info('渋谷駅', '海浜幕張駅', '2018-06-01 08:00', '出発')
+        latencies.append((time.perf_counter() - start) * 1000)
+        if transit_info is None:
+            raise RuntimeError('Can not parse the fixture')
+        bytes_read.append(module.GV_STREAM_STATS['bytesRead'] - before if stream else ThrottledHandler.last_length)
+    return {'latencyMs': summarize(latencies), 'bytesRead': summarize(bytes_read)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare streaming with early abort against full downloads.')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--bandwidth-kbps', type=float, default=512.0, help='帯域（KB/秒）')
+    parser.add_argument('--gzip', action='store_true', help='gzip で圧縮したページを返す')
+    parser.add_argument('--fixture', default=os.path.join(GV_FIXTURE_DIR, 'search_result.html'))
+    args = parser.parse_args()
+
+    with open(args.fixture, 'rb') as f:
+        ThrottledHandler.page = f.read()
+    if args.gzip:
+        ThrottledHandler.compressed = gzip.compress(ThrottledHandler.page)
+    ThrottledHandler.bandwidth = args.bandwidth_kbps * 1024
+    ThrottledHandler.last_length = len(ThrottledHandler.compressed or ThrottledHandler.page)
+    server = ThrottledServer(('127.0.0.1', 0), ThrottledHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ.update(stub_environ('http://127.0.0.1:%d' % server.server_address[1]))
+    sys.path.insert(0, GV_ROOT_DIR)
+    import yahoo_transit
+
+    result = {
+        'pageBytes': len(ThrottledHandler.page),
+        'transferBytes': ThrottledHandler.last_length,
+        'bandwidthKBps': args.bandwidth_kbps,
+        'full': run(yahoo_transit, False, args.iterations),
+        'streaming': run(yahoo_transit, True, args.iterations),
+    }
+    result['savedMs'] = result['full']['latencyMs']['p50'] - result['streaming']['latencyMs']['p50']
+    result['savedBytes'] = result['full']['bytesRead']['p50'] - result['streaming']['bytesRead']['p50']
+    server.shutdown()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+# coding: UTF-8
+"""
+yahoo_transit_server の負荷試験。
+
+resources/AlexaIntent*.json のイベントを、指定した頻度（1秒あたりのリクエスト数）で yahoo_transit_server に送信し、
+プロセス数（--cores）毎のスループットとレイテンシ（p50, p95, p99）、503 で断られた数を報告する。
+Yahoo!路線情報とIFTTTは、bench_request_path.py と同じローカルのスタブサーバーが応答する。
+
+リクエストは前のリクエストの応答を待たずに予定した時刻に送信し（オープンループ）、
+レイテンシは予定した時刻から数える。サーバーが詰まって送信が遅れた分も、レイテンシに含まれる。
+最後にサーバーに SIGTERM を送り、処理中のリクエストを処理し終えて終了したか（drained）を確認する。
+
+使い方:
+    $ python benchmarks/load_test.py --rate 50 --duration 10 --cores 1,2,4 --delay-ms 100
+    # 日時を毎回変えて、検索結果キャッシュに当たらないようにする
+    $ python benchmarks/load_test.py --rate 20 --vary-time
+"""
+
+from __future__ import print_function
+
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent import futures
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_request_path import GV_FIXTURE_DIR, GV_ROOT_DIR, load_events, start_stub_server, stub_environ, summarize
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, processes, threads, queue_size, environ):
+    """yahoo_transit_server を起動し、/health が応答するまで待つ。"""
+    env = dict(os.environ)
+    env.update(environ)
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(GV_ROOT_DIR, 'yahoo_transit_server.py'), '--host', '127.0.0.1',
+         '--port', str(port), '--processes', str(processes), '--threads', str(threads),
+         '--queue-size', str(queue_size)],
+        cwd=GV_ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/health')
+            if connection.getresponse().status == 200:
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('Server did not start')
+
+
+def make_events(events, vary_time, seed):
+    """送信するイベントを順に返す。vary_time の場合は、SetDateTime の時刻を毎回変える。"""
+    rng = random.Random(seed)
+    for event in itertools.cycle(events):
+        if vary_time and event['request']['intent']['name'] == 'SetDateTime':
+            event = json.loads(json.dumps(event))
+            event['request']['intent']['slots']['Time']['value'] = '%02d:%02d' % (rng.randrange(5, 24),
+                                                                                   rng.randrange(0, 60))
+        yield json.dumps(event).encode('utf-8')
+
+
+def send(port, body, scheduled):
+    """1件送信し、(ステータス, 予定した時刻からのレイテンシ（ミリ秒）) を返す。"""
+    try:
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        connection.request('POST', '/', body, {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        response.read()
+        status = response.status
+        connection.close()
+    except OSError:
+        status = None
+    return status, (time.time() - scheduled) * 1000
+
+
+def run_load(port, bodies, rate, duration, concurrency):
+    """rate 件/秒で duration 秒間送信し、結果を集計する。"""
+    results = []
+    lock = threading.Lock()
+
+    def record(future):
+        with lock:
+            results.append(future.result())
+
+    start = time.time()
+    count = int(rate * duration)
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in range(count):
+            scheduled = start + i / rate
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, port, next(bodies), scheduled).add_done_callback(record)
+    elapsed = time.time() - start
+
+    latencies = [latency for status, latency in results if status == 200]
+    return {
+        'sent': count,
+        'ok': len(latencies),
+        'rejected': sum(1 for status, _ in results if status == 503),
+        'errors': sum(1 for status, _ in results if status not in (200, 503)),
+        'throughput': len(latencies) / elapsed,
+        'latencyMs': summarize(latencies) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test yahoo_transit_server against a local Yahoo stub.')
+    parser.add_argument('--rate', type=float, default=50.0, help='1秒あたりのリクエスト数')
+    parser.add_argument('--duration', type=float, default=10.0, help='送信する秒数')
+    parser.add_argument('--cores', default='1', help='サーバーのプロセス数（カンマ区切りで複数）')
+    parser.add_argument('--threads', type=int, default=8, help='プロセス毎のワーカースレッドの数')
+    parser.add_argument('--queue-size', type=int, default=64, help='プロセス毎の処理を待つリクエストの最大数')
+    parser.add_argument('--delay-ms', type=float, default=100.0, help='スタブサーバーの応答遅延（ミリ秒）')
+    parser.add_argument('--vary-time', action='store_true', help='SetDateTime の時刻を毎回変える')
+    parser.add_argument('--concurrency', type=int, default=256, help='同時に送信中にできるリクエストの最大数')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with open(os.path.join(GV_FIXTURE_DIR, 'search_result.html'), 'rb') as f:
+        stub, base_url = start_stub_server(f.read(), args.delay_ms / 1000.0)
+    events = list(load_events(base_url).values())
+
+    result = {'rate': args.rate, 'duration': args.duration, 'delayMs': args.delay_ms, 'cpus': os.cpu_count(),
+              'runs': []}
+    for processes in [int(value) for value in args.cores.split(',')]:
+        port = free_port()
+        server = start_server(port, processes, args.threads, args.queue_size, stub_environ(base_url))
+        try:
+            run = run_load(port, make_events(events, args.vary_time, args.seed), args.rate, args.duration,
+                           args.concurrency)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            run_drained = server.wait(60) == 0
+        run.update(processes=processes, drained=run_drained)
+        result['runs'].append(run)
+    stub.shutdown()
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
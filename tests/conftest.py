@@ -0,0 +1,8 @@
+# coding: UTF-8
+import os
+import sys
+
+GV_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GV_FIXTURE_DIR = os.path.join(GV_ROOT_DIR, 'benchmarks', 'fixtures')
+
+sys.path.insert(0, GV_ROOT_DIR)
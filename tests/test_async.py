@@ -0,0 +1,128 @@
+# coding: UTF-8
+"""非同期クライアント（yahoo_transit_async）の検索のテスト。aiohttp がない場合は requests で通信する。"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+import requests
+
+import yahoo_transit
+import yahoo_transit_async
+from conftest import GV_FIXTURE_DIR
+
+GV_SEARCH_ARGS = ('渋谷駅', '海浜幕張駅', '2018-06-01 08:00', '出発')
+
+
+class StubYahooHandler(BaseHTTPRequestHandler):
+    """page を返す。delay 秒待ってから応答する。"""
+
+    page = b''
+    delay = 0.0
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(self.page)))
+        self.end_headers()
+        self.wfile.write(self.page)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def yahoo(monkeypatch):
+    with open(os.path.join(GV_FIXTURE_DIR, 'search_result.html'), 'rb') as f:
+        monkeypatch.setattr(StubYahooHandler, 'page', f.read())
+    monkeypatch.setattr(StubYahooHandler, 'delay', 0.0)
+    monkeypatch.setattr(StubYahooHandler, 'requests', [])
+    server = StubServer(('127.0.0.1', 0), StubYahooHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:%d' % server.server_address[1]
+    monkeypatch.setattr(yahoo_transit, 'GV_BASE_URL', base_url)
+    monkeypatch.setattr(yahoo_transit, 'GV_SEARCH_URL', base_url + '/search/result')
+    monkeypatch.setattr(yahoo_transit, 'GV_SHARED_CACHE', None)
+    monkeypatch.setattr(yahoo_transit, 'GV_RESULT_CACHE', OrderedDict())
+    monkeypatch.setattr(yahoo_transit, 'GV_CIRCUIT_BREAKERS', {})
+    yahoo_transit.GV_REQUEST_LOCAL.deadline = None
+    yield StubYahooHandler
+    yahoo_transit.GV_REQUEST_LOCAL.deadline = None
+    server.shutdown()
+    server.server_close()
+
+
+def search(*calls):
+    """検索し、結果と、検索にかかった時間（秒）を返す。"""
+    async def run():
+        async with yahoo_transit_async.AsyncTransitClient(hedge=False) as client:
+            start = time.perf_counter()
+            results = await asyncio.gather(*[client.search(*args) for args in calls])
+            return results, time.perf_counter() - start
+    return asyncio.run(run())
+
+
+def test_concurrent_searches_are_coalesced_and_cached(yahoo):
+    yahoo.delay = 0.2
+
+    (first, second), _ = search(GV_SEARCH_ARGS, GV_SEARCH_ARGS)
+    assert first is not None and first['routes'] == second['routes']
+    assert len(yahoo.requests) == 1
+
+    # 2回目はキャッシュから返す
+    (transit_info,), _ = search(GV_SEARCH_ARGS)
+    assert transit_info['routes'] == first['routes']
+    assert len(yahoo.requests) == 1
+
+
+def test_unparseable_page_is_recorded_as_failure(yahoo):
+    yahoo.page = b'<html><body>maintenance</body></html>'
+
+    (transit_info,), _ = search(GV_SEARCH_ARGS)
+    assert transit_info is None
+    breaker = yahoo_transit.get_circuit_breaker(yahoo_transit.GV_SEARCH_URL.split('/', 3)[2])
+    assert breaker.consecutive_failures == 1
+
+
+def test_stale_result_is_served_when_search_is_slow(monkeypatch, yahoo):
+    monkeypatch.setattr(yahoo_transit, 'GV_CACHE_STALE_WAIT', 0.2)
+    refreshed = []
+    monkeypatch.setattr(yahoo_transit, 'refresh_transit_info', lambda *args: refreshed.append(args))
+    key = yahoo_transit.make_cache_key(*GV_SEARCH_ARGS)
+    yahoo_transit.GV_RESULT_CACHE[key] = (time.time() - 1, {'route': 'old'})
+    yahoo.delay = 1.0
+
+    (transit_info,), elapsed = search(GV_SEARCH_ARGS)
+    assert elapsed < 0.8
+    assert transit_info['route'] == 'old'
+    assert transit_info['stale'] is True
+    # 検索は続けているので、検索し直さない
+    assert refreshed == []
+
+
+def test_sync_wrapper_returns_before_request_deadline(yahoo):
+    yahoo.delay = 1.0
+    yahoo_transit.GV_REQUEST_LOCAL.deadline = time.time() + 0.3
+
+    start = time.perf_counter()
+    with pytest.raises(requests.Timeout):
+        yahoo_transit_async.fetch_transit_info('新宿駅', '東京駅', '2018-06-01 09:00', '出発')
+    assert time.perf_counter() - start < 0.8
+
+
+def test_handlers_use_async_client_when_enabled(monkeypatch):
+    assert yahoo_transit.get_transit_client() is yahoo_transit
+    monkeypatch.setattr(yahoo_transit, 'GV_ASYNC_CLIENT', True)
+    assert yahoo_transit.get_transit_client() is yahoo_transit_async
@@ -0,0 +1,97 @@
+# coding: UTF-8
+"""一括検索（yahoo_transit_batch）のテスト。"""
+
+import io
+import threading
+
+import yahoo_transit
+import yahoo_transit_batch
+
+GV_QUERIES = u'''from,to,datetime,type,walk
+渋谷駅,海浜幕張駅,2018-06-01 08:00,出発,
+渋谷駅,海浜幕張駅,2018-06-01 08:00,乗車,
+渋谷駅,東京駅,明日の朝,出発,
+渋谷駅,品川駅,2018-06-01 09:00,到着,fast
+品川駅,東京駅,2018-06-01 10:00,終電,2
+'''
+
+
+class FakeSharedCache(object):
+
+    def get_many(self, keys):
+        return {}
+
+
+def test_invalid_rows_do_not_abort_batch(monkeypatch):
+    def fetch_transit_info(station_from, station_to, search_date_time, search_type, walk_speed):
+        # 日時が不正な場合は、yahoo_transit と同じく ValueError になる
+        yahoo_transit.make_cache_key(station_from, station_to, search_date_time, search_type, walk_speed)
+        return {'startTime': '09:12発'}
+
+    monkeypatch.setattr(yahoo_transit, 'fetch_transit_info', fetch_transit_info)
+    monkeypatch.setattr(yahoo_transit, 'GV_SHARED_CACHE', FakeSharedCache())
+    results = []
+
+    stats = yahoo_transit_batch.run_batch(yahoo_transit_batch.read_queries(io.StringIO(GV_QUERIES)),
+                                          results.append, workers=2, rate=0)
+    results = dict((result['index'], result) for result in results)
+    assert sorted(results) == [0, 1, 2, 3, 4]
+    assert stats['queries'] == 5 and stats['errors'] == 3 and stats['searches'] == 3
+    assert results[0]['transitInfo'] == {'startTime': '09:12発'}
+    assert results[4]['transitInfo'] == {'startTime': '09:12発'}
+
+    # 不正なタイプ、歩く速度の行も、不正な日時の行と同じ形のエラーになる
+    for index in (1, 2, 3):
+        assert sorted(results[index]) == ['error', 'index', 'query']
+        assert sorted(results[index]['query']) == sorted(yahoo_transit_batch.GV_QUERY_KEYS)
+    assert "Unknown search type: '乗車'" in results[1]['error']
+    assert results[3]['query']['walk'] == 'fast'
+
+
+def test_batch_limits_searches_in_flight(monkeypatch):
+    gate = threading.Event()
+
+    def fetch_transit_info(station_from, station_to, search_date_time, search_type, walk_speed):
+        gate.wait(5)
+        return {'startTime': '09:12発'}
+
+    monkeypatch.setattr(yahoo_transit, 'fetch_transit_info', fetch_transit_info)
+    monkeypatch.setattr(yahoo_transit, 'GV_SHARED_CACHE', None)
+    monkeypatch.setattr(yahoo_transit_batch, 'GV_BATCH_CHUNK', 1)
+    results = []
+    # -- 入力を読み進めた時点での、受け付けて結果を出力していない検索の数
+    accepted = []
+
+    def queries():
+        for index in range(40):
+            accepted.append(index - len(results))
+            yield {'from': '渋谷駅', 'to': '駅%d' % index, 'datetime': '2018-06-01 08:00', 'type': '出発', 'walk': 2}
+
+    threading.Timer(0.3, gate.set).start()
+    stats = yahoo_transit_batch.run_batch(queries(), results.append, workers=2, rate=0)
+    assert stats['searches'] == 40 and len(results) == 40
+    # 検索が止まっている間は、workers * GV_BATCH_WINDOW_RATIO 件を超えて入力を読み進めない
+    assert max(accepted) <= 2 * yahoo_transit_batch.GV_BATCH_WINDOW_RATIO + 1
+
+
+def test_batch_restores_http_settings(monkeypatch):
+    monkeypatch.setattr(yahoo_transit, 'fetch_transit_info', lambda *args: {'startTime': '09:12発'})
+    monkeypatch.setattr(yahoo_transit, 'GV_SHARED_CACHE', None)
+    limiter = yahoo_transit.HostRateLimiter(10)
+    session = object()
+    monkeypatch.setattr(yahoo_transit, 'GV_HTTP_RATE_LIMITER', limiter)
+    monkeypatch.setattr(yahoo_transit, 'GV_HTTP_POOL_MAXSIZE', 8)
+    monkeypatch.setattr(yahoo_transit, 'GV_HTTP_SESSION', session)
+    settings = []
+
+    def write(result):
+        settings.append((yahoo_transit.GV_HTTP_RATE_LIMITER, yahoo_transit.GV_HTTP_POOL_MAXSIZE,
+                         yahoo_transit.GV_HTTP_SESSION))
+
+    yahoo_transit_batch.run_batch(yahoo_transit_batch.read_queries(io.StringIO(GV_QUERIES)), write,
+                                  workers=16, rate=0)
+    # 一括検索の間は制限なし、大きいコネクションプールの別のセッション
+    assert settings and all(s[0] is None and s[1] == 16 and s[2] is not session for s in settings)
+    assert yahoo_transit.GV_HTTP_RATE_LIMITER is limiter
+    assert yahoo_transit.GV_HTTP_POOL_MAXSIZE == 8
+    assert yahoo_transit.GV_HTTP_SESSION is session
@@ -0,0 +1,93 @@
+# coding: UTF-8
+"""有効期限が切れた検索結果（cache_get_stale）を使う fetch_transit_info のテスト。"""
+
+import sys
+import threading
+import time
+
+import pytest
+import requests
+
+import yahoo_transit
+
+GV_SEARCH_ARGS = ('渋谷駅', '海浜幕張駅', '2018-06-01 08:00', '出発')
+
+
+@pytest.fixture
+def stale_entry(monkeypatch):
+    """有効期限が切れた検索結果をローカルのキャッシュに入れ、裏での検索し直しを記録する。"""
+    monkeypatch.setattr(yahoo_transit, 'GV_SHARED_CACHE', None)
+    monkeypatch.setattr(yahoo_transit, 'GV_CACHE_STALE_WAIT', 0.2)
+    refreshed = []
+    monkeypatch.setattr(yahoo_transit, 'refresh_transit_info', lambda *args: refreshed.append(args))
+    key = yahoo_transit.make_cache_key(*GV_SEARCH_ARGS, walk_speed=yahoo_transit.GV_WALK_SPEED)
+    with yahoo_transit.GV_CACHE_LOCK:
+        yahoo_transit.GV_RESULT_CACHE[key] = (time.time() - 1, {'route': 'old'})
+    yield refreshed
+    with yahoo_transit.GV_CACHE_LOCK:
+        yahoo_transit.GV_RESULT_CACHE.pop(key, None)
+
+
+def test_fresh_result_is_preferred_over_stale(monkeypatch, stale_entry):
+    monkeypatch.setattr(yahoo_transit, 'search_transit_info_once', lambda *args: {'route': 'new'})
+    stale = yahoo_transit.GV_CACHE_STATS['stale']
+
+    transit_info = yahoo_transit.fetch_transit_info(*GV_SEARCH_ARGS)
+    assert transit_info == {'route': 'new'}
+    assert yahoo_transit.GV_CACHE_STATS['stale'] == stale
+    assert stale_entry == []
+
+
+@pytest.mark.parametrize('error', [requests.Timeout('slow'), yahoo_transit.CircuitOpenError('open')])
+def test_stale_result_is_served_when_search_fails(monkeypatch, stale_entry, error):
+    def search_transit_info_once(*args):
+        raise error
+
+    monkeypatch.setattr(yahoo_transit, 'search_transit_info_once', search_transit_info_once)
+    stale = yahoo_transit.GV_CACHE_STATS['stale']
+
+    transit_info = yahoo_transit.fetch_transit_info(*GV_SEARCH_ARGS)
+    assert transit_info['route'] == 'old'
+    assert transit_info['stale'] is True
+    assert yahoo_transit.GV_CACHE_STATS['stale'] == stale + 1
+    assert len(stale_entry) == 1
+
+
+def test_search_is_bounded_by_stale_wait(monkeypatch, stale_entry):
+    deadlines = []
+
+    def search_transit_info_once(*args):
+        deadlines.append(yahoo_transit.remaining_request_time())
+        raise requests.Timeout('slow')
+
+    monkeypatch.setattr(yahoo_transit, 'search_transit_info_once', search_transit_info_once)
+    yahoo_transit.GV_REQUEST_LOCAL.deadline = None
+
+    assert yahoo_transit.fetch_transit_info(*GV_SEARCH_ARGS)['route'] == 'old'
+    assert 0 < deadlines[0] <= 0.2
+    assert yahoo_transit.GV_REQUEST_LOCAL.deadline is None
+
+
+def test_cache_stats_are_exact_across_threads(monkeypatch):
+    monkeypatch.setattr(yahoo_transit, 'GV_SHARED_CACHE', None)
+    # スレッドを頻繁に切り替え、ロックせずに加えた場合に回数が失われやすくする
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    before = yahoo_transit.get_cache_stats()
+
+    def run():
+        for _ in range(2000):
+            yahoo_transit.cache_get('missing|key')
+            yahoo_transit.count_cache_stats('coalesced')
+
+    try:
+        threads = [threading.Thread(target=run) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    after = yahoo_transit.get_cache_stats()
+    assert after['miss'] - before['miss'] == 8 * 2000
+    assert after['coalesced'] - before['coalesced'] == 8 * 2000
@@ -0,0 +1,104 @@
+# coding: UTF-8
+"""通勤プロファイル（find_commute_patterns、commute_warmup_handler）のテスト。"""
+
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import pytest
+
+import yahoo_transit
+from yahoo_transit import GV_TZ_JST
+
+
+def make_search(asked_date, asked_minutes, search_minutes, station_to='海浜幕張駅', search_type='到着',
+                search_date=None):
+    return {
+        'askedDate': asked_date,
+        'askedMinutes': asked_minutes,
+        'stationFrom': '渋谷駅',
+        'stationTo': station_to,
+        'searchType': search_type,
+        'searchDate': search_date or asked_date,
+        'searchMinutes': search_minutes,
+    }
+
+
+def test_find_commute_patterns_clusters_by_time_slot():
+    searches = [
+        # 朝: 3日、8:00〜8:20 に同じ日の 8:45 着を検索（2回目は同じ日に2回）
+        make_search('2018-06-04', 480, 525),
+        make_search('2018-06-05', 490, 525),
+        make_search('2018-06-05', 500, 530),
+        make_search('2018-06-06', 485, 520),
+        # 夜: 30分以上離れた時刻の、同じ駅、タイプの検索は別のパターン。翌日の始発を2日検索
+        make_search('2018-06-04', 1380, 0, search_type='始発', search_date='2018-06-05'),
+        make_search('2018-06-06', 1390, 0, search_type='始発', search_date='2018-06-07'),
+        make_search('2018-06-05', 1200, 1230),
+        # 1日しか検索していない条件は、パターンにしない
+        make_search('2018-06-04', 540, 560, station_to='東京駅'),
+    ]
+
+    patterns = yahoo_transit.find_commute_patterns(searches)
+    assert [(pattern['stationTo'], pattern['searchType'], pattern['days']) for pattern in patterns] == [
+        ('海浜幕張駅', '到着', 3), ('海浜幕張駅', '始発', 2)]
+    morning, night = patterns
+    # 検索する時刻は下位25%、最も遅い時刻、検索条件の時刻は中央値
+    assert (morning['askedMinutes'], morning['askedUntil'], morning['searchMinutes']) == (485, 500, 525)
+    assert morning['dayOffset'] == 0
+    assert (night['askedMinutes'], night['askedUntil'], night['dayOffset']) == (1380, 1390, 1)
+
+
+def test_find_commute_patterns_splits_slots_by_gap():
+    # 間隔が GV_COMMUTE_SLOT_MINUTES 分以内なら続けてまとめる（最初と最後が離れていても同じパターン）
+    gap = yahoo_transit.GV_COMMUTE_SLOT_MINUTES
+    searches = [make_search('2018-06-0%d' % (day + 4), 480 + day * gap, 525) for day in range(3)]
+    searches.append(make_search('2018-06-07', 480 + 3 * gap + 1, 525))
+    searches.append(make_search('2018-06-08', 480 + 3 * gap + 1, 525))
+
+    patterns = yahoo_transit.find_commute_patterns(searches)
+    assert [(pattern['askedMinutes'], pattern['askedUntil'], pattern['days']) for pattern in patterns] == [
+        (480, 480 + 2 * gap, 3), (480 + 3 * gap + 1, 480 + 3 * gap + 1, 2)]
+
+
+@pytest.fixture
+def profile(monkeypatch, tmp_path):
+    store = yahoo_transit.SqliteCommuteProfileStore(str(tmp_path / 'profiles.sqlite3'))
+    monkeypatch.setattr(yahoo_transit, 'GV_COMMUTE_PROFILE', store)
+    monkeypatch.setattr(yahoo_transit, 'GV_SHARED_CACHE', None)
+    monkeypatch.setattr(yahoo_transit, 'GV_RESULT_CACHE', OrderedDict())
+    monkeypatch.setattr(yahoo_transit, 'emit_metrics', lambda *args: None)
+    return store
+
+
+def record(user_id, asked, search_date_time, station_to='海浜幕張駅'):
+    transit_info = {'stationFrom': '渋谷駅', 'stationTo': station_to, 'searchDateTime': search_date_time,
+                    'searchType': '到着'}
+    yahoo_transit.record_commute_search({'user': {'userId': user_id}}, transit_info,
+                                        now=datetime.strptime(asked, '%Y-%m-%d %H:%M').replace(tzinfo=GV_TZ_JST))
+
+
+def test_warmup_searches_identical_users_once(monkeypatch, profile):
+    # 3人が同じ条件、1人が別の条件を、平日（2018-06-04〜06）の朝に検索している
+    for day in ('04', '05', '06'):
+        for user_id in ('user-a', 'user-b', 'user-c'):
+            record(user_id, '2018-06-%s 08:05' % day, '2018-06-%s 08:45' % day)
+        record('user-d', '2018-06-%s 08:10' % day, '2018-06-%s 09:00' % day, station_to='東京駅')
+    calls = []
+    lock = threading.Lock()
+
+    def fetch_transit_info(station_from, station_to, search_date_time, search_type):
+        with lock:
+            calls.append((station_from, station_to, search_date_time, search_type))
+        return {'startTime': '08:12発', 'searchDateTime': search_date_time}
+
+    monkeypatch.setattr(yahoo_transit, 'fetch_transit_info', fetch_transit_info)
+
+    result = yahoo_transit.commute_warmup_handler({'now': '2018-06-11 07:55'}, None)
+    assert sorted(calls) == [('渋谷駅', '東京駅', '2018-06-11 09:00', '到着'),
+                             ('渋谷駅', '海浜幕張駅', '2018-06-11 08:45', '到着')]
+    assert (result['users'], result['searches'], result['warmed'], result['predicted']) == (4, 2, 2, 4)
+
+    # 事前検索した条件で検索すると、予測が当たったものとして記録する
+    record('user-a', '2018-06-11 08:05', '2018-06-11 08:45')
+    assert profile.get_prediction_stats(0)['hit'] == 1
@@ -0,0 +1,93 @@
+# coding: UTF-8
+"""日時の解析（resolve_search_datetime など）の性質のテスト。ランダムな日時、期間は固定のシードで生成する。
+以前の処理（benchmarks/bench_datetime.py の legacy_*）と結果を比較する。
+"""
+
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+import yahoo_transit
+from conftest import GV_ROOT_DIR
+from yahoo_transit import GV_TZ_JST
+
+sys.path.insert(0, os.path.join(GV_ROOT_DIR, 'benchmarks'))
+import bench_datetime  # noqa: E402
+
+GV_SEED = 20180601
+GV_SAMPLES = 500
+
+
+@pytest.fixture
+def rng():
+    return random.Random(GV_SEED)
+
+
+def random_datetime(rng):
+    return datetime(2018, 1, 1, tzinfo=GV_TZ_JST) + timedelta(minutes=rng.randrange(0, 3 * 366 * 24 * 60))
+
+
+def test_format_and_parse_are_inverse(rng):
+    for _ in range(GV_SAMPLES):
+        dt = random_datetime(rng)
+        text = yahoo_transit.format_search_datetime(dt)
+        assert yahoo_transit.to_search_datetime(text) == dt, text
+
+
+def test_turn_matches_legacy(rng):
+    for _ in range(GV_SAMPLES):
+        dt = random_datetime(rng)
+        search_type = rng.choice(['出発', '到着', '始発', '終電'])
+        if search_type == '始発' or search_type == '終電':
+            # 始発、終電は日付のみ発話され、時刻は 00:00 になる
+            dt = dt.replace(hour=0, minute=0)
+        text = yahoo_transit.format_search_datetime(dt)
+        slots = {'Date': {'value': text[:10]}, 'Time': {'value': text[11:]}, 'Duration': {}}
+        legacy = bench_datetime.legacy_turn(slots, search_type, dt)
+        current = bench_datetime.current_turn(slots, search_type, dt)
+        # GETパラメータ、キャッシュのキー、確認メッセージ、日時
+        assert current == legacy, (text, search_type)
+
+
+def test_hour_minute_duration_matches_legacy(rng):
+    for _ in range(GV_SAMPLES):
+        dt = random_datetime(rng)
+        hours, minutes = rng.randrange(0, 48), rng.randrange(0, 120)
+        duration = 'PT' + ('%dH' % hours if hours else '') + ('%dM' % minutes if minutes or not hours else '')
+        assert (yahoo_transit.format_search_datetime(yahoo_transit.add_duration(dt, duration))
+                == bench_datetime.legacy_duration_to_datetime(duration, dt)), duration
+
+
+def test_duration_matches_timedelta(rng):
+    for _ in range(GV_SAMPLES):
+        dt = random_datetime(rng)
+        weeks, days, hours = rng.randrange(0, 5), rng.randrange(0, 40), rng.randrange(0, 48)
+        minutes, seconds = rng.randrange(0, 120), rng.randrange(0, 100)
+        duration = 'P%dW%dDT%dH%dM%dS' % (weeks, days, hours, minutes, seconds)
+        assert (yahoo_transit.add_duration(dt, duration)
+                == dt + timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)), duration
+
+
+def test_add_months_clamps_to_month_end(rng):
+    for _ in range(GV_SAMPLES):
+        dt = random_datetime(rng)
+        months = rng.randrange(0, 30)
+        added = yahoo_transit.add_months(dt, months)
+        assert (added.year * 12 + added.month) - (dt.year * 12 + dt.month) == months, (dt, months)
+        assert added.day == dt.day or (added.day < dt.day and (added + timedelta(days=1)).day == 1), (dt, months)
+
+
+def test_resolve_week_stays_in_week(rng):
+    for _ in range(GV_SAMPLES):
+        dt = random_datetime(rng)
+        iso_year, iso_week, _ = (dt + timedelta(days=rng.randrange(-14, 14))).isocalendar()
+        weekend = rng.random() < 0.5
+        value = '%04d-W%02d' % (iso_year, iso_week) + ('-WE' if weekend else '')
+        resolved = yahoo_transit.resolve_date(value, dt)
+        assert resolved.isocalendar()[:2] == (iso_year, iso_week), (dt, value)
+        assert not weekend or resolved.weekday() >= 5, (dt, value)
+        # 現在を含む週は、今日以降の日付
+        assert resolved >= dt.date() or resolved.isocalendar()[:2] != dt.date().isocalendar()[:2], (dt, value)
@@ -0,0 +1,115 @@
+# coding: UTF-8
+"""HTTP通信（http_request）の再試行、残り時間のテスト。"""
+
+import contextlib
+import io
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+import requests
+
+import yahoo_transit
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """statuses の順にステータスコードを返す（最後のものを繰り返す）。delay 秒待ってから応答する。"""
+
+    statuses = [200]
+    delay = 0.0
+    requests = []
+
+    def handle_request(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.requests.append(self.command)
+        status = self.statuses[min(len(self.requests), len(self.statuses)) - 1]
+        time.sleep(self.delay)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    monkeypatch.setattr(StubHandler, 'statuses', [200])
+    monkeypatch.setattr(StubHandler, 'delay', 0.0)
+    monkeypatch.setattr(StubHandler, 'requests', [])
+    monkeypatch.setattr(yahoo_transit, 'GV_HTTP_BACKOFF', 0.01)
+    yahoo_transit.GV_REQUEST_LOCAL.deadline = None
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    StubHandler.url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    yield StubHandler
+    yahoo_transit.GV_REQUEST_LOCAL.deadline = None
+    server.shutdown()
+    server.server_close()
+
+
+def request(method, url, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return yahoo_transit.http_request(method, url, **kwargs)
+
+
+def test_get_is_retried_on_5xx(stub):
+    stub.statuses = [503, 502, 200]
+    assert request('GET', stub.url).status_code == 200
+    assert stub.requests == ['GET', 'GET', 'GET']
+
+
+def test_post_is_not_retried_on_5xx(stub):
+    stub.statuses = [500, 200]
+    assert request('POST', stub.url, data={'value1': 'test'}).status_code == 500
+    assert stub.requests == ['POST']
+
+
+def test_post_is_not_retried_on_read_timeout(stub, monkeypatch):
+    monkeypatch.setattr(yahoo_transit, 'GV_HTTP_READ_TIMEOUT', 0.2)
+    stub.delay = 0.5
+    with pytest.raises(requests.ReadTimeout):
+        request('POST', stub.url, data={'value1': 'test'})
+    assert stub.requests == ['POST']
+
+
+def test_post_is_retried_when_it_can_not_connect(stub, monkeypatch):
+    # 使われていないポート（接続を拒否される）
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    url = 'http://127.0.0.1:%d/' % sock.getsockname()[1]
+    sock.close()
+    attempts = []
+    session = yahoo_transit.get_http_session()
+    send = session.request
+    monkeypatch.setattr(session, 'request', lambda *args, **kwargs: attempts.append(args) or send(*args, **kwargs))
+
+    with pytest.raises(requests.ConnectionError):
+        request('POST', url, data={'value1': 'test'})
+    assert len(attempts) == yahoo_transit.GV_HTTP_MAX_RETRIES + 1
+
+
+def test_request_stops_at_deadline(stub):
+    stub.delay = 1.0
+    yahoo_transit.GV_REQUEST_LOCAL.deadline = time.time() + 0.3
+    start = time.time()
+    with pytest.raises(requests.Timeout):
+        request('GET', stub.url)
+    assert time.time() - start < 0.8
+
+    # 残り時間がない場合は送信しない
+    count = len(stub.requests)
+    yahoo_transit.GV_REQUEST_LOCAL.deadline = time.time() - 1
+    with pytest.raises(requests.Timeout):
+        request('GET', stub.url)
+    assert len(stub.requests) == count
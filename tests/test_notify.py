@@ -0,0 +1,28 @@
+# coding: UTF-8
+"""Line通知の通知キューのテスト。"""
+
+import contextlib
+import io
+import json
+import os
+
+import yahoo_transit
+from conftest import GV_ROOT_DIR
+
+
+def load_event(name):
+    with open(os.path.join(GV_ROOT_DIR, 'resources', 'AlexaIntent' + name + '.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_lambda_handler_flushes_memory_queue_before_returning(monkeypatch):
+    delivered = []
+    monkeypatch.setattr(yahoo_transit, 'deliver_notifications', lambda messages: delivered.extend(messages) or True)
+    monkeypatch.setattr(yahoo_transit, 'GV_ON_LAMBDA', True)
+    monkeypatch.setattr(yahoo_transit, 'GV_NOTIFY_QUEUE_INSTANCE', yahoo_transit.MemoryNotifyQueue())
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = yahoo_transit.lambda_handler(load_event('LineNotify'), None)
+
+    assert response['response']['outputSpeech']['text'] == 'Lineに通知します。'
+    assert len(delivered) == 1
@@ -0,0 +1,80 @@
+# coding: UTF-8
+"""検索結果ページの解析方法（GV_PAGE_PARSERS: 'fast', 'lxml', 'bs4'）が同じ結果を返すことのテスト。"""
+
+import os
+
+import pytest
+
+import yahoo_transit
+from conftest import GV_FIXTURE_DIR
+
+GV_PARSER_NAMES = ('fast', 'lxml', 'bs4')
+
+
+@pytest.fixture(scope='module')
+def page():
+    with open(os.path.join(GV_FIXTURE_DIR, 'search_result.html'), encoding='utf-8') as f:
+        return f.read()
+
+
+def parse(page, name):
+    """解析方法 name で page を解析し、ルート（to_record の結果）と前後の電車のURLを返す。
+    解析できない場合に 'bs4' で解析し直す parse_transit_info を通さず、各解析方法の結果をそのまま比べる。
+    """
+    fields = yahoo_transit.GV_PAGE_PARSERS[name](page, None)
+    routes = [yahoo_transit.Route.from_fields(route_fields).to_record() for route_fields in fields['routes']]
+    return routes, fields['prevUrl'], fields['nextUrl']
+
+
+def test_parsers_return_identical_routes(page):
+    expected = parse(page, 'fast')
+    routes, prev_url, next_url = expected
+    assert len(routes) == 3
+    assert routes[0][:6] == ('36.4km', '626円', '1', 'ＪＲ山手線外回り・品川行', '09:12発', '09:58着')
+    assert routes[0][6] == (('ＪＲ山手線外回り・品川行', '09:12発', '09:25着'),
+                            ('ＪＲ京葉線快速・蘇我行', '09:25着', '09:58着'))
+    assert prev_url.startswith('/search/result?') and 'hh=09' in prev_url
+    assert next_url.startswith('/search/result?') and 'hh=10' in next_url
+    for name in GV_PARSER_NAMES[1:]:
+        assert parse(page, name) == expected, name
+
+
+@pytest.mark.parametrize('name', GV_PARSER_NAMES)
+def test_parse_transit_info_matches_fast_parser(page, name):
+    transit_info = yahoo_transit.parse_transit_info(page, name, None)
+    expected = yahoo_transit.parse_transit_info(page, 'fast', None)
+    assert [route.to_record() for route in transit_info['routes']] == \
+        [route.to_record() for route in expected['routes']]
+    assert transit_info['prevUrl'] == expected['prevUrl']
+    assert transit_info['nextUrl'] == expected['nextUrl']
+    assert [leg.line for leg in transit_info['routes'][0].legs] == transit_info['legs']
+
+
+def test_partial_page_returns_identical_first_route(page):
+    # 2つ目のルートの手前で途切れたページ（受信の途中で切断された場合など）
+    end = page.find('<div id="route02">')
+    assert end > 0
+    partial = page[:end]
+    results = dict((name, yahoo_transit.parse_transit_info(partial, name)) for name in GV_PARSER_NAMES)
+    expected = results['fast']
+    assert expected is not None
+    for name, transit_info in results.items():
+        assert transit_info['routes'][0].to_record() == expected['routes'][0].to_record(), name
+        assert (transit_info['prevUrl'], transit_info['nextUrl']) == (expected['prevUrl'], expected['nextUrl'])
+
+
+@pytest.mark.parametrize('name', GV_PARSER_NAMES)
+def test_malformed_page_returns_none(name):
+    malformed = '<html><body><p>ただいまメンテナンス中です</body>'
+    assert yahoo_transit.parse_transit_info(malformed, name) is None
+    assert yahoo_transit.parse_routes(malformed, name) == []
+
+
+@pytest.mark.parametrize('name', GV_PARSER_NAMES)
+def test_truncated_first_route_returns_none(page, name):
+    # 最初のルートの途中で途切れたページ
+    start = page.find('<div id="route01">')
+    assert start > 0
+    truncated = page[:start + 300]
+    assert yahoo_transit.parse_transit_info(truncated, name) is None
+    assert yahoo_transit.parse_routes(truncated, name) == []
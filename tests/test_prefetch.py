@@ -0,0 +1,55 @@
+# coding: UTF-8
+"""前後の電車の先読み（prefetch_adjacent_transit_info）のテスト。"""
+
+import os
+import threading
+import time
+
+import yahoo_transit
+from conftest import GV_FIXTURE_DIR
+
+
+class FakeResponse(object):
+
+    def __init__(self, url):
+        self.url = url
+
+
+def test_prefetch_does_not_block_and_next_reuses_it(monkeypatch):
+    with open(os.path.join(GV_FIXTURE_DIR, 'search_result.html'), 'rb') as f:
+        page = f.read()
+    calls = []
+    lock = threading.Lock()
+
+    def fetch_transit_page(url, *args, **kwargs):
+        with lock:
+            calls.append(url)
+        time.sleep(0.3)
+        return FakeResponse(url), page, None
+
+    monkeypatch.setattr(yahoo_transit, 'fetch_transit_page', fetch_transit_page)
+    monkeypatch.setattr(yahoo_transit, 'GV_PREFETCH', True)
+    next_url = '/search/result?test=prefetch-next'
+
+    start = time.perf_counter()
+    yahoo_transit.prefetch_adjacent_transit_info({'nextUrl': next_url, 'prevUrl': None})
+    assert time.perf_counter() - start < 0.1
+
+    # 先読み中の"次の電車"は、先読みの結果を待つ（同じページを2回取得しない）
+    transit_info = yahoo_transit.fetch_adjacent_transit_info(None, 'next', next_url)
+    assert transit_info is not None
+    assert calls == [yahoo_transit.GV_BASE_URL + next_url]
+
+    # 先読みした結果は、キャッシュから返す
+    assert yahoo_transit.fetch_adjacent_transit_info(None, 'next', next_url) is not None
+    assert len(calls) == 1
+
+
+def test_prefetch_is_disabled_on_lambda(monkeypatch):
+    monkeypatch.setattr(yahoo_transit, 'GV_PREFETCH', True)
+    monkeypatch.setattr(yahoo_transit, 'GV_ON_LAMBDA', True)
+    submitted = []
+    monkeypatch.setattr(yahoo_transit, 'get_prefetch_executor', lambda: submitted.append(True))
+
+    yahoo_transit.prefetch_adjacent_transit_info({'nextUrl': '/search/result?test=lambda', 'prevUrl': None})
+    assert submitted == []
@@ -0,0 +1,109 @@
+# coding: UTF-8
+"""Progressive Response（progressive_response）を送信するかどうか、送信する時刻のテスト。
+AlexaのDirective Service（/v1/directives）の代わりに、ローカルのスタブサーバーで受け取る。
+"""
+
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+import yahoo_transit
+
+
+class StubDirectiveHandler(BaseHTTPRequestHandler):
+    """受け取った directive を、受け取った時刻（perf_counter）、Authorization ヘッダとあわせて記録する。"""
+
+    directives = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.directives.append((time.perf_counter(), self.path, self.headers.get('Authorization'),
+                                json.loads(body.decode('utf-8'))))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def directives(monkeypatch):
+    monkeypatch.setattr(StubDirectiveHandler, 'directives', [])
+    monkeypatch.setattr(yahoo_transit, 'GV_PROGRESSIVE', True)
+    monkeypatch.setattr(yahoo_transit, 'GV_PROGRESSIVE_THRESHOLD_MS', 200)
+    monkeypatch.setattr(yahoo_transit, 'GV_PROGRESSIVE_LATENCIES', deque(maxlen=yahoo_transit.GV_PROGRESSIVE_SAMPLES))
+    server = StubServer(('127.0.0.1', 0), StubDirectiveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yahoo_transit.set_progressive_context({
+        'context': {'System': {'apiEndpoint': 'http://127.0.0.1:%d' % server.server_address[1],
+                               'apiAccessToken': 'token'}},
+        'request': {'requestId': 'amzn1.echo-api.request.test'},
+    })
+    yield StubDirectiveHandler.directives
+    yahoo_transit.GV_PROGRESSIVE_LOCAL.target = None
+    server.shutdown()
+    server.server_close()
+
+
+def search(seconds):
+    """seconds 秒かかる検索の間に Progressive Response を送信させ、検索を始めた時刻を返す。"""
+    start = time.perf_counter()
+    with yahoo_transit.progressive_response():
+        time.sleep(seconds)
+    return start
+
+
+def wait_for(directives, count, timeout=1.0):
+    deadline = time.time() + timeout
+    while len(directives) < count and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_fast_search_sends_no_directive(directives):
+    skipped = yahoo_transit.GV_PROGRESSIVE_STATS['skipped']
+
+    search(0.02)
+    time.sleep(0.4)
+    assert directives == []
+    assert yahoo_transit.GV_PROGRESSIVE_STATS['skipped'] == skipped + 1
+
+
+def test_slow_search_sends_directive_after_threshold(directives):
+    start = search(0.5)
+    wait_for(directives, 1)
+
+    assert len(directives) == 1
+    received, path, authorization, body = directives[0]
+    assert 0.2 <= received - start < 0.5
+    assert path == '/v1/directives'
+    assert authorization == 'Bearer token'
+    assert body['header'] == {'requestId': 'amzn1.echo-api.request.test'}
+    assert body['directive'] == {'type': 'VoicePlayer.Speak',
+                                 'speech': '<speak>' + yahoo_transit.GV_MSG_PROMPT3 + '</speak>'}
+
+
+def test_directive_is_sent_at_start_when_searches_are_slow(directives):
+    # 最近の検索時間の中央値がしきい値以上なら、しきい値を待たずに送信する
+    yahoo_transit.GV_PROGRESSIVE_LATENCIES.extend([1.0] * 5)
+
+    start = search(0.3)
+    wait_for(directives, 1)
+    assert len(directives) == 1
+    assert directives[0][0] - start < 0.15
+
+
+def test_no_directive_without_api_endpoint(directives):
+    yahoo_transit.set_progressive_context({'context': {'System': {}}, 'request': {'requestId': 'test'}})
+
+    search(0.3)
+    time.sleep(0.1)
+    assert directives == []
@@ -0,0 +1,77 @@
+# coding: UTF-8
+"""セッション情報の形式（encode_session_state / decode_session_state）のテスト。"""
+
+import json
+import os
+
+import pytest
+
+import yahoo_transit
+from conftest import GV_FIXTURE_DIR
+
+# -- 変更前の形式の sessionAttributes の項目
+GV_BASELINE_KEYS = ['stationFrom', 'stationTo', 'url', 'searchDateTime', 'searchType', 'searchResult']
+
+
+@pytest.fixture
+def session_attributes():
+    """SetDateTime で検索した後のセッション情報（search_and_save と同じ手順）。"""
+    with open(os.path.join(GV_FIXTURE_DIR, 'search_result.html'), encoding='utf-8') as f:
+        transit_info = yahoo_transit.parse_transit_info(f.read(), 'fast', yahoo_transit.GV_MAX_ROUTES)
+    transit_info.update({'stationFrom': '渋谷駅', 'stationTo': '海浜幕張駅', 'searchDateTime': '2018-06-01 09:00',
+                         'searchType': '出発'})
+    transit_info['url'] = yahoo_transit.build_search_url('渋谷駅', '海浜幕張駅', '2018-06-01 09:00', '出発')
+    transit_info['searchResult'] = yahoo_transit.make_transit_message(transit_info)
+    transit_info['position'] = 0
+    attributes = {}
+    yahoo_transit.update_session_attributes(attributes, transit_info)
+    attributes['history'] = {}
+    yahoo_transit.save_history(attributes, transit_info, 0)
+    return attributes
+
+
+def size(attributes):
+    return len(json.dumps(attributes, ensure_ascii=False).encode('utf-8'))
+
+
+def test_current_route_is_stored_once(session_attributes):
+    encoded = yahoo_transit.encode_session_state(session_attributes)
+    state = encoded['state']
+    assert state['c'] not in state['r']
+    assert 'ri' not in state
+    assert state['h'] == {'0': None}
+    assert size(encoded) < size(dict((key, session_attributes[key]) for key in GV_BASELINE_KEYS))
+    assert yahoo_transit.decode_session_state(encoded) == dict(
+        (key, value) for key, value in session_attributes.items() if value is not None)
+
+
+def test_sorted_route_round_trip(session_attributes):
+    # 並べ替えた後は、現在のルートが routes の先頭とは限らない
+    routes = session_attributes['routes']
+    session_attributes.update(zip(yahoo_transit.GV_ROUTE_KEYS, routes[1]))
+    session_attributes['order'] = '安い順'
+    encoded = yahoo_transit.encode_session_state(session_attributes)
+    assert encoded['state']['ri'] == 1
+    assert len(encoded['state']['r']) == len(routes) - 1
+    assert yahoo_transit.decode_session_state(encoded)['routes'] == routes
+
+
+def test_history_round_trip_after_next(session_attributes):
+    # "次の電車"（検索位置 1）の結果を保存した後
+    next_info = dict((key, session_attributes[key]) for key in yahoo_transit.GV_ROUTE_KEYS)
+    next_info.update({'url': yahoo_transit.GV_BASE_URL + session_attributes['nextUrl'], 'position': 1,
+                      'prevUrl': '/search/result?hh=09&m1=5', 'nextUrl': '/search/result?hh=09&m1=25',
+                      'stationFrom': '渋谷駅', 'stationTo': '海浜幕張駅', 'searchDateTime': '2018-06-01 09:00',
+                      'searchType': '出発', 'searchResult': 'テスト'})
+    yahoo_transit.update_session_attributes(session_attributes, next_info)
+    session_attributes['routes'] = None
+    yahoo_transit.save_history(session_attributes, next_info, 1)
+
+    encoded = yahoo_transit.encode_session_state(session_attributes)
+    history = encoded['state']['h']
+    assert history['1'] is None
+    # 最初の検索結果のURLは検索条件から、"一本後"のリンクは"一本前"のリンクとの差分から求める
+    assert history['0'][0] is None
+    assert isinstance(history['0'][-1], list)
+    assert yahoo_transit.decode_session_state(encoded) == dict(
+        (key, value) for key, value in session_attributes.items() if value is not None)
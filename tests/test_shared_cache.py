@@ -0,0 +1,128 @@
+# coding: UTF-8
+"""SQLiteの共有キャッシュ（SqliteResultStore）のテスト。"""
+
+import json
+import marshal
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import pytest
+
+import yahoo_transit
+from conftest import GV_FIXTURE_DIR
+
+GV_SEARCH_ARGS = ('渋谷駅', '海浜幕張駅', '2018-06-01 08:00', '出発')
+
+
+def load_transit_info():
+    with open(os.path.join(GV_FIXTURE_DIR, 'search_result.html'), 'rb') as f:
+        transit_info = yahoo_transit.parse_transit_info(f.read(), max_routes=yahoo_transit.GV_MAX_ROUTES)
+    transit_info.update({'stationFrom': GV_SEARCH_ARGS[0], 'stationTo': GV_SEARCH_ARGS[1],
+                         'searchDateTime': GV_SEARCH_ARGS[2], 'searchType': GV_SEARCH_ARGS[3],
+                         'url': 'https://transit.yahoo.co.jp/search/result?from=test'})
+    return transit_info
+
+
+def to_json(transit_info):
+    return json.dumps(transit_info, ensure_ascii=False, sort_keys=True, default=yahoo_transit.route_to_json)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return yahoo_transit.SqliteResultStore(str(tmp_path / 'cache.sqlite3'))
+
+
+def test_round_trip_through_another_connection(store):
+    transit_info = load_transit_info()
+    store.set('key', transit_info, 60)
+
+    # 別のコンテナ（同じファイルの別の接続）から読み込んでも、同じ路線情報に戻る
+    other = yahoo_transit.SqliteResultStore(store.path)
+    assert to_json(other.get('key')) == to_json(transit_info)
+    assert isinstance(other.get('key')['routes'][0], yahoo_transit.Route)
+
+    # 保存する形式は zlib で圧縮した marshal。最初のルートと同じ項目は省く
+    data = other.get_bytes_many(['key'])['key']
+    version, values, records = marshal.loads(zlib.decompress(data))
+    assert version == yahoo_transit.GV_SHARED_CACHE_VERSION
+    assert len(records) == len(transit_info['routes'])
+    assert 'startTime' not in values and values['url'] == transit_info['url']
+    assert len(data) < len(to_json(transit_info).encode('utf-8'))
+
+
+def test_entries_expire_after_ttl(store):
+    store.set_many({'short': (load_transit_info(), 0.2), 'long': (load_transit_info(), 60)})
+    assert sorted(store.get_many(['short', 'long', 'missing'])) == ['long', 'short']
+
+    time.sleep(0.3)
+    assert sorted(store.get_many(['short', 'long'])) == ['long']
+
+
+def test_searching_marker_expires(store):
+    assert store.add('searching|key', 0.2) is True
+    assert store.add('searching|key', 0.2) is False
+    time.sleep(0.3)
+    # 検索中のコンテナが止まっても、有効期限が過ぎれば他のコンテナが検索できる
+    assert store.add('searching|key', 0.2) is True
+    store.delete('searching|key')
+    assert store.add('searching|key', 0.2) is True
+
+
+@pytest.fixture
+def shared(monkeypatch, store):
+    """共有キャッシュに store を使い、Yahoo!路線情報の検索の代わりに、遅れて固定の路線情報を保存する。"""
+    monkeypatch.setattr(yahoo_transit, 'GV_SHARED_CACHE', store)
+    monkeypatch.setattr(yahoo_transit, 'GV_RESULT_CACHE', OrderedDict())
+    searches = []
+    lock = threading.Lock()
+
+    def search_transit_info(station_from, station_to, search_date_time, search_type, walk_speed, *args):
+        with lock:
+            searches.append(station_from)
+        time.sleep(0.2)
+        transit_info = load_transit_info()
+        cache_key = yahoo_transit.make_cache_key(station_from, station_to, search_date_time, search_type,
+                                                 walk_speed)
+        yahoo_transit.cache_set(cache_key, transit_info, 60)
+        return transit_info
+
+    monkeypatch.setattr(yahoo_transit, 'search_transit_info', search_transit_info)
+    return searches
+
+
+def run_threads(target, count=4):
+    results = [None] * count
+
+    def run(i):
+        results[i] = target()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_threads_in_one_container_search_once(shared):
+    coalesced = yahoo_transit.GV_CACHE_STATS['coalesced']
+
+    results = run_threads(lambda: yahoo_transit.fetch_transit_info(*GV_SEARCH_ARGS))
+    assert len(shared) == 1
+    assert all(to_json(result) == to_json(results[0]) for result in results)
+    assert yahoo_transit.GV_CACHE_STATS['coalesced'] - coalesced == 3
+
+
+def test_containers_wait_for_shared_result(shared):
+    # run_once を通さずに呼び出し、コンテナ毎に1スレッドずつ同時に検索する場合に見立てる
+    cache_key = yahoo_transit.make_cache_key(*GV_SEARCH_ARGS)
+
+    results = run_threads(lambda: yahoo_transit._search_transit_info_shared(
+        cache_key, *GV_SEARCH_ARGS, walk_speed=yahoo_transit.GV_WALK_SPEED))
+    assert len(shared) == 1
+    assert all(result is not None and result['routes'] for result in results)
+    # 検索中の印は、検索が終わったら消す
+    assert yahoo_transit.GV_SHARED_CACHE.add('searching|' + cache_key, 1) is True
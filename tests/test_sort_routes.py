@@ -0,0 +1,89 @@
+# coding: UTF-8
+"""並べ替え（intent_SortRoutes）のテスト。"""
+
+import contextlib
+import io
+import json
+import os
+
+import pytest
+
+import yahoo_transit
+from conftest import GV_FIXTURE_DIR, GV_ROOT_DIR
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __init__(self, url):
+        self.url = url
+
+
+def load_event(name):
+    with open(os.path.join(GV_ROOT_DIR, 'resources', 'AlexaIntent' + name + '.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def fetched(monkeypatch):
+    """検索結果ページの代わりに benchmarks/fixtures のページを返し、取得したURLを記録する。"""
+    with open(os.path.join(GV_FIXTURE_DIR, 'search_result.html'), 'rb') as f:
+        page = f.read()
+    urls = []
+
+    def fetch_transit_page(url, *args, **kwargs):
+        urls.append(url)
+        return FakeResponse(url), page, None
+
+    monkeypatch.setattr(yahoo_transit, 'fetch_transit_page', fetch_transit_page)
+    monkeypatch.setattr(yahoo_transit, 'GV_PREFETCH', False)
+    monkeypatch.setattr(yahoo_transit, 'GV_SHARED_CACHE', None)
+    yahoo_transit.GV_RESULT_CACHE.clear()
+    return urls
+
+
+def handle(name, attributes=None, intent=None):
+    event = load_event(name)
+    if attributes is not None:
+        event['session']['attributes'] = attributes
+    if intent is not None:
+        event['request']['intent']['name'] = intent
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = yahoo_transit.lambda_handler(event, None)
+    return response['response']['outputSpeech']['text'], response['sessionAttributes']
+
+
+@pytest.mark.parametrize('steps', [
+    # 最初の検索結果に戻った場合
+    ['AMAZON.NextIntent', 'AMAZON.PreviousIntent'],
+    # 前後の電車の検索結果に戻った場合
+    ['AMAZON.NextIntent', 'AMAZON.NextIntent', 'AMAZON.PreviousIntent'],
+])
+def test_sort_after_answer_from_history(fetched, steps):
+    speech, attributes = handle('SetDateTime')
+    for intent in steps:
+        speech, attributes = handle('Next', attributes, intent)
+    assert speech != yahoo_transit.GV_MSG_ERROR
+    # 保存済みの履歴で応答した場合は、セッションに他のルートがない
+    assert yahoo_transit.decode_session_state(attributes).get('routes') is None
+    count = len(fetched)
+
+    speech, attributes = handle('SortRoutes', attributes)
+    assert speech.startswith('安い順では、')
+    assert '580円' in speech
+    # 前後の電車の検索、最初の検索の結果はキャッシュにあるため、取得し直さない
+    assert len(fetched) == count
+    assert len(yahoo_transit.decode_session_state(attributes)['routes']) == 3
+
+
+def test_sort_refetches_page_when_not_cached(fetched):
+    speech, attributes = handle('SetDateTime')
+    for intent in ['AMAZON.NextIntent', 'AMAZON.NextIntent', 'AMAZON.PreviousIntent']:
+        speech, attributes = handle('Next', attributes, intent)
+    # 別のコンテナで処理する場合など、キャッシュにない
+    yahoo_transit.GV_RESULT_CACHE.clear()
+    count = len(fetched)
+
+    speech, attributes = handle('SortRoutes', attributes)
+    assert speech.startswith('安い順では、')
+    assert fetched[count:] == [yahoo_transit.decode_session_state(attributes)['url']]
@@ -0,0 +1,47 @@
+# coding: UTF-8
+"""駅名索引による駅名の変換（resolve_station_name, suggest_station_name）のテスト。"""
+
+import contextlib
+import io
+
+import pytest
+
+import yahoo_transit
+
+
+@pytest.mark.parametrize('name, canonical', [
+    ('渋谷', '渋谷駅'),
+    ('しぶや', '渋谷駅'),
+    ('アキバ', '秋葉原駅'),
+    ('浅草', '浅草駅'),
+])
+def test_resolve_exact(name, canonical):
+    assert yahoo_transit.resolve_station_name(name) == canonical
+
+
+@pytest.mark.parametrize('name', ['浅草橋', '赤羽橋', '浅草橋駅', '赤羽橋駅'])
+def test_different_station_is_not_rewritten(name):
+    # 索引にない別の駅を、名前が似た駅に置き換えない
+    assert yahoo_transit.resolve_station_name(name) is None
+    assert yahoo_transit.suggest_station_name(name) is None
+
+
+def test_suggest_typo():
+    assert yahoo_transit.suggest_station_name('いけぶくら') == '池袋駅'
+
+
+def test_set_station_passes_unknown_name_through(monkeypatch):
+    monkeypatch.setattr(yahoo_transit, 'GV_STATION_STRICT', False)
+    intent = {'name': 'SetStation', 'slots': {'StationFrom': {'value': '浅草橋'}, 'StationTo': {'value': '赤羽'}}}
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = yahoo_transit.intent_SetStation(intent, {'attributes': {}})
+    attributes = yahoo_transit.decode_session_state(response['sessionAttributes'])
+    assert attributes['stationFrom'] == '浅草橋'
+    assert attributes['stationTo'] == '赤羽駅'
+
+
+def test_station_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(yahoo_transit, 'GV_STATION_CACHE_MAX_ENTRIES', 4)
+    for i in range(10):
+        yahoo_transit.resolve_station_name('駅%d' % i)
+    assert len(yahoo_transit.GV_STATION_CACHE) == 4
@@ -0,0 +1,76 @@
+# coding: UTF-8
+"""検索結果ページを受信しながら解析する処理（fetch_transit_page）と、サーキットブレーカーのテスト。"""
+
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import requests
+
+import yahoo_transit
+from conftest import GV_FIXTURE_DIR
+
+
+class TruncatedHandler(BaseHTTPRequestHandler):
+    """Content-Length より短い本文を送信して接続を切る（本文の受信中に失敗する）ハンドラ。"""
+
+    page = b''
+    # -- 送信する本文のバイト数
+    sent = 1024
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=UTF-8')
+        self.send_header('Content-Length', str(len(self.page)))
+        self.end_headers()
+        self.wfile.write(self.page[:self.sent])
+        self.wfile.flush()
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def truncated_server(monkeypatch):
+    with open(os.path.join(GV_FIXTURE_DIR, 'search_result.html'), 'rb') as f:
+        TruncatedHandler.page = f.read()
+    server = HTTPServer(('127.0.0.1', 0), TruncatedHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = '127.0.0.1:%d' % server.server_address[1]
+    monkeypatch.setattr(yahoo_transit, 'GV_SEARCH_URL', 'http://' + host + '/search/result')
+    monkeypatch.setattr(yahoo_transit, 'GV_STREAM', True)
+    monkeypatch.setattr(yahoo_transit, 'GV_PARSER', 'fast')
+    try:
+        yield host
+    finally:
+        server.shutdown()
+        server.server_close()
+        yahoo_transit.GV_CIRCUIT_BREAKERS.pop(host, None)
+
+
+def search():
+    return yahoo_transit.search_transit_info('渋谷駅', '海浜幕張駅', '2018-06-01 08:00', '出発')
+
+
+def test_body_failure_in_half_open_trial_reopens_circuit(truncated_server):
+    breaker = yahoo_transit.get_circuit_breaker(truncated_server)
+    breaker.state = 'open'
+    breaker.opened_at = 0.0
+
+    with pytest.raises(requests.RequestException):
+        search()
+    assert breaker.state == 'open'
+
+    # 再び開いたので、reset_timeout の間は送信しない
+    with pytest.raises(yahoo_transit.CircuitOpenError):
+        search()
+
+
+def test_body_failure_in_closed_state_is_counted(truncated_server):
+    breaker = yahoo_transit.get_circuit_breaker(truncated_server)
+    with pytest.raises(requests.RequestException):
+        search()
+    assert breaker.state == 'closed'
+    assert breaker.consecutive_failures == 1
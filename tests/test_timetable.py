@@ -0,0 +1,49 @@
+# coding: UTF-8
+"""始発、終電の検索結果キャッシュのキー（make_timetable_key）と、祝日の計算（get_japanese_holidays）のテスト。"""
+
+import pytest
+
+import yahoo_transit
+
+
+def key(search_date):
+    return yahoo_transit.make_timetable_key('渋谷駅', '海浜幕張駅', search_date, '始発')
+
+
+@pytest.mark.parametrize('search_date', [
+    '2026-01-12',  # 成人の日（第2月曜）
+    '2026-03-20',  # 春分の日
+    '2026-05-06',  # 振替休日
+    '2026-07-20',  # 海の日（第3月曜）
+    '2026-09-21',  # 敬老の日（第3月曜）
+    '2026-09-22',  # 国民の休日（敬老の日と秋分の日の間）
+    '2026-10-12',  # スポーツの日（第2月曜）
+    '2026-12-31',  # 年末年始
+])
+def test_moving_holiday_shares_holiday_key(search_date):
+    assert yahoo_transit.get_day_type(search_date, exact=True) == 'holiday'
+    assert key(search_date) == key('2026-10-18')
+
+
+def test_weekdays_share_key():
+    assert key('2026-10-13') == key('2026-10-14') == key('2026-10-16')
+    assert '2026-10-14' not in key('2026-10-14')
+    assert key('2026-10-17') != key('2026-10-14')
+
+
+def test_unknown_year_is_keyed_by_date():
+    assert yahoo_transit.get_day_type('2100-03-22', exact=True) is None
+    assert yahoo_transit.get_day_type('2100-03-22') == 'weekday'
+    assert '2100-03-22' in key('2100-03-22')
+
+
+@pytest.mark.parametrize('year, included, excluded', [
+    (2018, ['12-23', '12-24', '09-24'], ['02-23']),
+    (2019, ['05-01', '10-22', '04-30', '05-06'], ['12-23', '02-23']),
+    (2020, ['07-23', '07-24', '08-10'], ['07-20', '08-11', '10-12']),
+    (2021, ['07-22', '07-23', '08-08', '08-09'], ['08-10', '10-11']),
+])
+def test_special_holidays(year, included, excluded):
+    holidays = yahoo_transit.get_japanese_holidays(year)
+    assert all(day in holidays for day in included)
+    assert not any(day in holidays for day in excluded)
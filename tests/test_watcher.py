@@ -0,0 +1,202 @@
+# coding: UTF-8
+"""通勤経路の監視（yahoo_transit_watcher）のテスト。"""
+
+import contextlib
+import io
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import yahoo_transit
+import yahoo_transit_watcher
+from conftest import GV_FIXTURE_DIR
+
+GV_SUBSCRIPTION = {'id': 'alice', 'from': '渋谷駅', 'to': '海浜幕張駅', 'time': '08:45', 'type': '到着',
+                   'days': ['weekday']}
+
+
+class StubYahooHandler(BaseHTTPRequestHandler):
+    """検索結果ページの代わりに page を返す。If-None-Match が etag と同じ場合は 304 を返す。"""
+
+    page = b''
+    etag = None
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        if self.etag is not None and self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=UTF-8')
+        self.send_header('Content-Length', str(len(self.page)))
+        if self.etag is not None:
+            self.send_header('ETag', self.etag)
+        self.end_headers()
+        self.wfile.write(self.page)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def yahoo(monkeypatch):
+    with open(os.path.join(GV_FIXTURE_DIR, 'search_result.html'), 'rb') as f:
+        StubYahooHandler.page = f.read()
+    StubYahooHandler.etag = None
+    StubYahooHandler.requests = []
+    server = HTTPServer(('127.0.0.1', 0), StubYahooHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(yahoo_transit, 'GV_SEARCH_URL', 'http://127.0.0.1:%d/search/result' % server.server_address[1])
+    monkeypatch.setattr(yahoo_transit, 'GV_STREAM', False)
+    yield StubYahooHandler
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def webhook(monkeypatch):
+    """IFTTTの代わりにスタブのWebhookに、その場で（SyncNotifyQueue で）通知する。"""
+    monkeypatch.setattr(yahoo_transit, 'GV_IFTTT_URL', None)
+    monkeypatch.setattr(yahoo_transit, 'GV_NOTIFY_QUEUE_INSTANCE', yahoo_transit.SyncNotifyQueue())
+    monkeypatch.setattr(yahoo_transit_watcher.StubWebhookHandler, 'received', [])
+    with contextlib.redirect_stderr(io.StringIO()):
+        server = yahoo_transit_watcher.start_stub_webhook()
+        yield yahoo_transit_watcher.StubWebhookHandler.received
+    server.shutdown()
+    server.server_close()
+
+
+def poll(watcher, now='2018-06-01 08:30'):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return watcher.poll(yahoo_transit.to_search_datetime(now))
+
+
+def delay_arrival(yahoo):
+    """最初のルートの到着を遅らせたページにする。"""
+    yahoo.page = yahoo.page.replace('09:58着'.encode('utf-8'), '10:05着'.encode('utf-8'))
+
+
+def test_failed_notification_is_retried_on_next_poll(yahoo, webhook, monkeypatch):
+    second = dict(GV_SUBSCRIPTION, **{'from': '品川駅', 'time': '08:40'})
+    watcher = yahoo_transit_watcher.CommuteWatcher([GV_SUBSCRIPTION, second])
+    assert poll(watcher)['parsed'] == 2
+    delay_arrival(yahoo)
+
+    # 最初の通勤経路の通知だけ失敗する
+    deliver = yahoo_transit.deliver_notifications
+    monkeypatch.setattr(yahoo_transit, 'deliver_notifications',
+                        lambda messages: '品川駅' in messages[0]['value1'] and deliver(messages))
+    stats = poll(watcher)
+    assert stats['failed'] == 1 and stats['notified'] == 1
+    assert len(webhook) == 1 and '品川駅' in webhook[0]['value1']
+    # 通知できなかった変更は、前回の検索結果に反映しない
+    routes = sorted(entry['route'][5] for entry in watcher.state.values())
+    assert routes == ['09:58着', '10:05着']
+
+    monkeypatch.setattr(yahoo_transit, 'deliver_notifications', deliver)
+    stats = poll(watcher)
+    assert stats['notified'] == 1
+    assert len(webhook) == 2 and '渋谷駅' in webhook[1]['value1']
+    assert [entry['route'][5] for entry in watcher.state.values()] == ['10:05着', '10:05着']
+
+
+def test_watcher_handler_saves_state_when_notification_fails(yahoo, monkeypatch, tmp_path):
+    path = str(tmp_path / 'state.json')
+    monkeypatch.setattr(yahoo_transit_watcher, 'GV_WATCH_STATE', path)
+    monkeypatch.setattr(yahoo_transit, 'GV_NOTIFY_QUEUE_INSTANCE', yahoo_transit.SyncNotifyQueue())
+    monkeypatch.setattr(yahoo_transit, 'deliver_notifications', lambda messages: False)
+    now = yahoo_transit.to_search_datetime('2018-06-01 08:30')
+    monkeypatch.setattr(yahoo_transit_watcher, 'datetime', type('datetime', (object,), {
+        'now': staticmethod(lambda tz=None: now)}))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        yahoo_transit_watcher.watcher_handler({'subscriptions': [GV_SUBSCRIPTION]}, None)
+        delay_arrival(yahoo)
+        stats = yahoo_transit_watcher.watcher_handler({'subscriptions': [GV_SUBSCRIPTION]}, None)
+    assert stats['failed'] == 1
+    state = yahoo_transit_watcher.load_state(path)
+    assert [entry['route'][5] for entry in state.values()] == ['09:58着']
+
+
+def make_route(start_time, arrival_time, transport='ＪＲ山手線外回り・品川行', fare='626円'):
+    return yahoo_transit.Route('36.4km', fare, '1', transport, start_time, arrival_time)
+
+
+def test_diff_routes():
+    previous = make_route('09:12発', '09:58着')
+    assert yahoo_transit_watcher.diff_routes(previous, make_route('09:12発', '09:58着')) == []
+    # 到着が早くなっただけの場合は通知しない
+    assert yahoo_transit_watcher.diff_routes(previous, make_route('09:12発', '09:55着')) == []
+    changes = yahoo_transit_watcher.diff_routes(previous, make_route('09:15発', '10:05着', '京成バス・海浜幕張駅行',
+                                                                     '580円'))
+    assert changes == ['到着が09:58着から10:05着に遅くなりました。',
+                       '乗車する電車が09:12発のＪＲ山手線外回り・品川行から、09:15発の京成バス・海浜幕張駅行に変わりました。',
+                       '料金が626円から580円に変わりました。']
+
+
+def test_due_groups():
+    subscriptions = [
+        GV_SUBSCRIPTION,
+        # 同じ駅、タイプで、時刻が同じ単位に入る通勤経路はまとめる
+        dict(GV_SUBSCRIPTION, id='bob', time='08:47'),
+        # 時刻の GV_WATCH_WINDOW 分前より前
+        dict(GV_SUBSCRIPTION, id='carol', time='10:00'),
+        # 土曜のみ
+        dict(GV_SUBSCRIPTION, id='dave', days=['saturday']),
+    ]
+    watcher = yahoo_transit_watcher.CommuteWatcher(subscriptions, window=60)
+    groups = watcher.due_groups(yahoo_transit.to_search_datetime('2018-06-01 08:30'))
+    assert len(groups) == 1
+    key, (search_dt, members) = groups.popitem()
+    assert '2018-06-01' not in key
+    assert yahoo_transit.format_search_datetime(search_dt) == '2018-06-01 08:45'
+    assert [member['id'] for member in members] == ['alice', 'bob']
+
+    saturday = watcher.due_groups(yahoo_transit.to_search_datetime('2018-06-02 08:30'))
+    assert [member['id'] for _, members in saturday.values() for member in members] == ['dave']
+
+
+def test_unchanged_pages_are_not_parsed(yahoo, webhook):
+    watcher = yahoo_transit_watcher.CommuteWatcher([GV_SUBSCRIPTION])
+    assert poll(watcher)['parsed'] == 1
+
+    # 内容が同じページは解析しない
+    stats = poll(watcher)
+    assert (stats['fetched'], stats['unchanged'], stats['parsed']) == (1, 1, 0)
+
+    # ETag が同じ場合は 304 Not Modified
+    yahoo.etag = '"v1"'
+    delay_arrival(yahoo)
+    stats = poll(watcher)
+    assert stats['parsed'] == 1 and stats['notified'] == 1
+    assert len(webhook) == 1 and '到着が09:58着から10:05着に遅くなりました。' in webhook[0]['value1']
+    stats = poll(watcher)
+    assert (stats['notModified'], stats['parsed'], stats['notified']) == (1, 0, 0)
+    assert yahoo.requests[-1]['If-None-Match'] == '"v1"'
+    assert len(webhook) == 1
+
+
+def test_state_does_not_grow_across_days(yahoo, webhook):
+    watcher = yahoo_transit_watcher.CommuteWatcher([GV_SUBSCRIPTION])
+    watcher.state['渋谷駅|海浜幕張駅|2018-05-31|08:45|到着|2'] = {'route': None}
+    for day in ('2018-06-01', '2018-06-04', '2018-06-05'):
+        poll(watcher, day + ' 08:30')
+    assert len(watcher.state) == 1
+    entry = list(watcher.state.values())[0]
+    assert entry['date'] == '2018-06-05'
+
+    # 別の日の検索結果とは比べない（条件付きリクエストにも使わない）
+    delay_arrival(yahoo)
+    yahoo.etag = '"v1"'
+    stats = poll(watcher, '2018-06-06 08:30')
+    assert (stats['parsed'], stats['notified']) == (1, 0)
+    assert 'If-None-Match' not in yahoo.requests[-1]
+
+    watcher.subscriptions = []
+    poll(watcher, '2018-06-06 08:35')
+    assert watcher.state == {}
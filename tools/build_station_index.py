@@ -0,0 +1,46 @@
+# coding: UTF-8
+"""
+駅名索引の生成。
+
+resources/stations.tsv（駅名<TAB>読み・別名）から、正規化した駅名をキーとして
+キーの昇順（UTF-8のバイト順）に並べた索引 resources/stations.idx を生成する。
+yahoo_transit.resolve_station_name は、この索引を mmap して二分探索する。
+
+使い方:
+    $ python tools/build_station_index.py [resources/stations.tsv] [resources/stations.idx]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+GV_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GV_ROOT_DIR)
+
+from yahoo_transit import normalize_station_name
+
+
+def build_index(source_path, index_path):
+    entries = {}
+    with open(source_path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            canonical, _, aliases = line.partition('\t')
+            for name in [canonical] + [alias for alias in aliases.split(',') if alias]:
+                key = normalize_station_name(name).encode('utf-8')
+                # 同じキーの駅名が複数ある場合は、先に書かれた駅名を優先する
+                entries.setdefault(key, canonical.encode('utf-8'))
+
+    with open(index_path, 'wb') as f:
+        for key in sorted(entries):
+            f.write(key + b'\t' + entries[key] + b'\n')
+    return len(entries)
+
+
+if __name__ == '__main__':
+    source = sys.argv[1] if len(sys.argv) > 1 else os.path.join(GV_ROOT_DIR, 'resources', 'stations.tsv')
+    index = sys.argv[2] if len(sys.argv) > 2 else os.path.join(GV_ROOT_DIR, 'resources', 'stations.idx')
+    print('%d keys -> %s' % (build_index(source, index), index))
@@ -6,15 +6,30 @@ Yahoo!路線情報を利用して、電車検索を行う。
 
 from __future__ import print_function
 
-# -- Use KMS to encrypt IFTTT webhook key
-import boto3
 import os
 from base64 import b64decode
 
+import codecs
+import difflib
+import hashlib
+import json
+import marshal
+import mmap
 import re
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent import futures
+from contextlib import contextmanager
+from urllib.parse import urlencode
 from datetime import datetime, timedelta, timezone
-import requests
-from bs4 import BeautifulSoup
+from html.parser import HTMLParser
+
+# -- コールドスタートを速くするため、boto3, requests, bs4, lxml は
+# -- 必要になったインテントの処理中に import する
 
 
 # --------------------------------------
@@ -22,15 +37,78 @@ from bs4 import BeautifulSoup
 # --------------------------------------
 
 # -- Yahoo!路線情報
-GV_BASE_URL = 'https://transit.yahoo.co.jp'
-GV_SEARCH_URL = 'https://transit.yahoo.co.jp/search/result'
+# -- 環境変数 yahoo_base_url でローカルのスタブサーバーなどに差し替えられる
+GV_BASE_URL = os.environ.get('yahoo_base_url', 'https://transit.yahoo.co.jp')
+GV_SEARCH_URL = GV_BASE_URL + '/search/result'
+
+# -- 駅名索引: tools/build_station_index.py で生成した、正規化した駅名と正式な駅名の対応表
+# -- 索引がない場合は、発話された駅名をそのまま検索に使う
+GV_STATION_INDEX = os.environ.get(
+    'station_index', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', 'stations.idx'))
+# -- 1 の場合、索引にない駅名はYahoo路線で検索せずに聞き返す（0 の場合は、発話された駅名のまま検索する）
+GV_STATION_STRICT = os.environ.get('station_strict', '0') == '1'
+# -- 索引にない駅名に、似た駅名を提案する類似度の下限（長さが同じ駅名のみ。浅草橋と浅草のような別の駅は提案しない）
+GV_STATION_FUZZY_CUTOFF = 0.8
+# -- 駅名の変換結果を保持する件数
+GV_STATION_CACHE_MAX_ENTRIES = 1024
 
 # -- Line Notify via IFTTT
-ENCRYPTED = os.environ['ifttt_webhook_key']
-# Decrypt code should run once and variables stored outside of the function
-# handler so that these are decrypted once per container
-DECRYPTED = boto3.client('kms').decrypt(CiphertextBlob=b64decode(ENCRYPTED))['Plaintext'].decode('utf-8')
-GV_IFTTT_URL = 'https://maker.ifttt.com/trigger/yahoo_transit/with/key/' + DECRYPTED
+# -- Webhooksキーは最初に通知する時に取得し、コンテナが再利用される間は保持する（get_ifttt_url）
+GV_IFTTT_BASE_URL = os.environ.get('ifttt_base_url', 'https://maker.ifttt.com')
+GV_IFTTT_URL = None
+
+# -- Line通知の送信方法
+# -- 'memory': プロセス内のキューからバックグラウンドで送信, 'file': notify_spool_dir のファイル経由で送信,
+# -- 'sqs': notify_queue_url のSQSキューに送り、notify_handler で送信, 'sync': 応答前に送信
+# -- Lambdaでは応答を返すとコンテナが止まり、バックグラウンドの送信も止まるため、既定を 'sync' にする
+GV_ON_LAMBDA = bool(os.environ.get('AWS_LAMBDA_FUNCTION_NAME'))
+GV_NOTIFY_QUEUE = os.environ.get('notify_queue', 'sync' if GV_ON_LAMBDA else 'memory')
+# -- Lambdaで 'memory', 'file' を指定した場合に、応答前にキューの通知を送信し終えるのを待つ最大の時間（秒）
+GV_NOTIFY_FLUSH_TIMEOUT = 2.0
+# -- 1回の送信にまとめる通知の最大数と、まとめるために待つ時間（秒）
+GV_NOTIFY_BATCH_SIZE = 5
+GV_NOTIFY_BATCH_WAIT = 0.2
+# -- 送信に失敗した通知を再送する回数、待ち時間（秒、再送毎に倍にする）
+GV_NOTIFY_MAX_ATTEMPTS = 3
+GV_NOTIFY_BACKOFF = 1.0
+# -- 同じセッションで、通知済みとして覚えておく検索結果の数
+GV_NOTIFY_DEDUP_SIZE = 5
+
+# -- HTTP通信
+# -- コネクションプールの大きさ（ホスト数、ホスト毎の接続数）
+GV_HTTP_POOL_CONNECTIONS = 4
+GV_HTTP_POOL_MAXSIZE = 8
+# -- 接続、読み込みのタイムアウト（秒）の上限
+GV_HTTP_CONNECT_TIMEOUT = 2.0
+GV_HTTP_READ_TIMEOUT = 5.0
+# -- 失敗時の再試行回数、待ち時間（秒、再試行毎に倍にする）
+GV_HTTP_MAX_RETRIES = 2
+GV_HTTP_BACKOFF = 0.2
+# -- 繰り返し送信しても結果が変わらないメソッド。それ以外（IFTTTへのPOSTなど）は、接続できなかった場合のみ再試行する
+GV_HTTP_IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+# -- ホスト毎の1秒あたりの最大リクエスト数（0の場合は制限しない）
+GV_HTTP_RATE_LIMIT = float(os.environ.get('http_rate_limit', 0))
+# -- サーキットブレーカー: ホスト毎に、連続してこの回数失敗したら GV_CIRCUIT_RESET_TIMEOUT 秒の間は送信しない
+GV_CIRCUIT_FAILURES = int(os.environ.get('circuit_failures', 5))
+GV_CIRCUIT_RESET_TIMEOUT = float(os.environ.get('circuit_reset_timeout', 30))
+# -- Alexaの応答期限（ミリ秒）と、応答を組み立てるために残しておく時間（ミリ秒）
+GV_ALEXA_TIMEOUT_MS = 8000
+GV_DEADLINE_MARGIN_MS = 1000
+
+# -- インテント毎の計測: HTTP通信、検索結果ページの解析、メッセージ生成、セッション情報の変換
+GV_METRICS_NAMESPACE = 'YahooTransit'
+GV_METRICS_SECTIONS = ['http', 'parse', 'message', 'serialize']
+# -- サンプリングプロファイラを有効にするリクエストID（カンマ区切り）と、全リクエストに対する割合
+GV_PROFILE_REQUEST_IDS = set(filter(None, os.environ.get('profile_request_ids', '').split(',')))
+GV_PROFILE_SAMPLE_RATE = float(os.environ.get('profile_sample_rate', 0))
+
+# -- Progressive Response: 検索に時間がかかる場合、検索中に GV_MSG_PROMPT3 を発話させる
+# -- 環境変数 progressive_response=0 で無効にする。検索がこの時間（ミリ秒）を超えたら送信する
+GV_PROGRESSIVE = os.environ.get('progressive_response', '1') == '1'
+GV_PROGRESSIVE_THRESHOLD_MS = int(os.environ.get('progressive_threshold_ms', 800))
+# -- 最近の検索時間の中央値が閾値以上の場合は、検索の開始と同時に送信する。中央値の計算に使う検索時間の数
+GV_PROGRESSIVE_SAMPLES = 50
+GV_PROGRESSIVE_WORKERS = 4
 
 # -- 検索リクエストに含めるGETパラメータ
 # -- タイプ: type = 1(出発), 2(終電), 3(始発), 4(到着)
@@ -40,6 +118,101 @@ GV_TYPE_FIRST = 3
 GV_TYPE_ARRIVE = 4
 # -- 歩く速度: ws = 1(急いで), 2(少し急いで), 3(少しゆっくり), 4(ゆっくり)
 GV_WALK_SPEED = 2
+# -- 発話されるタイプとGETパラメータの対応
+GV_SEARCH_TYPES = {
+    '出発': GV_TYPE_DEPARTURE,
+    '到着': GV_TYPE_ARRIVE,
+    '始発': GV_TYPE_FIRST,
+    '終電': GV_TYPE_LAST,
+}
+
+# -- 検索結果キャッシュ
+# -- コンテナが再利用される間（ウォームスタート）は、同じ条件の検索結果を使い回す
+# -- 出発/到着時刻は GV_CACHE_BUCKET_MINUTES 分単位に丸めてキーにする
+GV_CACHE_BUCKET_MINUTES = int(os.environ.get('cache_bucket_minutes', 5))
+GV_CACHE_MAX_ENTRIES = int(os.environ.get('cache_max_entries', 256))
+# -- 有効期限（秒）: 検索日時が現在から離れているほど長く保持する
+GV_CACHE_TTL_MIN = 60
+GV_CACHE_TTL_MAX = 6 * 60 * 60
+GV_CACHE_TTL_RATIO = 10
+# -- 有効期限が切れてからこの秒数の間は、検索し直しが遅い、または失敗した場合に、古い可能性がある結果で応答する
+GV_CACHE_STALE_TTL = int(os.environ.get('cache_stale_ttl', 24 * 60 * 60))
+# -- 古い結果がある場合に、検索し直すのを待つ時間（秒）。過ぎた場合は古い結果で応答し、裏で検索し直す
+GV_CACHE_STALE_WAIT = float(os.environ.get('cache_stale_wait', 2.0))
+
+# -- コンテナ間で共有する検索結果キャッシュ
+# -- '': 使用しない, 'redis': shared_cache_url のRedis, 'dynamodb': shared_cache_table のDynamoDBテーブル,
+# -- 'sqlite': shared_cache_path のSQLiteファイル（ローカルでの確認用）
+GV_SHARED_CACHE_BACKEND = os.environ.get('shared_cache', '')
+# -- 他のコンテナが同じ条件を検索している間、共有キャッシュに結果が保存されるのを待つ時間（秒）と間隔（秒）
+GV_SHARED_CACHE_WAIT = float(os.environ.get('shared_cache_wait', 1.0))
+GV_SHARED_CACHE_POLL = 0.05
+# -- 共有キャッシュに保存する形式（encode_transit_info）のバージョン
+GV_SHARED_CACHE_VERSION = 1
+
+# -- 検索結果ページの解析方法: 'fast'(必要な項目だけを逐次抽出), 'lxml', 'bs4'(BeautifulSoup)
+# -- 'fast', 'lxml' で解析できなかった場合は 'bs4' で解析し直す
+GV_PARSER = os.environ.get('parser', 'fast')
+# -- 'fast' の場合、検索結果ページを受信しながら解析し、必要な項目がそろった時点で受信を打ち切る
+# -- 環境変数 stream=0 で無効にする。1回に読み込むバイト数と、打ち切る際に残りがこれ以下なら読み切って接続を使い回す
+GV_STREAM = os.environ.get('stream', '1') == '1'
+GV_STREAM_CHUNK_SIZE = 4096
+GV_STREAM_DRAIN_BYTES = 16 * 1024
+
+# -- 検索結果ページから抽出するルートの最大数（料金、乗り換え回数で並べ替える候補）
+GV_MAX_ROUTES = 3
+# -- セッションに保持するルートの項目
+GV_ROUTE_KEYS = ['distance', 'fare', 'transfer', 'transport', 'startTime', 'arrivalTime']
+
+# -- 始発、終電の検索結果キャッシュ: 同じ駅、同じ曜日の種類（平日、土曜、休日）の結果は、ダイヤ改正まで変わらない
+# -- 有効期限（秒）と、ダイヤ改正時に変更してキャッシュを無効にするバージョン
+GV_TIMETABLE_TTL = int(os.environ.get('timetable_ttl', 7 * 24 * 60 * 60))
+GV_TIMETABLE_VERSION = os.environ.get('timetable_version', '1')
+GV_TIMETABLE_MAX_ENTRIES = 1024
+# -- 祝日: get_japanese_holidays で計算できる年の範囲（2007年以降の祝日法、2099年までの春分、秋分の近似式）
+GV_HOLIDAY_YEARS = range(2007, 2100)
+# -- 一度だけ設けられた祝日と、年毎に移した祝日 { 年: (追加する日, 除く日) }
+GV_SPECIAL_HOLIDAYS = {
+    2019: (['04-30', '05-01', '05-02', '10-22'], []),
+    2020: (['07-23', '07-24', '08-10'], ['07-20', '08-11', '10-12']),
+    2021: (['07-22', '07-23', '08-08'], ['07-19', '08-11', '10-11']),
+}
+# -- 祝日以外に休日の時刻表で運転する日（年末年始）
+GV_YEAR_END_HOLIDAYS = frozenset(['01-02', '01-03', '12-30', '12-31'])
+
+# -- 前後の電車の先読み: 応答を待たせずに前後の電車をバックグラウンドで検索し、検索結果キャッシュに保存する
+# -- 環境変数 prefetch=1 で有効にする。先読みした結果を保持する時間（秒）と、同時に検索する数
+GV_PREFETCH = os.environ.get('prefetch', '0') == '1'
+GV_PREFETCH_TTL = 10 * 60
+GV_PREFETCH_WORKERS = 2
+
+# -- インテントの処理の検索、前後の電車の検索に yahoo_transit_async（ヘッジリクエスト）を使う
+# -- 環境変数 async_client=1 で有効にする
+GV_ASYNC_CLIENT = os.environ.get('async_client', '0') == '1'
+
+# -- 利用者毎の通勤プロファイル: 検索した駅、時刻を userId 毎に記録し、「いつもの」で同じ条件を検索する
+# -- '': 使用しない, 'sqlite': commute_profile_path のSQLiteファイル
+GV_COMMUTE_PROFILE_BACKEND = os.environ.get('commute_profile', '')
+# -- パターンを求めるのに使う検索の期間（日）、同じ時間帯とみなす検索した時刻の間隔（分）、パターンとみなす最少の日数
+GV_COMMUTE_HISTORY_DAYS = 56
+GV_COMMUTE_SLOT_MINUTES = 30
+GV_COMMUTE_MIN_DAYS = 2
+# -- 事前検索: いつも検索する時刻のこの分数前から検索し、キャッシュに保存しておく。同時に検索する数
+GV_COMMUTE_LEAD_MINUTES = int(os.environ.get('commute_lead_minutes', 15))
+GV_COMMUTE_WARM_WORKERS = 4
+# -- 予測の的中率を集計する期間（日）
+GV_COMMUTE_STATS_DAYS = 7
+
+# -- セッション情報の形式（encode_session_state）のバージョンと、形式を変換する項目
+GV_SESSION_STATE_VERSION = 1
+GV_SESSION_STATE_KEYS = ['stationFrom', 'stationTo', 'url', 'searchDateTime', 'searchType', 'searchResult',
+                         'prevUrl', 'nextUrl', 'position', 'order', 'routes', 'history'] + GV_ROUTE_KEYS
+
+# -- 前後の電車の検索結果をセッションに保持する件数
+GV_HISTORY_SIZE = 6
+# -- セッションに保持する検索結果の項目
+GV_HISTORY_KEYS = ['url', 'distance', 'fare', 'transfer', 'transport', 'startTime', 'arrivalTime',
+                   'prevUrl', 'nextUrl']
 
 # -- Alexaメッセージ
 GV_MSG_PROMPT1 = 'Yahoo路線を使ってルート案内します。出発駅と到着駅を教えてください。'
@@ -53,249 +226,3487 @@ GV_MSG_PROMPT_LAST = '前後の電車を検索する場合は、前の電車、
                      '検索条件を変更する場合は、出発駅と到着駅、または、日時を言ってください。'
 GV_MSG_EXIT = 'ハバッナイスデーイ！'
 GV_MSG_ERROR = '確認できませんでした。再度お試しください。'
+GV_MSG_STALE = '少し前に検索した結果です。'
+GV_MSG_NO_USUAL = 'いつもの検索条件がまだありません。' + GV_MSG_PROMPT1
+# -- 路線情報の応答メッセージ（発車時刻、出発駅、路線名、到着時刻、到着駅、料金、乗り換え）
+GV_MSG_ROUTE = '%sに%sを発車する、%sに乗車すると、%sに%sに到着します。料金は%sで、%s'
+GV_MSG_TRANSFER = '%s回の乗り換えがあります。'
+GV_MSG_NO_TRANSFER = '乗り換えはありません。'
 GV_MSG_ERROR_EXIT = '問題が発生しました。もう一度はじめからやり直してください。'
 
 
-# --------------- Helpers that build all of the responses ----------------------
+# -- JST
+GV_TZ_JST = timezone(timedelta(hours=+9), 'JST')
 
-def build_speechlet_response(title, output, reprompt_text, should_end_session):
-    return {
-        'outputSpeech': {
-            'type': 'PlainText',
-            'text': output
-        },
-        'card': {
-            'type': 'Simple',
-            'title': "SessionSpeechlet - " + title,
-            'content': "SessionSpeechlet - " + output
-        },
-        'reprompt': {
-            'outputSpeech': {
-                'type': 'PlainText',
-                'text': reprompt_text
-            }
-        },
-        'shouldEndSession': should_end_session
-    }
+# -- 日時の解析
+# -- ISO-8601期間形式（PnYnMnWnDTnHnMnS）
+GV_DURATION_PATTERN = re.compile(
+    r'^P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d+)?)S)?)?$')
+# -- Alexaの日付（AMAZON.DATE）: 2018-06-01, 2018-06, 2018, 2018-W22, 2018-W22-WE, XXXX-06-01, XXXX-WXX など
+GV_DATE_PATTERN = re.compile(r'^(\d{4}|XXXX)(?:-(\d{2})(?:-(\d{2}))?|-W(\d{2}|XX)(-WE)?)?$')
+# -- Alexaの時刻（AMAZON.TIME）のうち、時間帯を表す値と検索する時刻
+GV_TIME_PERIODS = {
+    'MO': (8, 0),
+    'AF': (13, 0),
+    'EV': (18, 0),
+    'NI': (21, 0),
+}
 
 
-def build_response(session_attributes, speechlet_response):
-    return {
-        'version': '1.0',
-        'sessionAttributes': session_attributes,
-        'response': speechlet_response
-    }
+# --------------- Date/time resolution ----------------------
+
+def to_search_datetime(search_date_time):
+    """yyyy-mm-dd HH:MM形式の日時文字列を、JSTの datetime に変換する。datetime の場合はそのまま返す。
+
+    Parameters
+    ----------
+    search_date_time : str or datetime
+        検索日時。
+
+    Returns
+    -------
+    search_dt : datetime
+        JSTの日時。
+
+    Raises
+    ------
+    ValueError
+        形式が正しくない場合。
+    """
+    if isinstance(search_date_time, datetime):
+        return search_date_time
+    if len(search_date_time) != 16 or search_date_time[4] != '-' or search_date_time[13] != ':':
+        raise ValueError('Invalid search date time: ' + repr(search_date_time))
+    return datetime(int(search_date_time[0:4]), int(search_date_time[5:7]), int(search_date_time[8:10]),
+                    int(search_date_time[11:13]), int(search_date_time[14:16]), tzinfo=GV_TZ_JST)
+
+
+def format_search_datetime(search_dt):
+    """検索日時を、セッションに保存するyyyy-mm-dd HH:MM形式の文字列にする。"""
+    if isinstance(search_dt, str):
+        return search_dt
+    return '%04d-%02d-%02d %02d:%02d' % (search_dt.year, search_dt.month, search_dt.day,
+                                         search_dt.hour, search_dt.minute)
+
+
+def add_months(dt, months):
+    """dt の months か月後の日時を返す。月末を超える日は、その月の末日にする。"""
+    month = dt.month - 1 + months
+    year, month = dt.year + month // 12, month % 12 + 1
+    next_month = datetime(year + month // 12, month % 12 + 1, 1)
+    return dt.replace(year=year, month=month, day=min(dt.day, (next_month - timedelta(days=1)).day))
+
+
+def add_duration(dt, duration):
+    """dt に ISO-8601期間形式の期間を加えた日時を返す。
+
+    Parameters
+    ----------
+    dt : datetime
+        基準の日時。
+    duration : str
+        ISO-8601期間形式(PnYnMnWnDTnHnMnS)の期間。
+
+    Returns
+    -------
+    added : datetime
+        期間が経過した後の日時。
+
+    Raises
+    ------
+    ValueError
+        期間の形式が正しくない場合。
+    """
+    match = GV_DURATION_PATTERN.match(duration or '')
+    if match is None or duration in ('P', 'PT') or duration.endswith('T'):
+        raise ValueError('Invalid duration: ' + repr(duration))
+    years, months, weeks, days, hours, minutes, seconds = match.groups()
+    if years or months:
+        dt = add_months(dt, int(years or 0) * 12 + int(months or 0))
+    return dt + timedelta(weeks=int(weeks or 0), days=int(days or 0), hours=int(hours or 0),
+                          minutes=int(minutes or 0), seconds=float(seconds or 0))
+
+
+def resolve_date(value, now):
+    """Alexaの日付（AMAZON.DATE）を、検索する日付にする。
+    週、週末、月、年のように幅がある場合は、その最初の日（現在を含む場合は今日）にする。
+    年が XXXX の場合は、今日以降で最も近い日にする。
+
+    Parameters
+    ----------
+    value : str
+        2018-06-01, 2018-06, 2018, 2018-W22, 2018-W22-WE, XXXX-06-01, XXXX-WXX など。
+    now : datetime
+        現在日時（JST）。
+
+    Returns
+    -------
+    search_date : date
+        検索する日付。
+
+    Raises
+    ------
+    ValueError
+        解釈できない日付（季節、年代など）の場合。
+    """
+    today = now.date()
+    # 日付が指定された場合（ほとんどの発話）は、正規表現を使わない
+    if len(value) == 10 and value[4] == '-' and value[7] == '-' and value[0] != 'X':
+        return today.replace(year=int(value[0:4]), month=int(value[5:7]), day=int(value[8:10]))
+
+    match = GV_DATE_PATTERN.match(value or '')
+    if match is None:
+        raise ValueError('Unsupported date: ' + repr(value))
+    year, month, day, week, weekend = match.groups()
+
+    if week is not None:
+        iso_year = today.isocalendar()[0] if year == 'XXXX' else int(year)
+        iso_week = today.isocalendar()[1] if week == 'XX' else int(week)
+        start = datetime.strptime('%04d-W%02d-1' % (iso_year, iso_week), '%G-W%V-%u').date()
+        if weekend:
+            start += timedelta(days=5)
+        end = start + timedelta(days=2 if weekend else 7)
+        return today if start <= today < end else start
+
+    if year == 'XXXX':
+        if month is None:
+            return today
+        candidate = today.replace(month=int(month), day=int(day or 1))
+        if candidate < today and (day is not None or candidate.month != today.month):
+            candidate = candidate.replace(year=today.year + 1)
+        return max(candidate, today) if day is None else candidate
+
+    if month is None:
+        start = today.replace(year=int(year), month=1, day=1)
+        return today if start.year == today.year else start
+    if day is None:
+        start = today.replace(year=int(year), month=int(month), day=1)
+        return today if (start.year, start.month) == (today.year, today.month) else start
+    return today.replace(year=int(year), month=int(month), day=int(day))
+
+
+def resolve_time(value):
+    """Alexaの時刻（AMAZON.TIME: HH:MM、または MO, AF, EV, NI）を (時, 分) にする。"""
+    if value in GV_TIME_PERIODS:
+        return GV_TIME_PERIODS[value]
+    if len(value or '') < 5 or value[2] != ':':
+        raise ValueError('Unsupported time: ' + repr(value))
+    return int(value[0:2]), int(value[3:5])
+
+
+def resolve_search_datetime(slots, now=None):
+    """SetDateTime インテントのスロット（Date, Time, Duration）から、検索日時を求める。
+
+    Parameters
+    ----------
+    slots : dict
+        インテントのスロット。
+    now : datetime, default None
+        現在日時（JST）。None の場合は現在日時。
+
+    Returns
+    -------
+    search_dt : datetime
+        JSTの検索日時（分単位）。
+
+    Raises
+    ------
+    ValueError
+        日時を解釈できない場合。
+    """
+    now = now or datetime.now(GV_TZ_JST)
+    date_value = slots.get('Date', {}).get('value')
+    time_value = slots.get('Time', {}).get('value')
+    duration = slots.get('Duration', {}).get('value')
+
+    # 例）30分後に出発
+    if date_value is None and duration is not None:
+        return add_duration(now, duration).replace(second=0, microsecond=0)
+
+    # 例）2018-06-01 の 23:59 に到着、2018-06-01 の始発、8時45分に到着（今日）
+    search_date = resolve_date(date_value, now) if date_value is not None else now.date()
+    hour, minute = resolve_time(time_value) if time_value is not None else (0, 0)
+    if date_value is None and time_value is None:
+        raise ValueError('No date, time or duration')
+    return datetime(search_date.year, search_date.month, search_date.day, hour, minute, tzinfo=GV_TZ_JST)
+
+
+def speak_search_datetime(search_dt, search_type):
+    """検索条件を確認するメッセージの、日時とタイプの部分を生成する。
+
+    Returns
+    -------
+    text : str
+        例）2018年06月01日 08時45分、に到着、2018年06月01日 の、始発
+    """
+    text = format_search_datetime(search_dt)
+    date_text = text[0:4] + '年' + text[5:7] + '月' + text[8:10] + '日 '
+    if search_type == '始発' or search_type == '終電':
+        return date_text + 'の、' + search_type
+    return date_text + text[11:13] + '時' + text[14:16] + '分、に' + search_type
+
+
+# --------------- Result cache ----------------------
+
+# -- { key: (有効期限(epoch秒), 路線情報) } の LRU
+GV_RESULT_CACHE = OrderedDict()
+# -- コンテナ間で共有するキャッシュ（get(key), set(key, value, ttl) を持つオブジェクト）
+GV_SHARED_CACHE = None
+GV_CACHE_STATS = {'hit': 0, 'sharedHit': 0, 'stale': 0, 'miss': 0, 'coalesced': 0}
+# -- 先読み、一括検索のスレッドからも参照するため、ローカルのキャッシュと GV_CACHE_STATS はロックして操作する
+GV_CACHE_LOCK = threading.Lock()
+
+
+def set_shared_cache(backend):
+    """コンテナ間で共有するキャッシュのバックエンドを設定する。
+
+    Parameters
+    ----------
+    backend : object
+        get(key) -> dict or None, set(key, value, ttl) を実装したオブジェクト（SharedResultStore など）。
+        get_many(keys), add(key, ttl), delete(key) も実装している場合は、一括取得、コンテナ間での検索の集約に使う。
+        None を指定すると共有キャッシュを使用しない。
+    """
+    global GV_SHARED_CACHE
+    GV_SHARED_CACHE = backend
+
+
+def count_cache_stats(name, count=1):
+    """GV_CACHE_STATS の name に count を加える。先読み、一括検索、yahoo_transit_server のスレッドから
+    同時に呼び出されるため、GV_CACHE_LOCK を取得して加える。
+    """
+    with GV_CACHE_LOCK:
+        GV_CACHE_STATS[name] += count
+
+
+def make_cache_key(station_from, station_to, search_date_time, search_type, walk_speed=GV_WALK_SPEED):
+    """検索条件からキャッシュのキーを生成する。
+    始発、終電は日付のみ、それ以外は時刻を GV_CACHE_BUCKET_MINUTES 分単位に切り捨てる。
+
+    Parameters
+    ----------
+    station_from : str
+        出発駅。
+    station_to : str
+        到着駅。
+    search_date_time : str or datetime
+        yyyy-mm-dd HH:MM形式の日時文字列、またはJSTの日時。
+    search_type : str
+        '出発', '到着', '始発', '終電'
+    walk_speed : int, default GV_WALK_SPEED
+        歩く速度（1, 2, 3, 4）。
+
+    Returns
+    -------
+    key : str
+        キャッシュのキー。
+    """
+    text = format_search_datetime(search_date_time)
+    if search_type == '始発' or search_type == '終電':
+        search_time = ''
+    else:
+        minutes = int(text[11:13]) * 60 + int(text[14:16])
+        minutes -= minutes % max(GV_CACHE_BUCKET_MINUTES, 1)
+        search_time = '%02d:%02d' % divmod(minutes, 60)
+    return '|'.join([station_from, station_to, text[:10], search_time, search_type, str(walk_speed)])
+
+
+def cache_ttl(search_date_time):
+    """検索日時に応じたキャッシュの有効期限（秒）を返す。
+    検索日時が現在に近いほど短く、離れているほど長くする。
+
+    Parameters
+    ----------
+    search_date_time : str or datetime
+        yyyy-mm-dd HH:MM形式の日時文字列、またはJSTの日時。
+
+    Returns
+    -------
+    ttl : int
+        有効期限（秒）。
+    """
+    try:
+        search_dt = to_search_datetime(search_date_time)
+    except ValueError:
+        return GV_CACHE_TTL_MIN
+    distance = abs((search_dt - datetime.now(GV_TZ_JST)).total_seconds())
+    return int(min(max(distance / GV_CACHE_TTL_RATIO, GV_CACHE_TTL_MIN), GV_CACHE_TTL_MAX))
+
+
+def cache_get(key):
+    """キャッシュから路線情報を取り出す。ローカル（LRU）、共有キャッシュの順に参照する。
+
+    Parameters
+    ----------
+    key : str
+        キャッシュのキー。
+
+    Returns
+    -------
+    transit_info : dict
+        路線情報（のコピー）。見つからない場合は None。
+    """
+    with GV_CACHE_LOCK:
+        entry = GV_RESULT_CACHE.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.time():
+                GV_RESULT_CACHE.move_to_end(key)
+                GV_CACHE_STATS['hit'] += 1
+                return dict(value)
+            # 古い結果は、cache_get_stale で使うため GV_CACHE_STALE_TTL の間は残す
+            if expires + GV_CACHE_STALE_TTL <= time.time():
+                del GV_RESULT_CACHE[key]
+
+    if GV_SHARED_CACHE is not None:
+        try:
+            value = GV_SHARED_CACHE.get(key)
+        except Exception as e:
+            print('[WARN] Shared cache get failed: ' + repr(e))
+            value = None
+        if value is not None:
+            count_cache_stats('sharedHit')
+            _cache_put_local(key, value, GV_CACHE_TTL_MIN)
+            return dict(value)
+
+    count_cache_stats('miss')
+    return None
+
+
+def cache_get_stale(key):
+    """有効期限が切れてから GV_CACHE_STALE_TTL 秒以内の路線情報を、ローカルのキャッシュから取り出す。
+
+    Parameters
+    ----------
+    key : str
+        キャッシュのキー。
+
+    Returns
+    -------
+    transit_info : dict
+        路線情報（のコピー）。stale に True を設定する。見つからない場合は None。
+    """
+    with GV_CACHE_LOCK:
+        entry = GV_RESULT_CACHE.get(key)
+    if entry is None or entry[0] + GV_CACHE_STALE_TTL <= time.time():
+        return None
+    transit_info = dict(entry[1])
+    transit_info['stale'] = True
+    return transit_info
+
+
+def cache_set(key, transit_info, ttl):
+    """路線情報をキャッシュ（ローカル、共有キャッシュ）に保存する。
+
+    Parameters
+    ----------
+    key : str
+        キャッシュのキー。
+    transit_info : dict
+        路線情報。
+    ttl : int
+        有効期限（秒）。
+    """
+    _cache_put_local(key, transit_info, ttl)
+    if GV_SHARED_CACHE is not None:
+        try:
+            GV_SHARED_CACHE.set(key, dict(transit_info), ttl)
+        except Exception as e:
+            print('[WARN] Shared cache set failed: ' + repr(e))
+
+
+def _cache_put_local(key, transit_info, ttl):
+    with GV_CACHE_LOCK:
+        GV_RESULT_CACHE[key] = (time.time() + ttl, dict(transit_info))
+        GV_RESULT_CACHE.move_to_end(key)
+        while len(GV_RESULT_CACHE) > GV_CACHE_MAX_ENTRIES:
+            GV_RESULT_CACHE.popitem(last=False)
+
+
+def cache_get_many(keys):
+    """複数のキーの路線情報をまとめて取り出す。ローカルにないものは、共有キャッシュから一括で取り出す。
+
+    Parameters
+    ----------
+    keys : list of str
+        キャッシュのキー。
+
+    Returns
+    -------
+    result : dict
+        { キー: 路線情報（のコピー） }。見つからないキーは含まない。
+    """
+    result = {}
+    now = time.time()
+    with GV_CACHE_LOCK:
+        for key in keys:
+            entry = GV_RESULT_CACHE.get(key)
+            if entry is not None and entry[0] > now:
+                GV_RESULT_CACHE.move_to_end(key)
+                result[key] = dict(entry[1])
+        GV_CACHE_STATS['hit'] += len(result)
+
+    missing = [key for key in keys if key not in result]
+    if missing and GV_SHARED_CACHE is not None:
+        try:
+            if hasattr(GV_SHARED_CACHE, 'get_many'):
+                found = GV_SHARED_CACHE.get_many(missing)
+            else:
+                found = dict((key, GV_SHARED_CACHE.get(key)) for key in missing)
+        except Exception as e:
+            print('[WARN] Shared cache get failed: ' + repr(e))
+            found = {}
+        for key, value in found.items():
+            if value is not None:
+                count_cache_stats('sharedHit')
+                _cache_put_local(key, value, GV_CACHE_TTL_MIN)
+                result[key] = dict(value)
+    count_cache_stats('miss', len(keys) - len(result))
+    return result
+
+
+def get_cache_stats():
+    """キャッシュのヒット/ミス回数を返す。
+
+    Returns
+    -------
+    stats : dict
+        hit（ローカル）, sharedHit（共有キャッシュ）, stale（古い結果で応答）, miss,
+        coalesced（検索中の同じ条件の結果を待った）, size（ローカルの件数）。
+    """
+    with GV_CACHE_LOCK:
+        stats = dict(GV_CACHE_STATS)
+        stats['size'] = len(GV_RESULT_CACHE)
+    return stats
+
+
+# --------------- Shared result store ----------------------
+
+# -- 路線情報のうち、最初のルート（Route.to_dict）と同じ項目
+GV_ROUTE_DICT_KEYS = GV_ROUTE_KEYS + ['legs', 'times']
+
+
+def encode_transit_info(transit_info):
+    """路線情報を、共有キャッシュに保存するバイト列に変換する。
+    ルートは Route.to_record の値のタプルにし、最初のルートと同じ項目は省いて、marshal と zlib で圧縮する。
+    marshal の形式は同じバージョンのPython間でのみ互換性があるため、同じランタイムのコンテナ間で共有する。
+
+    Parameters
+    ----------
+    transit_info : dict
+        路線情報。
+
+    Returns
+    -------
+    data : bytes
+        変換したバイト列。
+    """
+    routes = transit_info.get('routes') or []
+    first = routes[0].to_dict() if routes else {}
+    values = dict((key, value) for key, value in transit_info.items()
+                  if key != 'routes' and key != 'stale' and not (key in first and first[key] == value))
+    return zlib.compress(marshal.dumps((GV_SHARED_CACHE_VERSION, values, [route.to_record() for route in routes])))
+
+
+def decode_transit_info(data):
+    """encode_transit_info で変換したバイト列を、路線情報に戻す。形式が異なる場合は None を返す。"""
+    try:
+        version, values, records = marshal.loads(zlib.decompress(data))
+    except (ValueError, TypeError, EOFError, zlib.error):
+        return None
+    if version != GV_SHARED_CACHE_VERSION:
+        return None
+    routes = [Route.from_record(record) for record in records]
+    transit_info = routes[0].to_dict() if routes else {}
+    transit_info.update(values)
+    if routes:
+        transit_info['routes'] = routes
+    return transit_info
+
+
+class SharedResultStore(object):
+    """コンテナ間で共有する検索結果キャッシュの基底クラス。
+    路線情報は encode_transit_info で変換して保存する。サブクラスは、バイト列を読み書きする
+    get_bytes_many(keys), set_bytes_many(items) と、検索中の印を付ける add(key, ttl), delete(key) を実装する。
+    """
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def set(self, key, value, ttl):
+        self.set_many({key: (value, ttl)})
+
+    def get_many(self, keys):
+        """{ キー: 路線情報 } を返す。見つからないキーは含まない。"""
+        result = {}
+        for key, data in self.get_bytes_many(list(OrderedDict.fromkeys(keys))).items():
+            value = decode_transit_info(data)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def set_many(self, items):
+        """items: { キー: (路線情報, 有効期限（秒）) } をまとめて保存する。"""
+        self.set_bytes_many(dict((key, (encode_transit_info(value), ttl)) for key, (value, ttl) in items.items()))
+
+
+class RedisResultStore(SharedResultStore):
+    """Redis（ElastiCache など）を使った共有キャッシュ。"""
+
+    def __init__(self, url):
+        self.url = url
+        self.client = None
+
+    def _get_client(self):
+        if self.client is None:
+            import redis
+            self.client = redis.Redis.from_url(self.url, socket_timeout=GV_HTTP_CONNECT_TIMEOUT)
+        return self.client
+
+    def get_bytes_many(self, keys):
+        return dict((key, data) for key, data in zip(keys, self._get_client().mget(keys)) if data is not None)
+
+    def set_bytes_many(self, items):
+        pipeline = self._get_client().pipeline(transaction=False)
+        for key, (data, ttl) in items.items():
+            pipeline.set(key, data, ex=max(int(ttl), 1))
+        pipeline.execute()
+
+    def add(self, key, ttl):
+        return bool(self._get_client().set(key, b'', nx=True, px=max(int(ttl * 1000), 1)))
+
+    def delete(self, key):
+        self._get_client().delete(key)
+
+
+class DynamoDbResultStore(SharedResultStore):
+    """Amazon DynamoDB を使った共有キャッシュ。
+    テーブルのパーティションキーは key（文字列）で、expires（epoch秒）をTTLの属性に設定する。
+    TTLによる削除は遅れるため、読み込み時にも有効期限を確認する。
+    """
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.client = None
+
+    def _get_client(self):
+        if self.client is None:
+            import boto3
+            self.client = boto3.client('dynamodb')
+        return self.client
+
+    def get_bytes_many(self, keys):
+        result = {}
+        now = time.time()
+        # -- BatchGetItem は1回に100件まで
+        for i in range(0, len(keys), 100):
+            request = {self.table_name: {'Keys': [{'key': {'S': key}} for key in keys[i:i + 100]]}}
+            while request:
+                res = self._get_client().batch_get_item(RequestItems=request)
+                for item in res['Responses'].get(self.table_name, []):
+                    if float(item['expires']['N']) > now:
+                        result[item['key']['S']] = item['value']['B']
+                request = res.get('UnprocessedKeys')
+        return result
+
+    def set_bytes_many(self, items):
+        now = time.time()
+        put_requests = [{'PutRequest': {'Item': {'key': {'S': key}, 'value': {'B': data},
+                                                 'expires': {'N': str(int(now + ttl))}}}}
+                        for key, (data, ttl) in items.items()]
+        # -- BatchWriteItem は1回に25件まで
+        for i in range(0, len(put_requests), 25):
+            request = {self.table_name: put_requests[i:i + 25]}
+            while request:
+                request = self._get_client().batch_write_item(RequestItems=request).get('UnprocessedItems')
+
+    def add(self, key, ttl):
+        client = self._get_client()
+        now = time.time()
+        try:
+            client.put_item(TableName=self.table_name,
+                            Item={'key': {'S': key}, 'value': {'B': b''}, 'expires': {'N': str(now + ttl)}},
+                            ConditionExpression='attribute_not_exists(#k) OR #e < :now',
+                            ExpressionAttributeNames={'#k': 'key', '#e': 'expires'},
+                            ExpressionAttributeValues={':now': {'N': str(now)}})
+        except client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def delete(self, key):
+        self._get_client().delete_item(TableName=self.table_name, Key={'key': {'S': key}})
+
+
+class SqliteResultStore(SharedResultStore):
+    """SQLiteのファイルを使った共有キャッシュ。同じファイルを使う複数のプロセスを、
+    複数のコンテナに見立ててローカルで確認するために使う。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def _get_connection(self):
+        if self.connection is None:
+            import sqlite3
+            connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+            self.connection = connection
+        return self.connection
+
+    def get_bytes_many(self, keys):
+        result = {}
+        now = time.time()
+        with self.lock:
+            connection = self._get_connection()
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = connection.execute(
+                    'SELECT key, value FROM results WHERE key IN (%s) AND expires > ?' % ','.join('?' * len(chunk)),
+                    chunk + [now])
+                result.update((key, bytes(value)) for key, value in rows)
+        return result
+
+    def set_bytes_many(self, items):
+        now = time.time()
+        with self.lock:
+            connection = self._get_connection()
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                                   [(key, data, now + ttl) for key, (data, ttl) in items.items()])
+            connection.execute('COMMIT')
+
+    def add(self, key, ttl):
+        now = time.time()
+        with self.lock:
+            connection = self._get_connection()
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DELETE FROM results WHERE key = ? AND expires <= ?', (key, now))
+            added = connection.execute('INSERT OR IGNORE INTO results VALUES (?, ?, ?)',
+                                       (key, b'', now + ttl)).rowcount == 1
+            connection.execute('COMMIT')
+        return added
+
+    def delete(self, key):
+        with self.lock:
+            self._get_connection().execute('DELETE FROM results WHERE key = ?', (key,))
+
+
+def make_shared_cache(backend):
+    """GV_SHARED_CACHE_BACKEND で指定した共有キャッシュを作成する。接続は最初に使う時に行う。"""
+    if backend == 'redis':
+        return RedisResultStore(os.environ['shared_cache_url'])
+    if backend == 'dynamodb':
+        return DynamoDbResultStore(os.environ['shared_cache_table'])
+    if backend == 'sqlite':
+        return SqliteResultStore(os.environ.get('shared_cache_path', '/tmp/yahoo_transit_cache.sqlite3'))
+    raise ValueError('Unknown shared cache: ' + repr(backend))
+
+
+if GV_SHARED_CACHE_BACKEND:
+    set_shared_cache(make_shared_cache(GV_SHARED_CACHE_BACKEND))
+
+
+# --------------- Station index ----------------------
+
+# -- 駅名索引のファイル（mmap）。開けなかった場合は False
+GV_STATION_INDEX_MAP = None
+# -- { 発話された駅名: 正式な駅名 }（LRU）
+GV_STATION_CACHE = OrderedDict()
+GV_KATAKANA_TO_HIRAGANA = dict((code, code - 0x60) for code in range(ord('ァ'), ord('ヶ') + 1))
+
+
+def normalize_station_name(name):
+    """駅名の表記ゆれを吸収するため、駅名を正規化する。
+    全角/半角の統一、空白と末尾の「駅」の除去、カタカナをひらがなに変換する。
+
+    Parameters
+    ----------
+    name : str
+        駅名。
+
+    Returns
+    -------
+    normalized : str
+        正規化した駅名。
+    """
+    normalized = unicodedata.normalize('NFKC', name).lower()
+    normalized = re.sub(r'\s+', '', normalized).translate(GV_KATAKANA_TO_HIRAGANA)
+    return re.sub('(駅|えき)$', '', normalized) or normalized
+
+
+def _open_station_index():
+    global GV_STATION_INDEX_MAP
+    if GV_STATION_INDEX_MAP is None:
+        try:
+            with open(GV_STATION_INDEX, 'rb') as f:
+                GV_STATION_INDEX_MAP = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e:
+            print('[WARN] Station index is not available: ' + repr(e))
+            GV_STATION_INDEX_MAP = False
+    return GV_STATION_INDEX_MAP
+
+
+def _station_index_line(index, position):
+    """索引の position を含む行の (キー, 駅名, 次の行の先頭) を返す。"""
+    start = index.rfind(b'\n', 0, position) + 1
+    end = index.find(b'\n', start)
+    if end < 0:
+        end = len(index)
+    key, _, canonical = index[start:end].partition(b'\t')
+    return key, canonical, end + 1, start
+
+
+def _station_index_lower_bound(index, key):
+    """索引（キーの昇順）で、キーが key 以上となる最初の行の先頭位置を二分探索で返す。"""
+    low, high = 0, len(index)
+    while low < high:
+        line_key, _, next_start, start = _station_index_line(index, (low + high) // 2)
+        if line_key < key:
+            low = next_start
+        else:
+            high = start
+    return low
+
+
+def _station_index_prefix(index, prefix, limit=200):
+    """索引から、キーが prefix で始まる行を最大 limit 件返す。"""
+    position = _station_index_lower_bound(index, prefix)
+    entries = []
+    while position < len(index) and len(entries) < limit:
+        line_key, canonical, position, _ = _station_index_line(index, position)
+        if not line_key.startswith(prefix):
+            break
+        entries.append((line_key.decode('utf-8'), canonical.decode('utf-8')))
+    return entries
+
+
+def resolve_station_name(name):
+    """発話された駅名を、駅名索引で正式な駅名に変換する。
+    正規化した駅名（読み、別名を含む）が完全に一致するものだけを変換する。似た駅名は suggest_station_name で探す。
+
+    Parameters
+    ----------
+    name : str
+        発話された駅名。
+
+    Returns
+    -------
+    canonical : str
+        正式な駅名。索引にない場合は None、索引がない場合は name をそのまま返す。
+    """
+    with GV_CACHE_LOCK:
+        if name in GV_STATION_CACHE:
+            GV_STATION_CACHE.move_to_end(name)
+            return GV_STATION_CACHE[name]
+    index = _open_station_index()
+    if not index:
+        return name
+
+    key = normalize_station_name(name)
+    canonical = None
+    if key:
+        encoded = key.encode('utf-8')
+        line_key, line_canonical, _, _ = _station_index_line(index, _station_index_lower_bound(index, encoded))
+        if line_key == encoded:
+            canonical = line_canonical.decode('utf-8')
+
+    with GV_CACHE_LOCK:
+        GV_STATION_CACHE[name] = canonical
+        GV_STATION_CACHE.move_to_end(name)
+        while len(GV_STATION_CACHE) > GV_STATION_CACHE_MAX_ENTRIES:
+            GV_STATION_CACHE.popitem(last=False)
+    return canonical
+
+
+def suggest_station_name(name):
+    """索引にない駅名に似た駅名を探す（聞き返す際に提案する）。
+    先頭の文字と長さが同じ駅名から、類似度が GV_STATION_FUZZY_CUTOFF 以上のものを探す。
+
+    Parameters
+    ----------
+    name : str
+        発話された駅名。
+
+    Returns
+    -------
+    canonical : str
+        似た駅名の正式な駅名。見つからない場合、索引がない場合は None。
+    """
+    index = _open_station_index()
+    key = normalize_station_name(name)
+    if not index or not key:
+        return None
+    candidates = dict((line_key, canonical) for line_key, canonical
+                      in _station_index_prefix(index, key[0].encode('utf-8')) if len(line_key) == len(key))
+    matches = difflib.get_close_matches(key, list(candidates), n=1, cutoff=GV_STATION_FUZZY_CUTOFF)
+    return candidates[matches[0]] if matches else None
+
+
+# --------------- Secrets ----------------------
+
+def get_ifttt_webhook_key():
+    """IFTTTのWebhooksキーを取得する。以下の順に環境変数を参照する。
+
+    - ifttt_webhook_key_plaintext : 平文のキー（テスト用）
+    - ifttt_webhook_key_file : 平文のキーを書いたファイルのパス（テスト用）
+    - ifttt_webhook_key : KMSで暗号化したキー（Base64）
+
+    Returns
+    -------
+    key : str
+        Webhooksキー。
+
+    Raises
+    ------
+    KeyError
+        いずれの環境変数も設定されていない場合。
+    """
+    if os.environ.get('ifttt_webhook_key_plaintext'):
+        return os.environ['ifttt_webhook_key_plaintext']
+    if os.environ.get('ifttt_webhook_key_file'):
+        with open(os.environ['ifttt_webhook_key_file'], encoding='utf-8') as f:
+            return f.read().strip()
+
+    # -- Use KMS to encrypt IFTTT webhook key
+    import boto3
+    encrypted = os.environ['ifttt_webhook_key']
+    return boto3.client('kms').decrypt(CiphertextBlob=b64decode(encrypted))['Plaintext'].decode('utf-8')
+
+
+def get_ifttt_url():
+    """IFTTTのWebhookのURLを返す。
+    Webhooksキーの復号は最初の1回だけ行い、コンテナが再利用される間は結果を保持する。
+
+    Returns
+    -------
+    url : str
+        WebhookのURL。
+    """
+    global GV_IFTTT_URL
+    if GV_IFTTT_URL is None:
+        GV_IFTTT_URL = GV_IFTTT_BASE_URL + '/trigger/yahoo_transit/with/key/' + get_ifttt_webhook_key()
+    return GV_IFTTT_URL
+
+
+# --------------- First/last train cache ----------------------
+
+# -- { key: (有効期限(epoch秒), 路線情報) }
+GV_TIMETABLE_CACHE = OrderedDict()
+GV_TIMETABLE_STATS = {'hit': 0, 'miss': 0}
+
+
+# -- { 年: 祝日（mm-dd）の集合 }（get_japanese_holidays）
+GV_HOLIDAYS = {}
+
+
+def get_japanese_holidays(year):
+    """国民の祝日（振替休日、国民の休日を含む）を計算する。
+
+    Parameters
+    ----------
+    year : int
+        年（GV_HOLIDAY_YEARS の範囲）。
+
+    Returns
+    -------
+    holidays : frozenset of str
+        祝日の mm-dd。
+    """
+    holidays = GV_HOLIDAYS.get(year)
+    if holidays is not None:
+        return holidays
+
+    def monday(month, week):
+        # month 月の第 week 月曜日（ハッピーマンデー）
+        first = datetime(year, month, 1).weekday()
+        return '%02d-%02d' % (month, 1 + (7 - first) % 7 + 7 * (week - 1))
+
+    days = set(['01-01', '02-11', '04-29', '05-03', '05-04', '05-05', '11-03', '11-23'])
+    # 天皇誕生日（2019年はなし）
+    if year <= 2018:
+        days.add('12-23')
+    elif year >= 2020:
+        days.add('02-23')
+    if year >= 2016:
+        days.add('08-11')
+    days.update([monday(1, 2), monday(7, 3), monday(9, 3), monday(10, 2)])
+    # 春分の日、秋分の日（1980〜2099年の近似式）
+    elapsed = year - 1980
+    days.add('03-%02d' % int(20.8431 + 0.242194 * elapsed - elapsed // 4))
+    days.add('09-%02d' % int(23.2488 + 0.242194 * elapsed - elapsed // 4))
+    added, removed = GV_SPECIAL_HOLIDAYS.get(year, ([], []))
+    days.update(added)
+    days.difference_update(removed)
+
+    dates = sorted(datetime.strptime('%d-%s' % (year, day), '%Y-%m-%d') for day in days)
+    for date in dates:
+        # 前後の日が祝日の日は国民の休日
+        between = date + timedelta(days=2)
+        if between.strftime('%m-%d') in days and (date + timedelta(days=1)).strftime('%m-%d') not in days \
+                and (date + timedelta(days=1)).weekday() != 6:
+            days.add((date + timedelta(days=1)).strftime('%m-%d'))
+    for date in dates:
+        # 日曜の祝日は、その後の最初の祝日でない日が振替休日
+        if date.weekday() == 6:
+            substitute = date + timedelta(days=1)
+            while substitute.strftime('%m-%d') in days:
+                substitute += timedelta(days=1)
+            if substitute.year == year:
+                days.add(substitute.strftime('%m-%d'))
+
+    holidays = frozenset(days)
+    GV_HOLIDAYS[year] = holidays
+    return holidays
+
+
+def get_day_type(search_date, exact=False):
+    """日付から、時刻表の曜日の種類を返す。
+    祝日は get_japanese_holidays で計算し、年末年始（GV_YEAR_END_HOLIDAYS）も休日とする。
+
+    Parameters
+    ----------
+    search_date : str
+        yyyy-mm-dd形式の日付文字列。
+    exact : bool, default False
+        True の場合、祝日を計算できない年（GV_HOLIDAY_YEARS の範囲外）の、日曜、元日以外の日は None を返す。
+        False の場合は、そのような日を祝日ではないものとして扱う。
+
+    Returns
+    -------
+    day_type : str
+        'weekday', 'saturday', 'holiday'。判定できない場合は None（exact の場合のみ）。
+    """
+    date = datetime.strptime(search_date, '%Y-%m-%d').date()
+    if search_date[5:] in GV_YEAR_END_HOLIDAYS or search_date[5:] == '01-01':
+        is_holiday = True
+    elif date.year in GV_HOLIDAY_YEARS:
+        is_holiday = search_date[5:] in get_japanese_holidays(date.year)
+    else:
+        is_holiday = None
+    if is_holiday or date.weekday() == 6:
+        return 'holiday'
+    if is_holiday is None and exact:
+        return None
+    if date.weekday() == 5:
+        return 'saturday'
+    return 'weekday'
+
+
+def make_timetable_key(station_from, station_to, search_date, search_type, walk_speed=GV_WALK_SPEED):
+    """始発、終電の検索結果キャッシュのキーを生成する。
+    曜日の種類を判定できない日（祝日を計算できない年）は、平日と休日の時刻表を取り違えないよう、日付をキーにする。
+    """
+    day_type = get_day_type(search_date, exact=True) or search_date
+    return '|'.join(['timetable', GV_TIMETABLE_VERSION, station_from, station_to, day_type,
+                     search_type, str(walk_speed)])
+
+
+def timetable_get(station_from, station_to, search_date_time, search_type, walk_speed=GV_WALK_SPEED):
+    """始発、終電の検索結果を、同じ曜日の種類のキャッシュから取り出す。
+    検索日が異なる場合があるため、検索結果ページのURLは検索日で作り直し、前後の電車へのリンクは使わない。
+
+    Parameters
+    ----------
+    station_from : str
+        出発駅。
+    station_to : str
+        到着駅。
+    search_date_time : str
+        yyyy-mm-dd HH:MM形式の日時文字列。
+    search_type : str
+        '始発', '終電'
+    walk_speed : int, default GV_WALK_SPEED
+        歩く速度（1, 2, 3, 4）。
+
+    Returns
+    -------
+    transit_info : dict
+        路線情報。見つからない場合は None。
+    """
+    key = make_timetable_key(station_from, station_to, search_date_time[:10], search_type, walk_speed)
+    transit_info = None
+    with GV_CACHE_LOCK:
+        entry = GV_TIMETABLE_CACHE.get(key)
+        if entry is not None and entry[0] > time.time():
+            GV_TIMETABLE_CACHE.move_to_end(key)
+            transit_info = dict(entry[1])
+    if transit_info is None and GV_SHARED_CACHE is not None:
+        try:
+            transit_info = GV_SHARED_CACHE.get(key)
+        except Exception as e:
+            print('[WARN] Shared cache get failed: ' + repr(e))
+        if transit_info is not None:
+            _timetable_put_local(key, transit_info)
+            transit_info = dict(transit_info)
+
+    if transit_info is None:
+        GV_TIMETABLE_STATS['miss'] += 1
+        return None
+    GV_TIMETABLE_STATS['hit'] += 1
+    transit_info['searchDateTime'] = search_date_time
+    transit_info['url'] = build_search_url(station_from, station_to, search_date_time, search_type, walk_speed)
+    transit_info['prevUrl'] = None
+    transit_info['nextUrl'] = None
+    return transit_info
+
+
+def timetable_set(transit_info, walk_speed=GV_WALK_SPEED):
+    """始発、終電の検索結果を、曜日の種類をキーにキャッシュ（ローカル、共有キャッシュ）に保存する。"""
+    key = make_timetable_key(transit_info['stationFrom'], transit_info['stationTo'],
+                             transit_info['searchDateTime'][:10], transit_info['searchType'], walk_speed)
+    _timetable_put_local(key, transit_info)
+    if GV_SHARED_CACHE is not None:
+        try:
+            GV_SHARED_CACHE.set(key, dict(transit_info), GV_TIMETABLE_TTL)
+        except Exception as e:
+            print('[WARN] Shared cache set failed: ' + repr(e))
+
+
+def _timetable_put_local(key, transit_info):
+    with GV_CACHE_LOCK:
+        GV_TIMETABLE_CACHE[key] = (time.time() + GV_TIMETABLE_TTL, dict(transit_info))
+        GV_TIMETABLE_CACHE.move_to_end(key)
+        while len(GV_TIMETABLE_CACHE) > GV_TIMETABLE_MAX_ENTRIES:
+            GV_TIMETABLE_CACHE.popitem(last=False)
+
+
+def warm_timetable_cache(pairs, search_date=None, walk_speed=GV_WALK_SPEED):
+    """駅の組み合わせ毎に始発、終電を検索し、キャッシュに保存する。
+
+    Parameters
+    ----------
+    pairs : list of (str, str)
+        (出発駅, 到着駅) のリスト。
+    search_date : str, default None
+        yyyy-mm-dd形式の検索日。None の場合は今日（JST）。
+    walk_speed : int, default GV_WALK_SPEED
+        歩く速度（1, 2, 3, 4）。
+
+    Returns
+    -------
+    warmed : int
+        キャッシュに保存した検索結果の数。
+    """
+    search_date = search_date or datetime.now(GV_TZ_JST).strftime('%Y-%m-%d')
+    warmed = 0
+    for station_from, station_to in pairs:
+        for search_type in ['始発', '終電']:
+            try:
+                transit_info = fetch_transit_info(station_from, station_to, search_date + ' 00:00', search_type,
+                                                  walk_speed)
+            except Exception as e:
+                print('[WARN] Can not warm timetable cache: ' + repr(e))
+                transit_info = None
+            if transit_info is not None:
+                warmed += 1
+    return warmed
+
+
+def timetable_warmup_handler(event, context):
+    """始発、終電のキャッシュを事前に作成する（EventBridgeのスケジュールなどから呼び出すLambdaのハンドラ）。
+    event の pairs（[[出発駅, 到着駅], ...]）、date（yyyy-mm-dd、省略時は今日）を検索する。
+    キャッシュを他のコンテナと共有するには、set_shared_cache で共有キャッシュを設定しておく必要がある。
+    """
+    warmed = warm_timetable_cache(event.get('pairs', []), event.get('date'))
+    print('[INFO] Timetable cache warmed: ' + str(warmed) + ' ' + repr(GV_TIMETABLE_STATS))
+    return {'warmed': warmed}
+
+
+# --------------- Commute profiles ----------------------
+
+# -- 利用者毎の検索を保存するストア（make_commute_profile_store の結果）
+GV_COMMUTE_PROFILE = None
+GV_COMMUTE_STATS = {'recorded': 0, 'predictionHit': 0, 'predictionMiss': 0}
+
+
+def set_commute_profile_store(store):
+    """通勤プロファイルのストアを設定する。None の場合は記録しない。"""
+    global GV_COMMUTE_PROFILE
+    GV_COMMUTE_PROFILE = store
+
+
+class SqliteCommuteProfileStore(object):
+    """SQLiteのファイルに、利用者毎の検索（searches）と、事前検索した条件（predictions）を保存する。
+
+    searches は検索した時刻（asked）と検索条件の日時（search_date, search_minutes）を持ち、
+    predictions は事前検索したキャッシュのキーと、その後に利用者が同じキーで検索したか（hit）を持つ。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def _get_connection(self):
+        if self.connection is None:
+            import sqlite3
+            connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS searches (user_id TEXT, asked REAL, asked_date TEXT, '
+                               'asked_minutes INTEGER, day_type TEXT, station_from TEXT, station_to TEXT, '
+                               'search_type TEXT, search_date TEXT, search_minutes INTEGER, predicted INTEGER)')
+            connection.execute('CREATE INDEX IF NOT EXISTS searches_user ON searches (user_id, asked)')
+            connection.execute('CREATE TABLE IF NOT EXISTS predictions (user_id TEXT, cache_key TEXT, '
+                               'predicted REAL, hit INTEGER, PRIMARY KEY (user_id, cache_key))')
+            self.connection = connection
+        return self.connection
+
+    def add_search(self, user_id, search, cache_key):
+        """検索を1件記録する。事前検索したキーと同じ場合は、予測が当たったものとして記録する。
+
+        Parameters
+        ----------
+        user_id : str
+            AlexaのuserId。
+        search : dict
+            asked（epoch秒）, askedDate, askedMinutes, dayType, stationFrom, stationTo, searchType,
+            searchDate, searchMinutes。
+        cache_key : str
+            検索条件のキャッシュのキー（make_cache_key）。
+
+        Returns
+        -------
+        predicted : bool
+            事前検索したキーと同じ場合は True。
+        """
+        expires = search['asked'] - GV_COMMUTE_HISTORY_DAYS * 24 * 60 * 60
+        with self.lock:
+            connection = self._get_connection()
+            connection.execute('BEGIN IMMEDIATE')
+            predicted = connection.execute('UPDATE predictions SET hit = 1 WHERE user_id = ? AND cache_key = ?',
+                                           (user_id, cache_key)).rowcount == 1
+            connection.execute('INSERT INTO searches VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (user_id, search['asked'], search['askedDate'], search['askedMinutes'],
+                                search['dayType'], search['stationFrom'], search['stationTo'], search['searchType'],
+                                search['searchDate'], search['searchMinutes'], int(predicted)))
+            connection.execute('DELETE FROM searches WHERE user_id = ? AND asked < ?', (user_id, expires))
+            connection.execute('DELETE FROM predictions WHERE user_id = ? AND predicted < ?', (user_id, expires))
+            connection.execute('COMMIT')
+        return predicted
+
+    def get_searches(self, user_id, since, day_type=None):
+        """since（epoch秒）以降の利用者の検索を、古い順に返す。day_type を指定した場合は、その曜日の種類のみ。"""
+        query = 'SELECT asked, asked_date, asked_minutes, day_type, station_from, station_to, search_type, ' \
+                'search_date, search_minutes FROM searches WHERE user_id = ? AND asked >= ?'
+        params = [user_id, since]
+        if day_type is not None:
+            query += ' AND day_type = ?'
+            params.append(day_type)
+        keys = ['asked', 'askedDate', 'askedMinutes', 'dayType', 'stationFrom', 'stationTo', 'searchType',
+                'searchDate', 'searchMinutes']
+        with self.lock:
+            rows = self._get_connection().execute(query + ' ORDER BY asked', params).fetchall()
+        return [dict(zip(keys, row)) for row in rows]
+
+    def get_users(self, since, day_type=None):
+        """since（epoch秒）以降に検索した利用者のuserIdを返す。"""
+        query = 'SELECT DISTINCT user_id FROM searches WHERE asked >= ?'
+        params = [since]
+        if day_type is not None:
+            query += ' AND day_type = ?'
+            params.append(day_type)
+        with self.lock:
+            return [row[0] for row in self._get_connection().execute(query, params)]
+
+    def add_predictions(self, items, predicted):
+        """事前検索した (userId, キャッシュのキー) を記録する。記録済みのものは無視する。"""
+        with self.lock:
+            connection = self._get_connection()
+            connection.execute('BEGIN IMMEDIATE')
+            added = connection.executemany('INSERT OR IGNORE INTO predictions VALUES (?, ?, ?, 0)',
+                                           [(user_id, key, predicted) for user_id, key in items]).rowcount
+            connection.execute('COMMIT')
+        return added
+
+    def get_prediction_stats(self, since):
+        """since（epoch秒）以降の予測の的中率を返す。
+
+        Returns
+        -------
+        stats : dict
+            predicted（事前検索した数）, hit（そのうち利用者が検索した数）, hitRate,
+            searches（検索した数）, predictedSearches（そのうち事前検索した条件だった数）, coverage。
+        """
+        with self.lock:
+            connection = self._get_connection()
+            predicted, hit = connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(hit), 0) FROM predictions WHERE predicted >= ?', (since,)).fetchone()
+            searches, predicted_searches = connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(predicted), 0) FROM searches WHERE asked >= ?', (since,)).fetchone()
+        return {
+            'predicted': predicted,
+            'hit': hit,
+            'hitRate': round(hit / float(predicted), 3) if predicted else None,
+            'searches': searches,
+            'predictedSearches': predicted_searches,
+            'coverage': round(predicted_searches / float(searches), 3) if searches else None,
+        }
+
+
+def make_commute_profile_store(backend):
+    """GV_COMMUTE_PROFILE_BACKEND で指定した通勤プロファイルのストアを作成する。接続は最初に使う時に行う。"""
+    if backend == 'sqlite':
+        return SqliteCommuteProfileStore(os.environ.get('commute_profile_path', '/tmp/yahoo_transit_profiles.sqlite3'))
+    raise ValueError('Unknown commute profile store: ' + repr(backend))
+
+
+if GV_COMMUTE_PROFILE_BACKEND:
+    set_commute_profile_store(make_commute_profile_store(GV_COMMUTE_PROFILE_BACKEND))
+
+
+def get_user_id(session):
+    """セッションから、AlexaのuserIdを取り出す。ない場合は None。"""
+    return (session.get('user') or {}).get('userId')
+
+
+def record_commute_search(session, transit_info, now=None):
+    """検索した条件を、利用者の通勤プロファイルに記録する。
+    記録できなくても応答には影響しないよう、失敗した場合はログに出力するだけにする。
+
+    Parameters
+    ----------
+    session : dict
+        Alexaのセッション。
+    transit_info : dict
+        路線情報（検索条件、検索結果）。
+    now : datetime, default None
+        検索した日時（JST）。None の場合は現在日時。
+    """
+    user_id = get_user_id(session)
+    if GV_COMMUTE_PROFILE is None or user_id is None:
+        return
+    now = now or datetime.now(GV_TZ_JST)
+    search_date_time = transit_info['searchDateTime']
+    asked_date = now.strftime('%Y-%m-%d')
+    search = {
+        'asked': now.timestamp(),
+        'askedDate': asked_date,
+        'askedMinutes': now.hour * 60 + now.minute,
+        'dayType': get_day_type(asked_date),
+        'stationFrom': transit_info['stationFrom'],
+        'stationTo': transit_info['stationTo'],
+        'searchType': transit_info['searchType'],
+        'searchDate': search_date_time[:10],
+        'searchMinutes': int(search_date_time[11:13]) * 60 + int(search_date_time[14:16]),
+    }
+    cache_key = make_cache_key(search['stationFrom'], search['stationTo'], search_date_time, search['searchType'])
+    try:
+        predicted = GV_COMMUTE_PROFILE.add_search(user_id, search, cache_key)
+    except Exception as e:
+        print('[WARN] Can not record commute search: ' + repr(e))
+        return
+    GV_COMMUTE_STATS['recorded'] += 1
+    GV_COMMUTE_STATS['predictionHit' if predicted else 'predictionMiss'] += 1
+
+
+def find_commute_patterns(searches):
+    """利用者の検索から、よく検索する条件（パターン）を求める。
+    同じ駅、タイプの検索を、検索した時刻の間隔が GV_COMMUTE_SLOT_MINUTES 分以内のものでまとめ、
+    GV_COMMUTE_MIN_DAYS 日以上検索したものをパターンとする。
+
+    Parameters
+    ----------
+    searches : list of dict
+        SqliteCommuteProfileStore.get_searches の結果（同じ曜日の種類のもの）。
+
+    Returns
+    -------
+    patterns : list of dict
+        stationFrom, stationTo, searchType, askedMinutes（検索する時刻の下位25%）, askedUntil（最も遅い時刻）,
+        searchMinutes, dayOffset（検索した日から検索条件の日付までの日数）, days（検索した日数）。
+        検索した日数が多い順。
+    """
+    groups = {}
+    for search in searches:
+        groups.setdefault((search['stationFrom'], search['stationTo'], search['searchType']), []).append(search)
+
+    patterns = []
+    for items in groups.values():
+        items.sort(key=lambda search: search['askedMinutes'])
+        slot = [items[0]]
+        for search in items[1:]:
+            if search['askedMinutes'] - slot[-1]['askedMinutes'] > GV_COMMUTE_SLOT_MINUTES:
+                patterns.append(_make_commute_pattern(slot))
+                slot = []
+            slot.append(search)
+        patterns.append(_make_commute_pattern(slot))
+    patterns = [pattern for pattern in patterns if pattern['days'] >= GV_COMMUTE_MIN_DAYS]
+    patterns.sort(key=lambda pattern: (-pattern['days'], pattern['askedMinutes']))
+    return patterns
+
+
+def _make_commute_pattern(searches):
+    asked = [search['askedMinutes'] for search in searches]
+    search_minutes = sorted(search['searchMinutes'] for search in searches)
+    offsets = sorted((datetime.strptime(search['searchDate'], '%Y-%m-%d') -
+                      datetime.strptime(search['askedDate'], '%Y-%m-%d')).days for search in searches)
+    return {
+        'stationFrom': searches[0]['stationFrom'],
+        'stationTo': searches[0]['stationTo'],
+        'searchType': searches[0]['searchType'],
+        'askedMinutes': asked[len(asked) // 4],
+        'askedUntil': asked[-1],
+        'searchMinutes': search_minutes[len(search_minutes) // 2],
+        'dayOffset': offsets[len(offsets) // 2],
+        'days': len(set(search['askedDate'] for search in searches)),
+    }
+
+
+def get_commute_patterns(user_id, now):
+    """利用者が now と同じ曜日の種類によく検索する条件を返す（find_commute_patterns）。"""
+    since = now.timestamp() - GV_COMMUTE_HISTORY_DAYS * 24 * 60 * 60
+    day_type = get_day_type(now.strftime('%Y-%m-%d'))
+    return find_commute_patterns(GV_COMMUTE_PROFILE.get_searches(user_id, since, day_type))
+
+
+def commute_search_condition(pattern, now):
+    """パターンから、now に検索する条件を求める。
+    出発、到着の時刻を過ぎている場合は、今から出発する電車を検索する。
+
+    Returns
+    -------
+    search_date_time, search_type : str, str
+        yyyy-mm-dd HH:MM形式の日時文字列と、タイプ。
+    """
+    search_date = now.date() + timedelta(days=pattern['dayOffset'])
+    search_dt = datetime(search_date.year, search_date.month, search_date.day, tzinfo=GV_TZ_JST) + \
+        timedelta(minutes=pattern['searchMinutes'])
+    search_type = pattern['searchType']
+    if search_type in ('出発', '到着') and search_dt < now.replace(second=0, microsecond=0):
+        search_dt, search_type = now.replace(second=0, microsecond=0), '出発'
+    return format_search_datetime(search_dt), search_type
+
+
+def predict_commute(user_id, now=None):
+    """利用者が now に検索する「いつもの」条件を予測する。
+    今の時間帯に検索するパターンがあればそれを、なければ同じ曜日の種類で最も多く検索したパターンを使う。
+
+    Parameters
+    ----------
+    user_id : str
+        AlexaのuserId。
+    now : datetime, default None
+        現在日時（JST）。None の場合は現在日時。
+
+    Returns
+    -------
+    condition : tuple
+        (出発駅, 到着駅, yyyy-mm-dd HH:MM形式の日時文字列, タイプ)。パターンがない場合は None。
+    """
+    if GV_COMMUTE_PROFILE is None or user_id is None:
+        return None
+    now = now or datetime.now(GV_TZ_JST)
+    patterns = get_commute_patterns(user_id, now)
+    if not patterns:
+        return None
+    minutes = now.hour * 60 + now.minute
+    current = [pattern for pattern in patterns
+               if pattern['askedMinutes'] - GV_COMMUTE_LEAD_MINUTES <= minutes
+               <= pattern['askedUntil'] + GV_COMMUTE_SLOT_MINUTES]
+    pattern = (current or patterns)[0]
+    search_date_time, search_type = commute_search_condition(pattern, now)
+    return pattern['stationFrom'], pattern['stationTo'], search_date_time, search_type
+
+
+def warm_commute_cache(now=None, lead_minutes=GV_COMMUTE_LEAD_MINUTES, workers=GV_COMMUTE_WARM_WORKERS):
+    """いつも検索する時刻の lead_minutes 分前から最も遅い時刻までの間にある利用者のパターンを検索し、
+    キャッシュに保存する。同じ条件の利用者はまとめて1回だけ検索する。
+    キャッシュの有効期限は、最も遅い時刻まで使えるように延ばす。
+
+    Parameters
+    ----------
+    now : datetime, default None
+        現在日時（JST）。None の場合は現在日時。
+    lead_minutes : int, default GV_COMMUTE_LEAD_MINUTES
+        いつも検索する時刻の何分前から検索するか。
+    workers : int, default GV_COMMUTE_WARM_WORKERS
+        並行して検索する数。
+
+    Returns
+    -------
+    result : dict
+        users（対象の利用者数）, searches（検索した条件の数）, warmed（キャッシュに保存した数）,
+        predicted（新たに記録した予測の数）。
+    """
+    now = now or datetime.now(GV_TZ_JST)
+    minutes = now.hour * 60 + now.minute
+    since = now.timestamp() - GV_COMMUTE_HISTORY_DAYS * 24 * 60 * 60
+    # -- { キャッシュのキー: [検索条件, 有効期限(秒), [userId, ...]] }
+    due = OrderedDict()
+    users = GV_COMMUTE_PROFILE.get_users(since, get_day_type(now.strftime('%Y-%m-%d')))
+    for user_id in users:
+        for pattern in get_commute_patterns(user_id, now):
+            if not pattern['askedMinutes'] - lead_minutes <= minutes <= pattern['askedUntil']:
+                continue
+            search_date_time, search_type = commute_search_condition(pattern, now)
+            condition = (pattern['stationFrom'], pattern['stationTo'], search_date_time, search_type)
+            key = make_cache_key(*condition)
+            ttl = (pattern['askedUntil'] - minutes) * 60 + GV_CACHE_TTL_MIN
+            entry = due.setdefault(key, [condition, 0, []])
+            entry[1] = max(entry[1], ttl)
+            entry[2].append(user_id)
+
+    def warm(key, condition, ttl):
+        try:
+            transit_info = fetch_transit_info(*condition)
+        except Exception as e:
+            print('[WARN] Can not warm commute cache: ' + repr(e))
+            return False
+        if transit_info is None or transit_info.get('stale'):
+            return False
+        cache_set(key, transit_info, max(ttl, cache_ttl(condition[2])))
+        return True
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = [(key, executor.submit(warm, key, condition, ttl)) for key, (condition, ttl, _) in due.items()]
+    warmed = [key for key, future in results if future.result()]
+    predictions = [(user_id, key) for key in warmed for user_id in due[key][2]]
+    predicted = GV_COMMUTE_PROFILE.add_predictions(predictions, now.timestamp()) if predictions else 0
+    return {'users': len(users), 'searches': len(due), 'warmed': len(warmed), 'predicted': predicted}
+
+
+def commute_warmup_handler(event, context):
+    """利用者がいつも検索する条件を事前に検索し、キャッシュに保存する（EventBridgeのスケジュールなどから
+    GV_COMMUTE_LEAD_MINUTES より短い間隔で呼び出すLambdaのハンドラ）。
+    event の now（yyyy-mm-dd HH:MM、省略時は現在日時）の時点で検索する。
+    キャッシュをスキルのコンテナと共有するには、set_shared_cache で共有キャッシュを設定しておく必要がある。
+    直近 GV_COMMUTE_STATS_DAYS 日の予測の的中率（get_prediction_stats）もあわせて返す。
+    """
+    if GV_COMMUTE_PROFILE is None:
+        print('[WARN] Commute profile store is not configured')
+        return {'warmed': 0}
+    now = to_search_datetime(event['now']) if event.get('now') else datetime.now(GV_TZ_JST)
+    result = warm_commute_cache(now)
+    result['predictions'] = GV_COMMUTE_PROFILE.get_prediction_stats(
+        now.timestamp() - GV_COMMUTE_STATS_DAYS * 24 * 60 * 60)
+    print('[INFO] Commute cache warmed: ' + json.dumps(result) + ' ' + repr(GV_COMMUTE_STATS))
+    emit_metrics({'Job': 'CommuteWarmup'}, {'Warmed': result['warmed'], 'Predicted': result['predicted']}, 'Count')
+    if result['predictions']['hitRate'] is not None:
+        emit_metrics({'Job': 'CommuteWarmup'}, {'PredictionHitRate': result['predictions']['hitRate'] * 100,
+                                                'PredictionCoverage': (result['predictions']['coverage'] or 0) * 100},
+                     'Percent')
+    return result
+
+
+# --------------- HTTP transport ----------------------
+
+# -- コンテナ毎に1つだけ作成し、Keep-Aliveで接続を使い回す
+GV_HTTP_SESSION = None
+# -- 現在処理中のリクエストで、HTTP通信を終えなければならない時刻（epoch秒）
+# -- yahoo_transit_server では複数のリクエストを並行して処理するため、スレッド毎に持つ
+GV_REQUEST_LOCAL = threading.local()
+# -- GV_HTTP_RATE_LIMIT が設定されている場合の、ホスト毎の流量制限
+GV_HTTP_RATE_LIMITER = None
+# -- { host: CircuitBreaker }
+GV_CIRCUIT_BREAKERS = {}
+GV_CIRCUIT_BREAKERS_LOCK = threading.Lock()
+
+
+def get_http_session():
+    """コンテナで共有する requests.Session を返す。初回呼び出し時に作成する。
+
+    Returns
+    -------
+    session : requests.Session
+        コネクションプールを持つセッション。
+    """
+    global GV_HTTP_SESSION
+    if GV_HTTP_SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=GV_HTTP_POOL_CONNECTIONS,
+                              pool_maxsize=GV_HTTP_POOL_MAXSIZE, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        GV_HTTP_SESSION = session
+    return GV_HTTP_SESSION
+
+
+def set_request_deadline(context):
+    """Lambdaの残り時間から、HTTP通信を終えなければならない時刻を設定する。
+
+    Parameters
+    ----------
+    context : LambdaContext
+        Lambdaのコンテキスト。get_remaining_time_in_millis を持たない場合は
+        Alexaの応答期限を使う。
+    """
+    remaining_ms = GV_ALEXA_TIMEOUT_MS
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        remaining_ms = min(context.get_remaining_time_in_millis(), GV_ALEXA_TIMEOUT_MS)
+    GV_REQUEST_LOCAL.deadline = time.time() + (remaining_ms - GV_DEADLINE_MARGIN_MS) / 1000.0
+
+
+class HostRateLimiter(object):
+    """ホスト毎に、1秒あたりのリクエスト数を制限する（トークンバケット）。
+
+    Parameters
+    ----------
+    rate : float
+        1秒あたりの最大リクエスト数。
+    burst : int, default 1
+        連続して送信できるリクエスト数。
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        # -- { host: (トークン数, 最後に補充した時刻) }
+        self.buckets = {}
+
+    def acquire(self, host):
+        """host へのリクエストを送信できるまで待つ。"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                tokens, updated = self.buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                if tokens >= 1:
+                    self.buckets[host] = (tokens - 1, now)
+                    return
+                self.buckets[host] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているため、リクエストを送信しなかった。"""
+
+
+class CircuitBreaker(object):
+    """連続して失敗したホストへのリクエストを、一定時間止める。
+    閉（closed）: 送信する。failures 回連続して失敗すると開く。
+    開（open）: 送信しない。reset_timeout 秒経過すると半開になる。
+    半開（half_open）: 1回だけ試しに送信し、成功すれば閉じ、失敗すれば再び開く。
+
+    Parameters
+    ----------
+    failures : int, default GV_CIRCUIT_FAILURES
+        開くまでの連続した失敗の回数。
+    reset_timeout : float, default GV_CIRCUIT_RESET_TIMEOUT
+        開いてから、試しに送信するまでの秒数。
+    """
+
+    def __init__(self, failures=GV_CIRCUIT_FAILURES, reset_timeout=GV_CIRCUIT_RESET_TIMEOUT):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.stats = {'opened': 0, 'rejected': 0}
+
+    def allow(self):
+        """リクエストを送信してよいか。半開の場合は、最初の1回だけ True を返す。"""
+        with self.lock:
+            if self.state == 'open' and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                return True
+            if self.state != 'closed':
+                self.stats['rejected'] += 1
+                return False
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.state == 'half_open' or self.consecutive_failures >= self.failures:
+                if self.state != 'open':
+                    self.stats['opened'] += 1
+                    print('[WARN] Circuit opened after ' + str(self.consecutive_failures) + ' failures')
+                self.state = 'open'
+                self.opened_at = time.time()
+
+    def metrics(self):
+        """状態（CircuitOpen: 開または半開なら1）、連続した失敗の回数、開いた回数、送信しなかった回数。"""
+        with self.lock:
+            return {
+                'CircuitOpen': 0 if self.state == 'closed' else 1,
+                'ConsecutiveFailures': self.consecutive_failures,
+                'CircuitOpened': self.stats['opened'],
+                'Rejected': self.stats['rejected'],
+            }
+
+
+def get_circuit_breaker(host):
+    """ホストのサーキットブレーカーを返す。初回呼び出し時に作成する。"""
+    breaker = GV_CIRCUIT_BREAKERS.get(host)
+    if breaker is None:
+        with GV_CIRCUIT_BREAKERS_LOCK:
+            breaker = GV_CIRCUIT_BREAKERS.setdefault(host, CircuitBreaker())
+    return breaker
+
+
+def set_http_rate_limit(rate, burst=1):
+    """ホスト毎の1秒あたりの最大リクエスト数を設定する。rate が0の場合は制限しない。"""
+    global GV_HTTP_RATE_LIMITER
+    GV_HTTP_RATE_LIMITER = HostRateLimiter(rate, burst) if rate > 0 else None
+
+
+def remaining_request_time():
+    """HTTP通信に使える残り時間（秒）を返す。現在のスレッドで期限が未設定の場合は None。"""
+    deadline = getattr(GV_REQUEST_LOCAL, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def http_request(method, url, use_deadline=True, record_success=True, **kwargs):
+    """共有セッションでHTTPリクエストを送信する。
+    タイムアウトは残り時間から決め、接続エラー、タイムアウト、5xxの場合は
+    残り時間の範囲内で間隔を空けて再試行する。
+    GV_HTTP_IDEMPOTENT_METHODS 以外のメソッドは、相手が受け付けた後に再送して重複しないよう、
+    接続できなかった場合のみ再試行する。
+
+    Parameters
+    ----------
+    method : str
+        'GET', 'POST' など。
+    url : str
+        リクエスト先のURL。
+    use_deadline : bool, default True
+        処理中のリクエストの残り時間に従うか。応答後にバックグラウンドで
+        送信する場合は False を指定する。
+    record_success : bool, default True
+        5xx以外の応答をサーキットブレーカーに成功として記録するか。レスポンスの内容を確認してから
+        記録する場合は False を指定し、呼び出し側で get_circuit_breaker(host) に記録する。
+    **kwargs
+        requests.Session.request に渡す引数（params, data など）。
+
+    Returns
+    -------
+    res : requests.Response
+        レスポンス。
+
+    Raises
+    ------
+    requests.RequestException
+        残り時間内に成功しなかった場合。
+    CircuitOpenError
+        失敗が続いているホストで、サーキットブレーカーが開いている場合。
+    """
+    host = url.split('/', 3)[2]
+    breaker = get_circuit_breaker(host)
+    if not breaker.allow():
+        raise CircuitOpenError('Circuit open: ' + host)
+    try:
+        with measure_time('http'):
+            res = _send_http_request(method, url, use_deadline, **kwargs)
+    except Exception:
+        breaker.record_failure()
+        raise
+    if res.status_code >= 500:
+        breaker.record_failure()
+    elif record_success:
+        breaker.record_success()
+    return res
+
+
+def _send_http_request(method, url, use_deadline, **kwargs):
+    import requests
+    session = get_http_session()
+    idempotent = method.upper() in GV_HTTP_IDEMPOTENT_METHODS
+    attempt = 0
+    while True:
+        if GV_HTTP_RATE_LIMITER is not None:
+            GV_HTTP_RATE_LIMITER.acquire(url.split('/', 3)[2])
+        remaining = remaining_request_time() if use_deadline else None
+        if remaining is not None and remaining <= 0:
+            raise requests.Timeout('Request deadline exceeded: ' + url)
+        connect_timeout = GV_HTTP_CONNECT_TIMEOUT
+        read_timeout = GV_HTTP_READ_TIMEOUT
+        if remaining is not None:
+            connect_timeout = min(connect_timeout, remaining)
+            read_timeout = min(read_timeout, remaining)
+
+        try:
+            res = session.request(method, url, timeout=(connect_timeout, read_timeout), **kwargs)
+            if res.status_code < 500 or attempt >= GV_HTTP_MAX_RETRIES or not idempotent:
+                return res
+            print('[WARN] HTTP ' + str(res.status_code) + ': ' + url)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= GV_HTTP_MAX_RETRIES or not (idempotent or _is_connect_error(e)):
+                raise
+            print('[WARN] HTTP ' + repr(e))
+
+        backoff = GV_HTTP_BACKOFF * (2 ** attempt)
+        remaining = remaining_request_time() if use_deadline else None
+        if remaining is not None and remaining <= backoff:
+            raise requests.Timeout('Request deadline exceeded: ' + url)
+        time.sleep(backoff)
+        attempt += 1
+
+
+def _is_connect_error(e):
+    """リクエストを送信する前の（接続できなかった）エラーか。"""
+    import requests
+    from urllib3.exceptions import NewConnectionError
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(e, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+if GV_HTTP_RATE_LIMIT > 0:
+    set_http_rate_limit(GV_HTTP_RATE_LIMIT)
+
+
+# --------------- Metrics ----------------------
+
+# -- 処理中のリクエストの計測値（スレッド毎。先読みなど別スレッドの処理は含めない）
+GV_METRICS_LOCAL = threading.local()
+
+
+def start_metrics():
+    """現在のスレッドで、リクエスト毎の計測を開始する。"""
+    GV_METRICS_LOCAL.metrics = dict((name, 0.0) for name in GV_METRICS_SECTIONS)
+
+
+def finish_metrics():
+    """現在のスレッドの計測を終了し、計測値（秒）を返す。"""
+    metrics = getattr(GV_METRICS_LOCAL, 'metrics', None)
+    GV_METRICS_LOCAL.metrics = None
+    return metrics or {}
+
+
+@contextmanager
+def measure_time(name):
+    """with ブロックの所要時間を、現在のリクエストの計測値 name に加算する。"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = getattr(GV_METRICS_LOCAL, 'metrics', None)
+        if metrics is not None:
+            metrics[name] = metrics.get(name, 0.0) + time.perf_counter() - start
+
+
+def emit_metrics(dimensions, values, unit='Milliseconds'):
+    """CloudWatch Embedded Metric Format のログを出力する。
+
+    Parameters
+    ----------
+    dimensions : dict
+        ディメンション（例: {'Intent': 'SetDateTime'}）。
+    values : dict
+        メトリクス名と値。
+    unit : str, default 'Milliseconds'
+        値の単位（'Count' など）。
+    """
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': GV_METRICS_NAMESPACE,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name in values],
+            }],
+        },
+    }
+    record.update(dimensions)
+    record.update(values)
+    print(json.dumps(record, ensure_ascii=False))
+
+
+class SamplingProfiler(object):
+    """別スレッドから一定間隔で対象スレッドのスタックを取得し、関数毎の出現回数を数えるプロファイラ。"""
+
+    def __init__(self, thread_id, interval=0.005, depth=8):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.depth = depth
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='sampling-profiler')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < self.depth:
+                code = frame.f_code
+                stack.append('%s:%d(%s)' % (os.path.basename(code.co_filename), frame.f_lineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.samples[tuple(stack)] += 1
+
+    def report(self, top=10):
+        """出現回数の多いスタック（呼び出し先から順）を返す。"""
+        return [{'count': count, 'stack': list(stack)} for stack, count in self.samples.most_common(top)]
+
+
+# --------------- Progressive response ----------------------
+
+# -- 処理中のリクエストの Progressive Response の送信先（スレッド毎）
+GV_PROGRESSIVE_LOCAL = threading.local()
+GV_PROGRESSIVE_EXECUTOR = None
+# -- 最近の検索時間（秒）
+GV_PROGRESSIVE_LATENCIES = deque(maxlen=GV_PROGRESSIVE_SAMPLES)
+GV_PROGRESSIVE_STATS = {'sent': 0, 'skipped': 0, 'failed': 0}
+
+
+def set_progressive_context(event):
+    """イベントの context.System から Progressive Response の送信先（apiEndpoint, apiAccessToken）を取り出し、
+    requestId とあわせて現在のスレッドに設定する。送信先がない場合、GV_PROGRESSIVE が無効な場合は送信しない。
+    """
+    system = (event.get('context') or {}).get('System') or {}
+    target = None
+    if GV_PROGRESSIVE and system.get('apiEndpoint') and system.get('apiAccessToken'):
+        target = (system['apiEndpoint'], system['apiAccessToken'], event['request']['requestId'])
+    GV_PROGRESSIVE_LOCAL.target = target
+
+
+def get_progressive_executor():
+    """Progressive Response の送信に使うスレッドプールを返す。初回呼び出し時に作成する。"""
+    global GV_PROGRESSIVE_EXECUTOR
+    if GV_PROGRESSIVE_EXECUTOR is None:
+        GV_PROGRESSIVE_EXECUTOR = futures.ThreadPoolExecutor(max_workers=GV_PROGRESSIVE_WORKERS)
+    return GV_PROGRESSIVE_EXECUTOR
+
+
+def send_progressive_response(speech, target):
+    """Alexaの Directive Service に VoicePlayer.Speak を送信する。
+
+    Parameters
+    ----------
+    speech : str
+        発話するテキスト。
+    target : tuple
+        (apiEndpoint, apiAccessToken, requestId)
+
+    Returns
+    -------
+    sent : bool
+        送信できた場合 True。
+    """
+    endpoint, token, request_id = target
+    directive = {
+        'header': {'requestId': request_id},
+        'directive': {'type': 'VoicePlayer.Speak', 'speech': '<speak>' + speech + '</speak>'},
+    }
+    try:
+        res = http_request('POST', endpoint + '/v1/directives', json=directive,
+                           headers={'Authorization': 'Bearer ' + token})
+    except Exception as e:
+        print('[WARN] Can not send progressive response: ' + repr(e))
+        return False
+    if res.status_code >= 300:
+        print('[WARN] Can not send progressive response: HTTP ' + str(res.status_code))
+        return False
+    return True
+
+
+def expected_search_latency():
+    """最近の検索時間の中央値（秒）。検索したことがない場合は 0。"""
+    if not GV_PROGRESSIVE_LATENCIES:
+        return 0.0
+    ordered = sorted(GV_PROGRESSIVE_LATENCIES)
+    return ordered[len(ordered) // 2]
+
+
+@contextmanager
+def progressive_response(speech=GV_MSG_PROMPT3):
+    """with ブロック（路線情報の検索）の間に、Progressive Response で speech を発話させる。
+
+    最近の検索時間の中央値が GV_PROGRESSIVE_THRESHOLD_MS 以上の場合は、検索の開始と同時に、
+    それ以外の場合は、検索が GV_PROGRESSIVE_THRESHOLD_MS を過ぎても終わらない場合に送信する。
+    送信は別スレッドで行い、検索と応答は送信の完了を待たない。
+    送信できた時刻は、metrics_middleware が TimeToFirstAudio として出力する。
+    """
+    target = getattr(GV_PROGRESSIVE_LOCAL, 'target', None)
+    if target is None:
+        yield
+        return
+
+    done = threading.Event()
+    metrics = getattr(GV_METRICS_LOCAL, 'metrics', None)
+    threshold = GV_PROGRESSIVE_THRESHOLD_MS / 1000.0
+    wait = 0 if expected_search_latency() >= threshold else threshold
+
+    def send():
+        if done.wait(wait):
+            GV_PROGRESSIVE_STATS['skipped'] += 1
+            return
+        if send_progressive_response(speech, target):
+            GV_PROGRESSIVE_STATS['sent'] += 1
+            if metrics is not None:
+                metrics['firstAudio'] = time.perf_counter()
+        else:
+            GV_PROGRESSIVE_STATS['failed'] += 1
+
+    get_progressive_executor().submit(send)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        done.set()
+        GV_PROGRESSIVE_LATENCIES.append(time.perf_counter() - start)
+
+
+# --------------- Notification queue ----------------------
+
+# -- コンテナで共有する通知キュー（get_notify_queue）
+GV_NOTIFY_QUEUE_INSTANCE = None
+
+
+def make_notify_key(session_id, search_result, url):
+    """セッションと検索結果から、重複した通知を判定するためのキーを生成する。"""
+    text = '\n'.join([session_id or '', search_result or '', url or ''])
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def make_notify_payload(messages):
+    """複数の通知を、IFTTTのWebhookに送信する1つのデータにまとめる（同じ key の通知は1つにする）。"""
+    unique = OrderedDict((message['key'], message) for message in messages)
+    return {
+        'value1': '\n\n'.join(message['value1'] for message in unique.values()),
+        'value2': '\n'.join(message['value2'] for message in unique.values()),
+    }
+
+
+def deliver_notifications(messages):
+    """通知をIFTTTのWebhookに送信する。複数の通知は1回のリクエストにまとめる。
+
+    Parameters
+    ----------
+    messages : list of dict
+        通知（key, value1: 検索結果テキスト, value2: URL）のリスト。
+
+    Returns
+    -------
+    delivered : bool
+        送信に成功した場合 True。
+    """
+    try:
+        status_code = http_request('POST', get_ifttt_url(), use_deadline=False,
+                                   data=make_notify_payload(messages)).status_code
+    except Exception as e:
+        print('[ERR] Can not notify Line: ' + repr(e))
+        return False
+    if status_code != 200:
+        print('[ERR] Can not notify Line: HTTP ' + str(status_code))
+    return status_code == 200
+
+
+class MemoryNotifyQueue(object):
+    """プロセス内の通知キュー。バックグラウンドのスレッドがまとめて送信し、失敗した通知は再送する。"""
+
+    def __init__(self):
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.worker = None
+        self.sending = 0
+
+    def put(self, message):
+        with self.condition:
+            self._append(message)
+            self.condition.notify()
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, name='notify-worker')
+                self.worker.daemon = True
+                self.worker.start()
+
+    def flush(self, timeout=None):
+        """キューが空になり、送信中の通知がなくなるまで待つ。
+
+        Returns
+        -------
+        flushed : bool
+            timeout 以内に空になった場合 True。
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self._pending() or self.sending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def _append(self, message):
+        self.queue.append(message)
+
+    def _pending(self):
+        return len(self.queue)
+
+    def _take(self, max_items):
+        return [self.queue.popleft() for _ in range(min(max_items, len(self.queue)))]
+
+    def _done(self, messages):
+        pass
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self._pending():
+                    self.condition.wait()
+            # 続けて届く通知を1回の送信にまとめる
+            time.sleep(GV_NOTIFY_BATCH_WAIT)
+            with self.condition:
+                batch = self._take(GV_NOTIFY_BATCH_SIZE)
+                self.sending += 1
+            try:
+                delivered = deliver_notifications(batch)
+            finally:
+                with self.condition:
+                    self.sending -= 1
+            if delivered:
+                with self.condition:
+                    self._done(batch)
+                    self.condition.notify_all()
+                continue
+
+            retry = [dict(message, attempts=message.get('attempts', 0) + 1) for message in batch]
+            retry = [message for message in retry if message['attempts'] < GV_NOTIFY_MAX_ATTEMPTS]
+            with self.condition:
+                self._done(batch)
+                self.condition.notify_all()
+            if retry:
+                time.sleep(GV_NOTIFY_BACKOFF * (2 ** (retry[0]['attempts'] - 1)))
+                with self.condition:
+                    for message in retry:
+                        self._append(message)
+                    self.condition.notify_all()
+
+
+class FileNotifyQueue(MemoryNotifyQueue):
+    """ファイルを使った通知キュー。1通知を1つのJSONファイルとしてディレクトリに保存し、
+    送信に成功するまで削除しない（プロセスが終了しても、次に起動した時に送信する）。
+    """
+
+    def __init__(self, spool_dir):
+        MemoryNotifyQueue.__init__(self)
+        self.spool_dir = spool_dir
+        os.makedirs(spool_dir, exist_ok=True)
+        self.taken = set()
+        for name in sorted(os.listdir(spool_dir)):
+            if name.endswith('.json'):
+                self.queue.append(name)
+
+    def _append(self, message):
+        name = '%.6f-%s-%d.json' % (time.time(), message['key'], message.get('attempts', 0))
+        path = os.path.join(self.spool_dir, name)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(message, f, ensure_ascii=False)
+        os.rename(path + '.tmp', path)
+        self.queue.append(name)
+
+    def _take(self, max_items):
+        messages = []
+        for name in MemoryNotifyQueue._take(self, max_items):
+            with open(os.path.join(self.spool_dir, name), encoding='utf-8') as f:
+                message = json.load(f)
+            message['file'] = name
+            messages.append(message)
+        return messages
+
+    def _done(self, messages):
+        for message in messages:
+            os.remove(os.path.join(self.spool_dir, message['file']))
+
+    def put(self, message):
+        message = dict(message)
+        message.pop('file', None)
+        MemoryNotifyQueue.put(self, message)
+
+
+class SqsNotifyQueue(object):
+    """Amazon SQS を使った通知キュー。送信は notify_handler（SQSをイベントソースとするLambda）で行う。"""
+
+    def __init__(self, queue_url):
+        import boto3
+        self.queue_url = queue_url
+        self.client = boto3.client('sqs')
+
+    def put(self, message):
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(message, ensure_ascii=False))
+
+    def flush(self, timeout=None):
+        return True
+
+
+class SyncNotifyQueue(object):
+    """キューを使わず、その場で送信する。"""
+
+    def put(self, message):
+        if not deliver_notifications([message]):
+            raise IOError('Can not notify Line.')
+
+    def flush(self, timeout=None):
+        return True
+
+
+def get_notify_queue():
+    """GV_NOTIFY_QUEUE で指定した通知キューを返す。初回呼び出し時に作成する。
+
+    Returns
+    -------
+    queue : object
+        put(message), flush(timeout) を持つ通知キュー。
+    """
+    global GV_NOTIFY_QUEUE_INSTANCE
+    if GV_NOTIFY_QUEUE_INSTANCE is None:
+        if GV_NOTIFY_QUEUE == 'sqs':
+            GV_NOTIFY_QUEUE_INSTANCE = SqsNotifyQueue(os.environ['notify_queue_url'])
+        elif GV_NOTIFY_QUEUE == 'file':
+            GV_NOTIFY_QUEUE_INSTANCE = FileNotifyQueue(os.environ.get('notify_spool_dir', '/tmp/yahoo_transit_notify'))
+        elif GV_NOTIFY_QUEUE == 'sync':
+            GV_NOTIFY_QUEUE_INSTANCE = SyncNotifyQueue()
+        else:
+            GV_NOTIFY_QUEUE_INSTANCE = MemoryNotifyQueue()
+    return GV_NOTIFY_QUEUE_INSTANCE
+
+
+def flush_notify_queue(timeout=GV_NOTIFY_FLUSH_TIMEOUT):
+    """通知キューの通知を送信し終えるまで、timeout 秒（処理中のリクエストの残り時間の方が短ければその時間）まで待つ。
+    Lambdaでは応答を返すとコンテナが止まるため、lambda_handler が応答の前に呼び出す。
+
+    Returns
+    -------
+    flushed : bool
+        送信し終えた（または通知キューを使っていない）場合 True。
+    """
+    if GV_NOTIFY_QUEUE_INSTANCE is None:
+        return True
+    remaining = remaining_request_time()
+    if remaining is not None:
+        timeout = min(timeout, max(remaining, 0))
+    flushed = GV_NOTIFY_QUEUE_INSTANCE.flush(timeout)
+    if not flushed:
+        print('[WARN] Notification queue was not flushed within ' + str(timeout) + ' seconds')
+    return flushed
+
+
+def notify_handler(event, context):
+    """SQSの通知キューから受け取った通知を、まとめてIFTTTに送信する（SQSをイベントソースとするLambdaのハンドラ）。
+    送信に失敗した通知は batchItemFailures として返し、SQSに再送させる。
+    """
+    records = event.get('Records', [])
+    failures = []
+    for i in range(0, len(records), GV_NOTIFY_BATCH_SIZE):
+        batch = records[i:i + GV_NOTIFY_BATCH_SIZE]
+        if not deliver_notifications([json.loads(record['body']) for record in batch]):
+            failures.extend({'itemIdentifier': record['messageId']} for record in batch)
+    return {'batchItemFailures': failures}
+
+
+# --------------- Route model ----------------------
+
+# -- routeDetail のテキストから、乗車する路線の行を取り出す
+GV_LEG_PATTERN = re.compile(r'^\[(?:train|bus)\]([^\]\r\n]*)', re.MULTILINE)
+GV_DIGIT_PATTERN = re.compile(r'\d+')
+
+
+def time_to_minutes(text):
+    """'09:12発' 形式の時刻を、0時からの分数に変換する。変換できない場合は None を返す。"""
+    if text is None or len(text) < 5 or text[2] != ':':
+        return None
+    try:
+        return int(text[0:2]) * 60 + int(text[3:5])
+    except ValueError:
+        return None
+
+
+class Leg(object):
+    """ルートのうち、1つの路線に乗車する区間。
+
+    Attributes
+    ----------
+    line : str
+        路線名（例: 'ＪＲ山手線外回り・品川行'）。
+    departure : str
+        発車時刻（例: '09:12発'）。わからない場合は None。
+    arrival : str
+        到着時刻（例: '09:25着'）。わからない場合は None。
+    """
+
+    __slots__ = ('line', 'departure', 'arrival')
+
+    def __init__(self, line, departure=None, arrival=None):
+        self.line = line
+        self.departure = departure
+        self.arrival = arrival
+
+
+class Route(object):
+    """検索結果ページに掲載された1つのルート。
+    表示用のテキストに加えて、料金（円）、乗り換え回数、所要時間（分）を数値で持つ。
+
+    Attributes
+    ----------
+    distance, fare, transfer, transport, start_time, arrival_time : str
+        セッションに保存するテキスト（GV_ROUTE_KEYS の順）。
+    legs : tuple of Leg
+        乗車する区間（乗車順）。
+    times : list of str
+        routeDetail 内の各時刻。
+    fare_yen : int
+        料金（円）。
+    transfer_count : int
+        乗り換え回数。
+    minutes : int
+        所要時間（分）。時刻がわからない場合は None。
+    """
+
+    __slots__ = ('distance', 'fare', 'transfer', 'transport', 'start_time', 'arrival_time', 'legs', 'times',
+                 'fare_yen', 'transfer_count', 'minutes')
+
+    def __init__(self, distance, fare, transfer, transport, start_time, arrival_time, legs=(), times=None):
+        self.distance = distance
+        self.fare = fare
+        self.transfer = transfer
+        self.transport = transport
+        self.start_time = start_time
+        self.arrival_time = arrival_time
+        self.legs = legs
+        self.times = times if times is not None else [start_time, arrival_time]
+        self.fare_yen = fare_to_int(fare)
+        self.transfer_count = int(transfer) if transfer and transfer.isdigit() else 0
+        start, arrival = time_to_minutes(start_time), time_to_minutes(arrival_time)
+        self.minutes = (arrival - start) % (24 * 60) if start is not None and arrival is not None else None
+
+    @classmethod
+    def from_fields(cls, fields):
+        """各解析方法で抽出した値（_make_route の fields）から生成する。"""
+        times = fields['times']
+        lines = GV_LEG_PATTERN.findall(fields['detail'])
+        legs = tuple(Leg(line, times[i] if i < len(times) else None, times[i + 1] if i + 1 < len(times) else None)
+                     for i, line in enumerate(lines))
+        return cls(fields['distance'], fields['fare'], GV_DIGIT_PATTERN.search(fields['transfer']).group(0),
+                   lines[0], times[0], times[-1], legs, times)
+
+    @classmethod
+    def from_values(cls, values):
+        """セッションに保存した値のリスト（to_values の結果）から生成する。"""
+        return cls(*values)
+
+    @classmethod
+    def from_record(cls, record):
+        """共有キャッシュに保存した値のタプル（to_record の結果）から生成する。"""
+        legs = tuple(Leg(*leg) for leg in record[6])
+        return cls(*record[:6], legs=legs, times=list(record[7]))
+
+    def to_record(self):
+        """共有キャッシュに保存する値のタプル（to_values に、乗車する区間、時刻を加えたもの）。"""
+        return (self.distance, self.fare, self.transfer, self.transport, self.start_time, self.arrival_time,
+                tuple((leg.line, leg.departure, leg.arrival) for leg in self.legs), tuple(self.times))
+
+    def to_values(self):
+        """セッションに保存する値のリスト（GV_ROUTE_KEYS の順）。"""
+        return [self.distance, self.fare, self.transfer, self.transport, self.start_time, self.arrival_time]
+
+    def to_dict(self):
+        """路線情報（transit_info）の形式の dict。"""
+        return {
+            'distance': self.distance,
+            'fare': self.fare,
+            'transfer': self.transfer,
+            'transport': self.transport,
+            'startTime': self.start_time,
+            'arrivalTime': self.arrival_time,
+            'legs': [leg.line for leg in self.legs],
+            'times': self.times,
+        }
+
+
+def route_to_json(value):
+    """json.dumps の default: 路線情報に含まれる Route を dict にする。"""
+    if isinstance(value, Route):
+        return value.to_dict()
+    raise TypeError(repr(value) + ' is not JSON serializable')
+
+
+# --------------- Helpers that build all of the responses ----------------------
+
+def build_speechlet_response(title, output, reprompt_text, should_end_session):
+    return {
+        'outputSpeech': {
+            'type': 'PlainText',
+            'text': output
+        },
+        'card': {
+            'type': 'Simple',
+            'title': "SessionSpeechlet - " + title,
+            'content': "SessionSpeechlet - " + output
+        },
+        'reprompt': {
+            'outputSpeech': {
+                'type': 'PlainText',
+                'text': reprompt_text
+            }
+        },
+        'shouldEndSession': should_end_session
+    }
+
+
+def build_response(session_attributes, speechlet_response):
+    with measure_time('serialize'):
+        session_attributes = encode_session_state(session_attributes)
+    return {
+        'version': '1.0',
+        'sessionAttributes': session_attributes,
+        'response': speechlet_response
+    }
+
+
+# --------------- Functions that control the skill's behavior ------------------
+
+def get_welcome_response():
+    """ If we wanted to initialize the session to have some attributes we could
+    add those here
+    """
+    session_attributes = {}
+    card_title = 'Welcome'
+    should_end_session = False
+
+    speech_output = GV_MSG_PROMPT1
+    # If the user either does not reply to the welcome message or says something
+    # that is not understood, they will be prompted again with this text.
+    reprompt_text = GV_MSG_REPROMPT1
+
+    return build_response(session_attributes, build_speechlet_response(
+        card_title, speech_output, reprompt_text, should_end_session))
+
+
+def handle_session_end_request():
+    card_title = 'Session Ended'
+    speech_output = GV_MSG_EXIT
+    # Setting this to true ends the session and exits the skill.
+    should_end_session = True
+    return build_response({}, build_speechlet_response(
+        card_title, speech_output, None, should_end_session))
+
+
+def handle_error_exit(session):
+    card_title = 'Error Exit'
+    speech_output = GV_MSG_ERROR_EXIT
+    # Setting this to true ends the session and exits the skill.
+    should_end_session = True
+    return build_response({}, build_speechlet_response(
+        card_title, speech_output, None, should_end_session))
+
+
+def make_search_payload(station_from, station_to, search_date_time, search_type, walk_speed=GV_WALK_SPEED):
+    """Yahoo路線の検索リクエストに含めるGETパラメータを生成する。
+
+    Parameters
+    ----------
+    station_from : str
+        出発駅。
+    station_to : str
+        到着駅。
+    search_date_time : str or datetime
+        yyyy-mm-dd HH:MM形式の日時文字列、またはJSTの日時。
+    search_type : str
+        '出発', '到着', '始発', '終電'
+    walk_speed : int, default GV_WALK_SPEED
+        歩く速度（1, 2, 3, 4）。
+
+    Returns
+    -------
+    payload : dict
+        GETパラメータ。
+    """
+    text = format_search_datetime(search_date_time)
+    return {
+        'from': station_from,
+        'to': station_to,
+        'y': text[0:4],
+        'm': text[5:7],
+        'd': text[8:10],
+        'hh': text[11:13],
+        'm2': text[15],
+        'm1': text[14],
+        'type': GV_SEARCH_TYPES.get(search_type, GV_TYPE_ARRIVE),
+        'expkind': 1,
+        'ws': walk_speed,
+        's': 0,
+        'lb': 1,
+        'kw': station_to
+    }
+
+
+def build_search_url(station_from, station_to, search_date_time, search_type, walk_speed=GV_WALK_SPEED):
+    """Yahoo路線の検索結果ページのURLを生成する。"""
+    return GV_SEARCH_URL + '?' + urlencode(
+        make_search_payload(station_from, station_to, search_date_time, search_type, walk_speed))
+
+
+def fetch_transit_info(station_from, station_to, search_date_time, search_type, walk_speed=GV_WALK_SPEED):
+    """Yahoo路線のWebサイトで、指定した条件で路線情報を検索し、検索結果ページから路線情報を取得する。
+
+    Parameters
+    ----------
+    station_from : str
+        出発駅。
+    station_to : str
+        到着駅。
+    search_date_time : str or datetime
+        yyyy-mm-dd HH:MM形式の日時文字列、またはJSTの日時（resolve_search_datetime の結果）。
+    search_type : str
+        '出発', '到着', '始発', '終電'
+    walk_speed : int, default GV_WALK_SPEED
+        歩く速度（1, 2, 3, 4）。
+
+    Returns
+    -------
+    transit_info : dict
+        路線情報。
+
+    See Also
+    --------
+    parse_transit_info : 検索結果ページから最初に見つかった路線情報を抽出する。
+    make_cache_key : 検索条件からキャッシュのキーを生成する。
+    """
+    # 日時は1回だけ文字列にし、キャッシュのキー、GETパラメータは文字列から切り出す
+    search_date_time = format_search_datetime(search_date_time)
+    transit_info = find_cached_transit_info(station_from, station_to, search_date_time, search_type, walk_speed)
+    if transit_info is not None:
+        return transit_info
+
+    cache_key = make_cache_key(station_from, station_to, search_date_time, search_type, walk_speed)
+    stale_info = cache_get_stale(cache_key)
+    if stale_info is None:
+        return search_transit_info_once(cache_key, station_from, station_to, search_date_time, search_type,
+                                        walk_speed)
+
+    # 有効期限が切れた結果がある場合も、まず検索し直す。GV_CACHE_STALE_WAIT 秒以内に終わらない、失敗した、
+    # サーキットブレーカーが開いている場合だけ、古い結果で応答し、裏で検索し直す
+    previous_deadline = getattr(GV_REQUEST_LOCAL, 'deadline', None)
+    stale_deadline = time.time() + GV_CACHE_STALE_WAIT
+    GV_REQUEST_LOCAL.deadline = stale_deadline if previous_deadline is None else min(previous_deadline,
+                                                                                     stale_deadline)
+    try:
+        transit_info = search_transit_info_once(cache_key, station_from, station_to, search_date_time,
+                                                search_type, walk_speed)
+    except Exception as e:
+        print('[WARN] Search failed, falling back to stale cache: ' + repr(e))
+        transit_info = None
+    finally:
+        GV_REQUEST_LOCAL.deadline = previous_deadline
+    if transit_info is not None:
+        return transit_info
+
+    count_cache_stats('stale')
+    print('[INFO] Stale cache hit: ' + cache_key)
+    stale_info['searchDateTime'] = search_date_time
+    refresh_transit_info(station_from, station_to, search_date_time, search_type, walk_speed)
+    return stale_info
+
+
+def search_transit_info(station_from, station_to, search_date_time, search_type, walk_speed=GV_WALK_SPEED,
+                        use_deadline=True):
+    """キャッシュを使わずにYahoo路線で検索し、結果をキャッシュに保存する。
+    引数は fetch_transit_info と同じ。use_deadline は http_request に渡す。
+    """
+    payload = make_search_payload(station_from, station_to, search_date_time, search_type, walk_speed)
+    res, page, fields = fetch_transit_page(GV_SEARCH_URL, use_deadline, record_success=False, params=payload)
+    return make_searched_transit_info(res.status_code, page, res.url, station_from, station_to, search_date_time,
+                                      search_type, walk_speed, fields)
+
+
+def make_searched_transit_info(status_code, page, url, station_from, station_to, search_date_time, search_type,
+                               walk_speed=GV_WALK_SPEED, fields=None):
+    """検索結果ページから路線情報を作成し（make_transit_info）、結果をサーキットブレーカーに記録する。
+    record_success=False で取得した検索結果ページに使う（search_transit_info、yahoo_transit_async）。
+    status_code は検索結果ページのステータスコード、それ以外の引数は make_transit_info と同じ。
+    """
+    breaker = get_circuit_breaker(GV_SEARCH_URL.split('/', 3)[2])
+    try:
+        transit_info = make_transit_info(page, url, station_from, station_to, search_date_time,
+                                         search_type, walk_speed, fields)
+    except Exception:
+        breaker.record_failure()
+        raise
+    # 検索結果ページを解析できない（レイアウトが変わった場合など）のも、失敗として数える
+    if status_code < 500:
+        if transit_info is None:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+    return transit_info
+
+
+# -- 検索中の検索条件（キャッシュのキー）と、その結果を待つ Future
+GV_INFLIGHT = {}
+GV_INFLIGHT_LOCK = threading.Lock()
+
+
+def run_once(cache_key, func):
+    """同じキャッシュのキーの検索を、同じコンテナで1回にまとめる。検索中の場合は、その結果を待つ。
+
+    Parameters
+    ----------
+    cache_key : str
+        キャッシュのキー。
+    func : callable
+        func() -> 路線情報。検索中でない場合に呼び出す。
+
+    Returns
+    -------
+    transit_info : dict
+        路線情報。見つからない場合は None。
+    """
+    with GV_INFLIGHT_LOCK:
+        future = GV_INFLIGHT.get(cache_key)
+        owner = future is None
+        if owner:
+            future = GV_INFLIGHT[cache_key] = futures.Future()
+    if not owner:
+        count_cache_stats('coalesced')
+        transit_info = future.result()
+        return dict(transit_info) if transit_info is not None else None
+
+    try:
+        transit_info = func()
+        future.set_result(transit_info)
+        return transit_info
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with GV_INFLIGHT_LOCK:
+            del GV_INFLIGHT[cache_key]
+
+
+def search_transit_info_once(cache_key, station_from, station_to, search_date_time, search_type,
+                             walk_speed=GV_WALK_SPEED):
+    """同じ検索条件の検索を1回にまとめる（run_once）。
+    共有キャッシュが add を持つ場合は、他のコンテナが検索中の間、
+    共有キャッシュに結果が保存されるのを GV_SHARED_CACHE_WAIT 秒まで待つ。引数は fetch_transit_info と同じ。
+    """
+    return run_once(cache_key, lambda: _search_transit_info_shared(
+        cache_key, station_from, station_to, search_date_time, search_type, walk_speed))
+
+
+def _search_transit_info_shared(cache_key, station_from, station_to, search_date_time, search_type, walk_speed):
+    if GV_SHARED_CACHE is None or not hasattr(GV_SHARED_CACHE, 'add'):
+        return search_transit_info(station_from, station_to, search_date_time, search_type, walk_speed)
+
+    lock_key = 'searching|' + cache_key
+    try:
+        acquired = GV_SHARED_CACHE.add(lock_key, GV_HTTP_CONNECT_TIMEOUT + GV_HTTP_READ_TIMEOUT)
+    except Exception as e:
+        print('[WARN] Shared cache add failed: ' + repr(e))
+        acquired = None
+    if acquired is False:
+        # 他のコンテナが検索中: 結果が共有キャッシュに保存されるのを待つ
+        remaining = remaining_request_time()
+        deadline = time.time() + min(GV_SHARED_CACHE_WAIT, remaining if remaining is not None else GV_SHARED_CACHE_WAIT)
+        while time.time() < deadline:
+            time.sleep(GV_SHARED_CACHE_POLL)
+            try:
+                transit_info = GV_SHARED_CACHE.get(cache_key)
+            except Exception as e:
+                print('[WARN] Shared cache get failed: ' + repr(e))
+                break
+            if transit_info is not None:
+                count_cache_stats('coalesced')
+                _cache_put_local(cache_key, transit_info, GV_CACHE_TTL_MIN)
+                transit_info = dict(transit_info)
+                transit_info['searchDateTime'] = format_search_datetime(search_date_time)
+                return transit_info
+
+    try:
+        return search_transit_info(station_from, station_to, search_date_time, search_type, walk_speed)
+    finally:
+        if acquired:
+            try:
+                GV_SHARED_CACHE.delete(lock_key)
+            except Exception as e:
+                print('[WARN] Shared cache delete failed: ' + repr(e))
+
+
+# -- 裏で検索し直している検索条件（キャッシュのキー）
+GV_REFRESHING = set()
+GV_REFRESHING_LOCK = threading.Lock()
+
+
+def refresh_transit_info(station_from, station_to, search_date_time, search_type, walk_speed=GV_WALK_SPEED):
+    """応答の後に検索し直し、キャッシュを更新する。同じ検索条件を同時に2回は検索しない。
+    引数は fetch_transit_info と同じ。
+    """
+    cache_key = make_cache_key(station_from, station_to, search_date_time, search_type, walk_speed)
+    with GV_REFRESHING_LOCK:
+        if cache_key in GV_REFRESHING:
+            return
+        GV_REFRESHING.add(cache_key)
+
+    def refresh():
+        try:
+            search_transit_info(station_from, station_to, search_date_time, search_type, walk_speed,
+                                use_deadline=False)
+        except Exception as e:
+            print('[WARN] Can not refresh cache: ' + repr(e))
+        finally:
+            with GV_REFRESHING_LOCK:
+                GV_REFRESHING.discard(cache_key)
+
+    get_prefetch_executor().submit(refresh)
+
+
+def find_cached_transit_info(station_from, station_to, search_date_time, search_type, walk_speed=GV_WALK_SPEED):
+    """始発、終電のキャッシュ、検索結果キャッシュの順に、検索条件に一致する路線情報を探す。
+    引数は fetch_transit_info と同じ。見つからない場合は None を返す。
+    """
+    search_date_time = format_search_datetime(search_date_time)
+    if search_type == '始発' or search_type == '終電':
+        transit_info = timetable_get(station_from, station_to, search_date_time, search_type, walk_speed)
+        if transit_info is not None:
+            return transit_info
+
+    cache_key = make_cache_key(station_from, station_to, search_date_time, search_type, walk_speed)
+    transit_info = cache_get(cache_key)
+    if transit_info is not None:
+        print('[INFO] Cache hit: ' + cache_key + ' ' + repr(get_cache_stats()))
+        transit_info['searchDateTime'] = search_date_time
+    return transit_info
+
+
+def make_transit_info(page, url, station_from, station_to, search_date_time, search_type,
+                      walk_speed=GV_WALK_SPEED, fields=None):
+    """検索結果ページから路線情報を抽出し、検索条件をあわせてキャッシュに保存する。
+
+    Parameters
+    ----------
+    page : bytes
+        検索結果ページ（HTML）。
+    url : str
+        検索結果ページのURL。
+    station_from, station_to, search_date_time, search_type, walk_speed
+        fetch_transit_info と同じ検索条件。
+    fields : dict, default None
+        受信しながら抽出した値（fetch_transit_page の結果）。
+
+    Returns
+    -------
+    transit_info : dict
+        路線情報。見つからない場合は None。
+    """
+    transit_info = parse_transit_info(page, max_routes=GV_MAX_ROUTES, fields=fields)
+    # 直後の検索で利用する場合があるため、以下の項目をセット
+    if transit_info is not None:
+        transit_info['stationFrom'] = station_from
+        transit_info['stationTo'] = station_to
+        transit_info['searchDateTime'] = format_search_datetime(search_date_time)
+        transit_info['searchType'] = search_type
+        transit_info['url'] = url
+        cache_key = make_cache_key(station_from, station_to, search_date_time, search_type, walk_speed)
+        cache_set(cache_key, transit_info, cache_ttl(search_date_time))
+        if search_type == '始発' or search_type == '終電':
+            timetable_set(transit_info, walk_speed)
+
+    return transit_info
+
+
+def fetch_adjacent_transit_info(url, operation='next', adjacent_url=None):
+    """引数で渡された URL（Yahoo路線の検索結果ページ）から、
+    "一本前"または"一本後"の路線情報を検索し、検索結果ページから路線情報を取得する。
+    直前の検索結果から"一本前"または"一本後"のリンクがわかっている場合は、
+    adjacent_url に指定すると、検索結果ページを再取得せずに済む。
+
+    Parameters
+    ----------
+    url : str
+        直前でフェッチしたYahoo路線検索結果ページのURL。
+    operation : str, default='next'
+        一本後の電車の場合 "next"、一本前の電車の場合 "prev" を指定
+    adjacent_url : str, default None
+        "一本前"または"一本後"の検索結果ページのパス（parse_transit_info で抽出した prevUrl, nextUrl）。
+
+    Returns
+    -------
+    transit_info : dict
+        路線情報。
+
+    See Also
+    --------
+    parse_transit_info : 検索結果ページから最初に見つかった路線情報を抽出する。
+    """
+    if adjacent_url is None:
+        from bs4 import BeautifulSoup
+        res = http_request('GET', url)
+        soup = BeautifulSoup(res.content, 'html.parser')
+        adjacent_url = soup.find(class_=operation).a.get('href')
+
+    # 先読み（prefetch_adjacent_transit_info）した結果があればそれを使い、先読み中ならその結果を待つ
+    cache_key = make_adjacent_cache_key(adjacent_url)
+    transit_info = cache_get(cache_key)
+    if transit_info is not None:
+        GV_PREFETCH_STATS['hit'] += 1
+        return transit_info
+    return run_once(cache_key, lambda: _fetch_adjacent_page(adjacent_url, cache_key))
+
+
+def make_adjacent_cache_key(adjacent_url):
+    """"一本前"、"一本後"の検索結果ページのパスから、キャッシュのキーを生成する。"""
+    return 'adjacent|' + adjacent_url
+
+
+def _fetch_adjacent_page(adjacent_url, cache_key):
+    res, page, fields = fetch_transit_page(GV_BASE_URL + adjacent_url)
+    transit_info = parse_transit_info(page, max_routes=GV_MAX_ROUTES, fields=fields)
+
+    # 直後の検索で利用する場合があるため、以下の項目をセット
+    if transit_info is not None:
+        transit_info['url'] = res.url
+        cache_set(cache_key, transit_info, GV_PREFETCH_TTL)
+
+    return transit_info
+
+
+GV_STREAM_STATS = {'requests': 0, 'aborted': 0, 'bytesRead': 0, 'bytesSkipped': 0}
+
+
+def fetch_transit_page(url, use_deadline=True, record_success=True, **kwargs):
+    """検索結果ページを取得する。GV_STREAM が有効で、解析方法が 'fast' の場合は、受信しながら解析し、
+    路線情報に必要な項目（GV_MAX_ROUTES 件のルートと、前後の電車へのリンク）がそろった時点で受信を打ち切る。
+    引数は http_request と同じ。
+
+    Returns
+    -------
+    res : requests.Response
+        レスポンス。
+    page : bytes
+        受信した（打ち切った場合はそこまでの）検索結果ページ。
+    fields : dict
+        受信しながら抽出した値（parse_transit_info に渡す）。受信しながら解析しない場合は None。
+    """
+    if not GV_STREAM or GV_PARSER != 'fast':
+        res = http_request('GET', url, use_deadline, record_success, **kwargs)
+        return res, res.content, None
+    res = http_request('GET', url, use_deadline, record_success, stream=True, **kwargs)
+    try:
+        page, fields = read_transit_page(res, GV_MAX_ROUTES)
+    except Exception:
+        # 本文の受信中の失敗（ChunkedEncodingError など）も、サーキットブレーカーに失敗として記録する
+        get_circuit_breaker(url.split('/', 3)[2]).record_failure()
+        raise
+    return res, page, fields
+
+
+def read_transit_page(res, max_routes=GV_MAX_ROUTES):
+    """ストリーミングで受信中の検索結果ページを、受信したチャンク毎に _RoutePageParser で解析する。
+    必要な項目がそろった時点で受信を打ち切り、残りが GV_STREAM_DRAIN_BYTES 以下なら読み切って接続を使い回す。
+    受信したバイト数（圧縮されている場合は圧縮後）は GV_STREAM_STATS と、リクエスト毎の計測値 bytesRead に加算する。
+
+    Parameters
+    ----------
+    res : requests.Response
+        stream=True で送信したリクエストのレスポンス。
+    max_routes : int, default GV_MAX_ROUTES
+        抽出するルートの最大数。
+
+    Returns
+    -------
+    page : bytes
+        受信した検索結果ページ。
+    fields : dict
+        抽出した値（_parse_page_fast の結果と同じ形式）。
+    """
+    parser = _RoutePageParser(max_routes)
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    chunks = []
+    complete = False
+    iterator = res.iter_content(GV_STREAM_CHUNK_SIZE)
+    try:
+        while not complete:
+            with measure_time('http'):
+                chunk = next(iterator, None)
+            with measure_time('parse'):
+                try:
+                    if chunk is None:
+                        parser.feed(decoder.decode(b'', True))
+                        parser.close()
+                        break
+                    chunks.append(chunk)
+                    parser.feed(decoder.decode(chunk))
+                except _StopParsing:
+                    complete = True
+    finally:
+        _finish_stream(res, complete)
+    return b''.join(chunks), parser.result()
+
+
+def _finish_stream(res, aborted):
+    bytes_read = res.raw.tell()
+    length = res.headers.get('Content-Length')
+    remaining = int(length) - bytes_read if length and length.isdigit() else None
+    if aborted and remaining is not None and 0 < remaining <= GV_STREAM_DRAIN_BYTES:
+        # 残りが少なければ読み切り、接続をコネクションプールに戻す
+        try:
+            with measure_time('http'):
+                for _ in res.iter_content(GV_STREAM_CHUNK_SIZE):
+                    pass
+            bytes_read, remaining = res.raw.tell(), 0
+        except Exception:
+            pass
+    res.close()
+
+    GV_STREAM_STATS['requests'] += 1
+    GV_STREAM_STATS['bytesRead'] += bytes_read
+    if aborted and remaining:
+        GV_STREAM_STATS['aborted'] += 1
+        GV_STREAM_STATS['bytesSkipped'] += remaining
+    metrics = getattr(GV_METRICS_LOCAL, 'metrics', None)
+    if metrics is not None:
+        metrics['bytesRead'] = metrics.get('bytesRead', 0) + bytes_read
+
+
+def parse_transit_info(page, parser=None, max_routes=1, fields=None):
+    """検索結果ページから、最初に見つかった路線情報を抽出する。
+    "一本前"、"一本後"の検索結果ページへのリンクもあわせて抽出する。
+
+    Parameters
+    ----------
+    page : str
+        直前でフェッチしたYahoo路線検索結果ページのHTMLソース。
+    parser : str, default None
+        解析方法（'fast', 'lxml', 'bs4'）。None の場合は GV_PARSER。
+    max_routes : int, default 1
+        抽出するルートの最大数。None の場合はページ内のすべてのルート。
+        抽出したルート（Route）は transit_info['routes'] に格納する。
+    fields : dict, default None
+        受信しながら抽出した値（fetch_transit_page の結果）。指定した場合は page を解析し直さない。
+        値から路線情報を作成できない場合は、page を 'bs4' で解析し直す。
+
+    Returns
+    -------
+    transit_info : dict
+        路線情報（最初のルート）。
+
+    See Also
+    --------
+    parse_routes : 検索結果ページから、すべてのルートを抽出する。
+    """
+    parser = parser or GV_PARSER
+    if parser == 'lxml':
+        try:
+            import lxml.html
+        except ImportError:
+            parser = 'fast'
+    parse = GV_PAGE_PARSERS.get(parser, _parse_page_bs4)
+
+    try:
+        if fields is None:
+            with measure_time('parse'):
+                fields = parse(page, max_routes)
+        routes = [_make_route(route_fields) for route_fields in fields['routes'][:max_routes]]
+        transit_info = routes[0].to_dict()
+        transit_info['prevUrl'] = fields['prevUrl']
+        transit_info['nextUrl'] = fields['nextUrl']
+        transit_info['routes'] = routes
+    except:
+        transit_info = None
+    if transit_info is None and parse is not _parse_page_bs4:
+        print('[WARN] Can not parse current pages with ' + parser + ' parser.')
+        return parse_transit_info(page, 'bs4', max_routes)
+    if transit_info is None:
+        print('[ERR] Can not parse current pages.')
+
+    return transit_info
+
+
+def parse_routes(page, parser=None):
+    """検索結果ページから、掲載されているすべてのルートを抽出する。
+
+    Parameters
+    ----------
+    page : str
+        直前でフェッチしたYahoo路線検索結果ページのHTMLソース。
+    parser : str, default None
+        解析方法（'fast', 'lxml', 'bs4'）。None の場合は GV_PARSER。
+
+    Returns
+    -------
+    routes : list of Route
+        ルートのリスト（ページの掲載順）。解析できない場合は空のリスト。
+    """
+    transit_info = parse_transit_info(page, parser, None)
+    return transit_info['routes'] if transit_info is not None else []
+
+
+def _make_route(fields):
+    """各解析方法で抽出した値から、1つのルートの路線情報を生成する。
+
+    Parameters
+    ----------
+    fields : dict
+        distance, fare, transfer（"乗換：1回"などのテキスト）, detail（routeDetailのテキスト）,
+        times（routeDetail内の各時刻の最初の値）。
+
+    Returns
+    -------
+    route : Route
+        ルート。
+    """
+    return Route.from_fields(fields)
+
+
+def _parse_page_bs4(page, max_routes=None):
+    """BeautifulSoup でページ全体を解析し、路線情報の元になる値を抽出する。"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(page, 'html.parser')
+    route_details = soup.find_all(class_='routeDetail', limit=max_routes)
+    summaries = dict((name, soup.find_all(class_=name, limit=max_routes)) for name in ['distance', 'fare', 'transfer'])
+    routes = []
+    for i, route_detail in enumerate(route_details):
+        routes.append({
+            'distance': summaries['distance'][i].get_text(),
+            'fare': summaries['fare'][i].get_text(),
+            'transfer': summaries['transfer'][i].get_text(),
+            'detail': route_detail.get_text(),
+            'times': [time_list.li.string for time_list in route_detail.find_all(class_='time')],
+        })
+    fields = {'routes': routes}
+    for operation in ['prev', 'next']:
+        nav = soup.find(class_=operation)
+        fields[operation + 'Url'] = nav.a.get('href') if nav is not None and nav.a is not None else None
+    return fields
+
+
+def _parse_page_lxml(page, max_routes=None):
+    """lxml でページ全体を解析し、路線情報の元になる値を抽出する。"""
+    import lxml.html
+
+    def xpath_class(name):
+        return './/*[contains(concat(" ", normalize-space(@class), " "), " ' + name + ' ")]'
+
+    root = lxml.html.fromstring(page)
+    route_details = root.xpath(xpath_class('routeDetail'))[:max_routes]
+    summaries = dict((name, root.xpath(xpath_class(name))) for name in ['distance', 'fare', 'transfer'])
+    routes = []
+    for i, route_detail in enumerate(route_details):
+        routes.append({
+            'distance': summaries['distance'][i].text_content(),
+            'fare': summaries['fare'][i].text_content(),
+            'transfer': summaries['transfer'][i].text_content(),
+            'detail': route_detail.text_content(),
+            'times': [time_list.find('.//li').text_content() for time_list in route_detail.xpath(xpath_class('time'))],
+        })
+    fields = {'routes': routes}
+    for operation in ['prev', 'next']:
+        anchors = root.xpath(xpath_class(operation) + '//a')
+        fields[operation + 'Url'] = anchors[0].get('href') if anchors else None
+    return fields
+
+
+class _StopParsing(Exception):
+    """必要な項目がそろったため、解析を打ち切る。"""
+
+
+class _RoutePageParser(HTMLParser):
+    """検索結果ページから、路線情報に必要な要素だけを逐次抽出するパーサー。
+    max_routes 件の routeDetail と、距離、料金、乗り換え回数、前後の電車へのリンクが
+    そろった時点で解析を打ち切る。
+    """
+
+    # -- 終了タグを持たない要素
+    VOID_ELEMENTS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                               'link', 'meta', 'param', 'source', 'track', 'wbr'])
+    SUMMARY_CLASSES = ('distance', 'fare', 'transfer')
+    NAV_CLASSES = ('prev', 'next')
+
+    def __init__(self, max_routes=None):
+        HTMLParser.__init__(self)
+        self.max_routes = max_routes
+        self.fields = {'prevUrl': None, 'nextUrl': None}
+        self.summaries = dict((name, []) for name in self.SUMMARY_CLASSES)
+        self.details = []
+        self.nav_found = set()
+        self.stack = []
+        # -- テキストを収集中の要素: [(スタック上の位置, 収集したテキスト, 収集完了時の処理)]
+        self.captures = []
+        self.detail = None
+        self.time_depth = None
+        self.nav_waiting = None
+
+    def handle_starttag(self, tag, attrs):
+        classes = []
+        for name, value in attrs:
+            if name == 'class' and value:
+                classes = value.split()
+        depth = len(self.stack)
+        if tag not in self.VOID_ELEMENTS:
+            self.stack.append(tag)
+
+        if tag == 'a' and self.nav_waiting is not None:
+            self.fields[self.nav_waiting + 'Url'] = dict(attrs).get('href')
+            self.nav_found.add(self.nav_waiting)
+            self.nav_waiting = None
+        for name in self.NAV_CLASSES:
+            if name in classes and name not in self.nav_found:
+                self.nav_waiting = name
+
+        if not classes and self.time_depth is None:
+            return
+        for name in self.SUMMARY_CLASSES:
+            if name in classes and not self._has_enough(self.summaries[name]):
+                self._capture(depth, self.summaries[name].append)
+
+        if self.detail is None:
+            if 'routeDetail' in classes and not self._has_enough(self.details):
+                self.detail = {'times': []}
+                self._capture(depth, self._set_detail)
+        elif 'time' in classes:
+            self.time_depth = depth
+        elif tag == 'li' and self.time_depth is not None:
+            self.time_depth = None
+            self._capture(depth, self.detail['times'].append)
+
+    def handle_endtag(self, tag):
+        if tag not in self.stack:
+            return
+        depth = len(self.stack) - 1 - self.stack[::-1].index(tag)
+        del self.stack[depth:]
+        if self.time_depth is not None and self.time_depth >= depth:
+            self.time_depth = None
+        while self.captures and self.captures[-1][0] >= depth:
+            _, texts, callback = self.captures.pop()
+            callback(''.join(texts))
+        if self._is_complete():
+            raise _StopParsing()
+
+    def handle_data(self, data):
+        for _, texts, _ in self.captures:
+            texts.append(data)
+
+    def _capture(self, depth, callback):
+        self.captures.append((depth, [], callback))
+
+    def _set_detail(self, text):
+        self.detail['detail'] = text
+        self.details.append(self.detail)
+        self.detail = None
+
+    def _has_enough(self, values):
+        return self.max_routes is not None and len(values) >= self.max_routes
+
+    def _is_complete(self):
+        return self._has_enough(self.details) and \
+            all(self._has_enough(self.summaries[name]) for name in self.SUMMARY_CLASSES) and \
+            len(self.nav_found) == len(self.NAV_CLASSES)
+
+    def result(self):
+        routes = []
+        for i, detail in enumerate(self.details):
+            route = dict((name, self.summaries[name][i]) for name in self.SUMMARY_CLASSES)
+            route.update(detail)
+            routes.append(route)
+        fields = dict(self.fields)
+        fields['routes'] = routes
+        return fields
+
+
+def _parse_page_fast(page, max_routes=None):
+    """必要な要素だけを逐次抽出し、路線情報の元になる値を抽出する。"""
+    if isinstance(page, bytes):
+        page = page.decode('utf-8', 'replace')
+    parser = _RoutePageParser(max_routes)
+    try:
+        parser.feed(page)
+        parser.close()
+    except _StopParsing:
+        pass
+    return parser.result()
+
+
+GV_PAGE_PARSERS = {
+    'fast': _parse_page_fast,
+    'lxml': _parse_page_lxml,
+    'bs4': _parse_page_bs4,
+}
+
+
+def make_transit_message(transit_info):
+    with measure_time('message'):
+        return _make_transit_message(transit_info)
+
+
+def _make_transit_message(transit_info):
+    """路線情報に関するAlexa応答メッセージを生成する。
+
+    Parameters
+    ----------
+    transit_info : dict
+        路線情報。
+
+    Returns
+    -------
+    msg : str
+        Alexa応答メッセージ。
+    """
+    if transit_info is None:
+        return GV_MSG_ERROR
+    transport = transit_info['transport']
+    transfer = transit_info['transfer']
+    return GV_MSG_ROUTE % (
+        transit_info['startTime'], transit_info['stationFrom'],
+        transport + 'き' if transport.endswith('行') else transport,
+        transit_info['arrivalTime'], transit_info['stationTo'], transit_info['fare'],
+        GV_MSG_NO_TRANSFER if transfer == '0' else GV_MSG_TRANSFER % transfer)
+
+
+def make_search_result(transit_info):
+    """セッションに保存する検索結果テキストを生成する。
+    並べ替えたルートの場合は、先頭に並べ替えの順序を付ける。
+
+    Parameters
+    ----------
+    transit_info : dict
+        路線情報。
+
+    Returns
+    -------
+    msg : str
+        検索結果テキスト。
+    """
+    msg = make_transit_message(transit_info)
+    if transit_info.get('order'):
+        msg = transit_info['order'] + 'では、' + msg
+    return msg
+
+
+def update_session_attributes(session_attributes, transit_info):
+    """第1引数の既存セッションに、第2引数の路線情報（検索条件、検索結果）を追加・上書きする。
 
+    Parameters
+    ----------
+    session_attributes : dict
+        既存のセッション情報。
+    transit_info : dict
+        路線情報（検索条件、検索結果）
+    """
+    save_keys = ['stationFrom', 'stationTo', 'url', 'searchDateTime', 'searchType', 'searchResult',
+                 'prevUrl', 'nextUrl', 'position', 'order'] + GV_ROUTE_KEYS
+    for key in save_keys:
+        session_attributes[key] = transit_info.get(key)
+    # 同じ検索結果ページに掲載された他のルート（並べ替えに利用）
+    routes = transit_info.get('routes')
+    session_attributes['routes'] = [route.to_values() for route in routes] if routes else None
 
-# --------------- Functions that control the skill's behavior ------------------
 
-def get_welcome_response():
-    """ If we wanted to initialize the session to have some attributes we could
-    add those here
-    """
-    session_attributes = {}
-    card_title = 'Welcome'
-    should_end_session = False
+def _compact_url(url):
+    if url is not None and url.startswith(GV_BASE_URL + '/'):
+        return url[len(GV_BASE_URL):]
+    return url
 
-    speech_output = GV_MSG_PROMPT1
-    # If the user either does not reply to the welcome message or says something
-    # that is not understood, they will be prompted again with this text.
-    reprompt_text = GV_MSG_REPROMPT1
 
-    return build_response(session_attributes, build_speechlet_response(
-        card_title, speech_output, reprompt_text, should_end_session))
+def _expand_url(url):
+    if url is not None and url.startswith('/'):
+        return GV_BASE_URL + url
+    return url
 
 
-def handle_session_end_request():
-    card_title = 'Session Ended'
-    speech_output = GV_MSG_EXIT
-    # Setting this to true ends the session and exits the skill.
-    should_end_session = True
-    return build_response({}, build_speechlet_response(
-        card_title, speech_output, None, should_end_session))
+def _compact_adjacent_url(prev_url, next_url):
+    """"一本後"のURLのうち、"一本前"のURLと共通の先頭部分を、その文字数 [文字数, 残り] にする。"""
+    if prev_url is None or next_url is None:
+        return next_url
+    length = len(os.path.commonprefix([prev_url, next_url]))
+    return [length, next_url[length:]] if length > 0 else next_url
 
 
-def handle_error_exit(session):
-    card_title = 'Error Exit'
-    speech_output = GV_MSG_ERROR_EXIT
-    # Setting this to true ends the session and exits the skill.
-    should_end_session = True
-    return build_response({}, build_speechlet_response(
-        card_title, speech_output, None, should_end_session))
+def _expand_adjacent_url(prev_url, next_url):
+    if isinstance(next_url, list):
+        return prev_url[:next_url[0]] + next_url[1]
+    return next_url
 
 
-def fetch_transit_info(station_from, station_to, search_date_time, search_type, walk_speed=GV_WALK_SPEED):
-    """Yahoo路線のWebサイトで、指定した条件で路線情報を検索し、検索結果ページから路線情報を取得する。
+def encode_session_state(session_attributes):
+    """セッション情報を、Alexaの応答に含める小さな形式（state）に変換する。
+    検索条件は [出発駅, 到着駅, yyyymmddHHMM, タイプ] に、路線情報は値のリストにまとめる。
+    検索結果テキストと検索結果ページのURLは、検索条件と路線情報から再生成できる場合は保存しない。
+    同じ検索結果ページの他のルート（routes）、履歴（history）は、現在のルートと同じものを重複して保存しない。
+    対象外の項目（通知済みのキーなど）はそのまま残す。
 
     Parameters
     ----------
-    station_from : str
-        出発駅。
-    station_to : str
-        到着駅。
-    search_date_time : str
-        yyyy-mm-dd HH:MM形式の日時文字列。
-    search_type : str
-        '出発', '到着', '始発', '終電'
-    walk_speed : int, default GV_WALK_SPEED
-        歩く速度（1, 2, 3, 4）。
+    session_attributes : dict
+        セッション情報。
 
     Returns
     -------
-    transit_info : dict
-        路線情報。
+    encoded : dict
+        Alexaの応答の sessionAttributes。
 
     See Also
     --------
-    parse_transit_info : 検索結果ページから最初に見つかった路線情報を抽出する。
+    decode_session_state : encode_session_state で変換したセッション情報を元に戻す。
     """
-    dt = re.split('[- :]', search_date_time)
-    if search_type == '出発':
-        search_type_code = GV_TYPE_DEPARTURE
-    elif search_type == '到着':
-        search_type_code = GV_TYPE_ARRIVE
-    elif search_type == '始発':
-        search_type_code = GV_TYPE_FIRST
-    elif search_type == '終電':
-        search_type_code = GV_TYPE_LAST
-    else:
-        search_type_code = GV_TYPE_ARRIVE
+    attributes = dict(session_attributes)
+    values = dict((key, attributes.pop(key, None)) for key in GV_SESSION_STATE_KEYS)
+    values['history'] = values['history'] or None
+    if all(value is None for value in values.values()):
+        return attributes
 
-    payload = {
-        'from': station_from,
-        'to': station_to,
-        'y': dt[0],
-        'm': dt[1],
-        'd': dt[2],
-        'hh': dt[3],
-        'm2': dt[4][1],
-        'm1': dt[4][0],
-        'type': search_type_code,
-        'expkind': 1,
-        'ws': walk_speed,
-        's': 0,
-        'lb': 1,
-        'kw': station_to
-    }
-    res = requests.get(GV_SEARCH_URL, params=payload)
-    transit_info = parse_transit_info(res.content)
-    # 直後の検索で利用する場合があるため、以下の項目をセット
-    if transit_info is not None:
-        transit_info['stationFrom'] = station_from
-        transit_info['stationTo'] = station_to
-        transit_info['searchDateTime'] = search_date_time
-        transit_info['searchType'] = search_type
-        transit_info['url'] = res.url
+    state = {'v': GV_SESSION_STATE_VERSION}
+    query = [values['stationFrom'], values['stationTo']]
+    search_date_time, search_type = values['searchDateTime'], values['searchType']
+    if search_date_time is not None or search_type is not None:
+        if search_date_time is not None and re.match(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}$', search_date_time):
+            search_date_time = re.sub(r'\D', '', search_date_time)
+        query += [search_date_time, GV_SEARCH_TYPES.get(search_type, search_type)]
+    state['q'] = query
 
-    return transit_info
+    route = [values[key] for key in GV_ROUTE_KEYS]
+    if any(value is not None for value in route):
+        state['c'] = route
+    if values['order'] is not None:
+        state['o'] = values['order']
+    if values['position']:
+        state['p'] = values['position']
+    if values['prevUrl'] is not None or values['nextUrl'] is not None:
+        state['n'] = [values['prevUrl'], _compact_adjacent_url(values['prevUrl'], values['nextUrl'])]
+    if values['routes'] is not None:
+        # 現在のルートは c に保存済みのため除き、routes 内の位置（0 以外の場合）だけを保存する
+        routes = list(values['routes'])
+        index = routes.index(route) if route in routes else -1
+        if index >= 0:
+            del routes[index]
+        if index != 0:
+            state['ri'] = index
+        state['r'] = routes
+    # 再生成できない場合のみ保存する
+    decoded = decode_session_state({'state': state})
+    if values['url'] != decoded.get('url'):
+        state['u'] = _compact_url(values['url'])
+    if values['history'] is not None:
+        current = [values['url']] + route + [values['prevUrl'], values['nextUrl']]
+        state['h'] = _encode_history(values['history'], make_state_search_url(decoded, state),
+                                     str(values['position'] or 0), current)
+    if values['searchResult'] != decoded.get('searchResult'):
+        state['s'] = values['searchResult']
 
+    attributes['state'] = state
+    return attributes
 
-def fetch_adjacent_transit_info(url, operation='next'):
-    """引数で渡された URL（Yahoo路線の検索結果ページ）から、
-    "一本前"または"一本後"の路線情報を検索し、検索結果ページから路線情報を取得する。
+
+def decode_session_state(session_attributes):
+    """encode_session_state で変換したセッション情報を元に戻す。
+    state を含まない（以前の形式の）セッション情報はそのまま返す。
 
     Parameters
     ----------
-    url : str
-        直前でフェッチしたYahoo路線検索結果ページのURL。
-    operation : str, default='next'
-        一本後の電車の場合 "next"、一本前の電車の場合 "prev" を指定
+    session_attributes : dict
+        Alexaのリクエストの sessionAttributes。
 
     Returns
     -------
-    transit_info : dict
-        路線情報。
+    decoded : dict
+        セッション情報。
+    """
+    attributes = dict(session_attributes)
+    state = attributes.pop('state', None)
+    if state is None:
+        return attributes
+    if state.get('v') != GV_SESSION_STATE_VERSION:
+        print('[WARN] Unknown session state version: ' + repr(state.get('v')))
+        return attributes
 
-    See Also
-    --------
-    parse_transit_info : 検索結果ページから最初に見つかった路線情報を抽出する。
+    query = state['q']
+    attributes['stationFrom'], attributes['stationTo'] = query[0], query[1]
+    if len(query) > 2:
+        search_date_time, search_type = query[2], query[3]
+        if search_date_time is not None and re.match(r'^\d{12}$', search_date_time):
+            search_date_time = '%s-%s-%s %s:%s' % (search_date_time[0:4], search_date_time[4:6], search_date_time[6:8],
+                                                   search_date_time[8:10], search_date_time[10:12])
+        for name, code in GV_SEARCH_TYPES.items():
+            if code == search_type:
+                search_type = name
+        attributes['searchDateTime'], attributes['searchType'] = search_date_time, search_type
+    if 'c' in state:
+        attributes.update(zip(GV_ROUTE_KEYS, state['c']))
+    if 'o' in state:
+        attributes['order'] = state['o']
+    attributes['position'] = state.get('p', 0)
+    if 'n' in state:
+        attributes['prevUrl'] = state['n'][0]
+        attributes['nextUrl'] = _expand_adjacent_url(state['n'][0], state['n'][1])
+    if 'r' in state:
+        routes = list(state['r'])
+        if state.get('ri', 0) >= 0 and 'c' in state:
+            routes.insert(state.get('ri', 0), state['c'])
+        attributes['routes'] = routes
+
+    search_url = make_state_search_url(attributes, state)
+    if 'u' in state:
+        attributes['url'] = _expand_url(state['u'])
+    elif attributes['position'] == 0 and search_url is not None:
+        attributes['url'] = search_url
+    if 'h' in state:
+        current = [attributes.get('url')] + [attributes.get(key) for key in GV_ROUTE_KEYS] + \
+            [attributes.get('prevUrl'), attributes.get('nextUrl')]
+        attributes['history'] = _decode_history(state['h'], search_url, current)
+    if 's' in state:
+        attributes['searchResult'] = state['s']
+    elif 'c' in state and None not in state['c']:
+        attributes['searchResult'] = make_search_result(attributes)
+    return attributes
+
+
+def make_state_search_url(attributes, state):
+    """state から元に戻したセッション情報の検索条件で、検索結果ページのURLを生成する。路線情報がない場合は None。"""
+    if attributes.get('searchDateTime') is None or 'c' not in state:
+        return None
+    return build_search_url(attributes['stationFrom'], attributes['stationTo'], attributes['searchDateTime'],
+                            attributes['searchType'])
+
+
+def _history_url_candidate(history, position, search_url):
+    """履歴の検索位置 position のURLを、検索条件、または隣の検索位置のリンクから求める。"""
+    if position == 0 and search_url is not None:
+        return search_url
+    previous = history.get(str(position - 1))
+    if previous is not None and previous[-1] is not None:
+        return _expand_url(previous[-1])
+    following = history.get(str(position + 1))
+    if following is not None and following[-2] is not None:
+        return _expand_url(following[-2])
+    return None
+
+
+def _encode_history(history, search_url, current_position, current):
+    """履歴のURLのうち、検索条件、または隣の検索位置のリンクから求められるものを None にし、
+    "一本後"のリンクは "一本前"のリンクとの差分にする。
+    現在の検索位置の履歴が現在の路線情報（current）と同じ場合は、複製せずに None にする。
     """
-    res = requests.get(url)
-    soup = BeautifulSoup(res.content, 'html.parser')
+    encoded = {}
+    for position, values in history.items():
+        if position == current_position and list(values) == current:
+            encoded[position] = None
+            continue
+        url = values[0]
+        if url is not None and url == _history_url_candidate(history, int(position), search_url):
+            url = None
+        encoded[position] = [_compact_url(url)] + values[1:-1] + [_compact_adjacent_url(values[-2], values[-1])]
+    return encoded
 
-    next_url = soup.find(class_=operation).a.get('href')
-    res = requests.get(GV_BASE_URL + next_url)
-    transit_info = parse_transit_info(res.content)
 
-    # 直後の検索で利用する場合があるため、以下の項目をセット
-    if transit_info is not None:
-        transit_info['url'] = res.url
+def _decode_history(history, search_url, current):
+    # None の履歴は、現在の路線情報を指す
+    history = dict((position, list(current) if values is None else
+                    values[:-1] + [_expand_adjacent_url(values[-2], values[-1])])
+                   for position, values in history.items())
+    decoded = {}
+    for position, values in history.items():
+        url = _expand_url(values[0])
+        if url is None:
+            url = _history_url_candidate(history, int(position), search_url)
+        decoded[position] = [url] + values[1:]
+    return decoded
 
-    return transit_info
 
+def load_session_attributes(session):
+    """Alexaのリクエストのセッションから、セッション情報を取り出す。"""
+    return decode_session_state(session.get('attributes') or {})
 
-def parse_transit_info(page):
-    """検索結果ページから、最初に見つかった路線情報を抽出する。
+
+def save_history(session_attributes, transit_info, position):
+    """前後の電車を検索した結果を、検索位置（最初の検索結果を 0 とした何本後か）をキーにセッションに保存する。
+    "前の電車"、"次の電車"を繰り返した場合に、保存済みの結果を再利用する。
 
     Parameters
     ----------
-    page : str
-        直前でフェッチしたYahoo路線検索結果ページのHTMLソース。
-
-    Returns
-    -------
+    session_attributes : dict
+        既存のセッション情報。
     transit_info : dict
-        路線情報。
+        路線情報（検索結果）
+    position : int
+        検索位置。
     """
-    transit_info = {}
-    soup = BeautifulSoup(page, 'html.parser')
-    try:
-        route_detail = soup.find(class_='routeDetail')
-        transit_info['distance'] = soup.find(class_='distance').get_text()
-        transit_info['fare'] = soup.find(class_='fare').get_text()
-        transit_info['transfer'] = re.search(r'\d', soup.find(class_='transfer').get_text())[0]
-        transport = [
-            line for line in
-            re.split(r'\r\n|\r|\n', route_detail.get_text()) if re.match(r'\[train\]|\[bus\]', line)
-        ][0]
-        transit_info['transport'] = re.split(r'\]', transport)[1]
-        transit_info['startTime'] = route_detail.find(class_='time').li.string
-        transit_info['arrivalTime'] = route_detail.find_all(class_='time')[-1].li.string
-    except:
-        transit_info = None
-        print('[ERR] Can not parse current pages.')
-
-    return transit_info
+    history = session_attributes.get('history') or {}
+    history[str(position)] = [transit_info.get(key) for key in GV_HISTORY_KEYS]
+    # 現在の検索位置から遠いものから削除
+    for key in sorted(history, key=lambda k: abs(int(k) - position))[GV_HISTORY_SIZE:]:
+        del history[key]
+    session_attributes['history'] = history
 
 
-def make_transit_message(transit_info):
-    """路線情報に関するAlexa応答メッセージを生成する。
+def load_history(session_attributes, position):
+    """セッションに保存した、指定した検索位置の路線情報を取り出す。
 
     Parameters
     ----------
-    transit_info : dict
-        路線情報。
+    session_attributes : dict
+        既存のセッション情報。
+    position : int
+        検索位置。
 
     Returns
     -------
-    msg : str
-        Alexa応答メッセージ。
+    transit_info : dict
+        路線情報。保存されていない場合は None。
     """
-    if transit_info is not None:
-        msg = \
-            transit_info['startTime'] + 'に' + transit_info['stationFrom'] + 'を発車する、' + \
-            transit_info['transport'] + 'に乗車すると、' + transit_info['arrivalTime'] + 'に' + \
-            transit_info['stationTo'] + 'に到着します。' + \
-            '料金は' + transit_info['fare'] + 'で、' + transit_info['transfer'] + '回の乗り換えがあります。'
-        msg = msg.replace('行に', '行きに').replace('0回の乗り換えがあります。', '乗り換えはありません。')
-    else:
-        msg = GV_MSG_ERROR
-    return msg
+    values = (session_attributes.get('history') or {}).get(str(position))
+    if values is None:
+        return None
+    return dict(zip(GV_HISTORY_KEYS, values))
 
 
-def update_session_attributes(session_attributes, transit_info):
-    """第1引数の既存セッションに、第2引数の路線情報（検索条件、検索結果）を追加・上書きする。
+# -- 前後の電車を先読みするスレッドプール（get_prefetch_executor）
+GV_PREFETCH_EXECUTOR = None
+GV_PREFETCH_STATS = {'fetched': 0, 'hit': 0, 'failed': 0}
+
+
+def get_prefetch_executor():
+    """先読みに使うスレッドプールを返す。初回呼び出し時に作成する。"""
+    global GV_PREFETCH_EXECUTOR
+    if GV_PREFETCH_EXECUTOR is None:
+        GV_PREFETCH_EXECUTOR = futures.ThreadPoolExecutor(max_workers=GV_PREFETCH_WORKERS)
+    return GV_PREFETCH_EXECUTOR
+
+
+def prefetch_adjacent_transit_info(transit_info):
+    """一本前、一本後の路線情報を、応答を待たせずにバックグラウンドで検索し、
+    "一本前"、"一本後"の検索結果ページのパスをキーに検索結果キャッシュ（共有キャッシュを含む）に保存する
+    （GV_PREFETCH が有効な場合のみ）。続く"前の電車"、"次の電車"は、fetch_adjacent_transit_info がキャッシュから応答する。
+    Lambdaでは先読みしない。応答するとコンテナが停止するため、先読みが終わらないか、
+    次の呼び出しで再開してその処理時間を使ってしまう（応答前に待つと、先読みの意味がなくなる）。
 
     Parameters
     ----------
-    session_attributes : dict
-        既存のセッション情報。
     transit_info : dict
-        路線情報（検索条件、検索結果）
+        直前に応答した路線情報（prevUrl, nextUrl）。
     """
-    save_keys = ['stationFrom', 'stationTo', 'url', 'searchDateTime', 'searchType', 'searchResult']
-    for key in save_keys:
-        session_attributes[key] = transit_info.get(key)
+    if not GV_PREFETCH or GV_ON_LAMBDA:
+        return
+    executor = get_prefetch_executor()
+    for operation in ['next', 'prev']:
+        adjacent_url = transit_info.get(operation + 'Url')
+        if adjacent_url:
+            executor.submit(_prefetch_adjacent_page, adjacent_url)
+
+
+def _prefetch_adjacent_page(adjacent_url):
+    cache_key = make_adjacent_cache_key(adjacent_url)
+    try:
+        if cache_get(cache_key) is not None:
+            return
+        if run_once(cache_key, lambda: _fetch_adjacent_page(adjacent_url, cache_key)) is not None:
+            GV_PREFETCH_STATS['fetched'] += 1
+    except Exception as e:
+        GV_PREFETCH_STATS['failed'] += 1
+        print('[WARN] Prefetch failed: ' + repr(e))
 
 
 def intent_SetStation(intent, session):
@@ -304,12 +3715,28 @@ def intent_SetStation(intent, session):
     """
     card_title = intent['name']
     should_end_session = False
-    session_attributes = session['attributes'] if 'attributes' in session else {}
+    session_attributes = load_session_attributes(session)
 
     try:
-        # 検索条件をセッションに保存
+        # 駅名を正式な駅名に変換（索引にない駅名は、GV_STATION_STRICT の場合は聞き返し、それ以外はそのまま使う）
+        # 似た駅名は、別の駅の場合があるため置き換えずに提案だけする
         station_from = intent['slots']['StationFrom']['value']
         station_to = intent['slots']['StationTo']['value']
+        resolved_from = resolve_station_name(station_from)
+        resolved_to = resolve_station_name(station_to)
+        unknown = station_from if resolved_from is None else station_to if resolved_to is None else None
+        suggestion = suggest_station_name(unknown) if unknown is not None else None
+        if GV_STATION_STRICT and unknown is not None:
+            speech_output = unknown + 'が見つかりませんでした。'
+            if suggestion is not None:
+                speech_output += suggestion + 'ではありませんか。'
+            speech_output += GV_MSG_REPROMPT1
+            return build_response(session_attributes, build_speechlet_response(
+                card_title, speech_output, GV_MSG_REPROMPT1, should_end_session))
+
+        # 検索条件をセッションに保存
+        station_from = resolved_from or station_from
+        station_to = resolved_to or station_to
         transit_info = {
             'stationFrom': station_from,
             'stationTo': station_to}
@@ -318,6 +3745,9 @@ def intent_SetStation(intent, session):
         # 次の検索条件を質問
         speech_output = GV_MSG_PROMPT2
         reprompt_text = GV_MSG_REPROMPT2
+        if suggestion is not None:
+            speech_output = unknown + 'のまま検索します。' + suggestion + 'の場合は、もう一度駅名を教えてください。' + \
+                speech_output
     except:
         # 現在の検索条件を再度質問
         speech_output = GV_MSG_ERROR
@@ -329,28 +3759,27 @@ def intent_SetStation(intent, session):
 
 def convert_duration_to_datetime(duration):
     """現在時刻から指定した期間が経過した後の日時(文字列)を返す。
-    期間は時、分のみを変換処理し、変換できない場合は現在日時を返す。
+    変換できない場合は現在日時を返す。
 
     Parameters
     ----------
     duration : str
-        ISO-8601期間形式(PnYnMnDTnHnMnS)の期間。
+        ISO-8601期間形式(PnYnMnWnDTnHnMnS)の期間。
 
     Returns
     -------
     converted_datetime : str
         yyyy-mm-dd HH:MM形式の日時文字列。
-    """
-    delta_hours = re.sub(r'^P.*T(\d+)H.*', r'\1', duration)
-    delta_minutes = re.sub(r'^P.*[TH](\d+)M.*', r'\1', duration)
-
-    converted_datetime = datetime.now(timezone(timedelta(hours=+9), 'JST'))
-    if delta_hours[0] != 'P':
-        converted_datetime = converted_datetime + timedelta(hours=int(delta_hours))
-    if delta_minutes[0] != 'P':
-        converted_datetime = converted_datetime +  timedelta(minutes=int(delta_minutes))
 
-    return converted_datetime.strftime('%Y-%m-%d %H:%M')
+    See Also
+    --------
+    add_duration : 日時に期間を加える。
+    """
+    now = datetime.now(GV_TZ_JST)
+    try:
+        return format_search_datetime(add_duration(now, duration))
+    except ValueError:
+        return format_search_datetime(now)
 
 
 def intent_SetDateTime(intent, session):
@@ -360,40 +3789,19 @@ def intent_SetDateTime(intent, session):
     """
     card_title = intent['name']
     should_end_session = False
-    session_attributes = session['attributes'] if 'attributes' in session else {}
+    session_attributes = load_session_attributes(session)
 
     try:
-        # 検索条件を設定
-        if 'value' in intent['slots']['Date']:
-            search_date = intent['slots']['Date']['value']
-
-            # 例）2018-06-01 の 23:59 に到着
-            if 'value' in intent['slots']['Time']:
-                search_time = intent['slots']['Time']['value']
-            # 例）2018-06-01 の始発
-            else:
-                search_time = '00:00'
-
-            search_date_time = search_date + ' ' + search_time
-        else:
-            # 例）30分後に出発
-            search_date_time = convert_duration_to_datetime(intent['slots']['Duration']['value'])
-
+        # 検索条件を設定（例: 2018-06-01 の 23:59 に到着、2018-06-01 の始発、30分後に出発）
+        search_dt = resolve_search_datetime(intent['slots'])
         search_type = intent['slots']['Type']['value']
 
         # 路線情報を検索し、検索結果テキストを生成
         station_from = session_attributes['stationFrom']
         station_to = session_attributes['stationTo']
-        transit_info = fetch_transit_info(station_from, station_to, search_date_time, search_type, GV_WALK_SPEED)
-        speech_output = make_transit_message(transit_info)
+        speech_output = search_and_save(session_attributes, session, station_from, station_to, search_dt,
+                                        search_type)
         reprompt_text = GV_MSG_PROMPT_LAST
-
-        # 検索結果をセッションに保存
-        if transit_info is not None:
-            transit_info['searchResult'] = speech_output
-            update_session_attributes(session_attributes, transit_info)
-        else:
-            raise Exception
     except:
         # 現在の検索条件を再度質問
         speech_output = GV_MSG_ERROR
@@ -403,29 +3811,81 @@ def intent_SetDateTime(intent, session):
         card_title, speech_output, reprompt_text, should_end_session))
 
 
+def get_transit_client():
+    """インテントの処理で使う、fetch_transit_info と fetch_adjacent_transit_info を持つモジュールを返す。
+    GV_ASYNC_CLIENT が有効な場合は yahoo_transit_async（ヘッジリクエストを使う）、それ以外はこのモジュール。
+    """
+    if GV_ASYNC_CLIENT:
+        import yahoo_transit_async
+        return yahoo_transit_async
+    return sys.modules[__name__]
+
+
+def search_and_save(session_attributes, session, station_from, station_to, search_date_time, search_type):
+    """路線情報を検索して検索結果テキストを生成し、検索条件、検索結果をセッションと通勤プロファイルに保存する。
+
+    Returns
+    -------
+    speech_output : str
+        検索結果テキスト。
+
+    Raises
+    ------
+    Exception
+        路線情報が見つからない場合。
+    """
+    with progressive_response():
+        transit_info = get_transit_client().fetch_transit_info(station_from, station_to, search_date_time,
+                                                               search_type, GV_WALK_SPEED)
+    if transit_info is None:
+        raise Exception('No route found')
+    speech_output = make_transit_message(transit_info)
+
+    # 検索結果をセッションに保存
+    transit_info['searchResult'] = speech_output
+    if transit_info.get('stale'):
+        speech_output = GV_MSG_STALE + speech_output
+    transit_info['position'] = 0
+    update_session_attributes(session_attributes, transit_info)
+    session_attributes['history'] = {}
+    save_history(session_attributes, transit_info, 0)
+    record_commute_search(session, transit_info)
+    prefetch_adjacent_transit_info(transit_info)
+    return speech_output
+
+
 def intent_NextPrevious(intent, session, operation='next'):
     """インテント[AMAZON.NextIntent / Amazon.PreviousIntent]
     ③１本前(previous)または１本後(next)の路線情報を検索する
     """
     card_title = intent['name']
     should_end_session = False
-    session_attributes = session['attributes'] if 'attributes' in session else {}
+    session_attributes = load_session_attributes(session)
 
     try:
-        # 路線情報を検索し、検索結果テキストを生成
-        url = session_attributes['url']
-        transit_info = fetch_adjacent_transit_info(url, operation)
-        transit_info['stationFrom'] = session_attributes['stationFrom']
-        transit_info['stationTo'] = session_attributes['stationTo']
+        # 保存済みの検索結果がなければ、路線情報を検索する
+        position = (session_attributes.get('position') or 0) + (1 if operation == 'next' else -1)
+        transit_info = load_history(session_attributes, position)
+        if transit_info is None:
+            url = session_attributes['url']
+            with progressive_response():
+                transit_info = get_transit_client().fetch_adjacent_transit_info(
+                    url, operation, session_attributes.get(operation + 'Url'))
+        if transit_info is None:
+            raise Exception
+
+        # 検索結果テキストを生成
+        for key in ['stationFrom', 'stationTo', 'searchDateTime', 'searchType']:
+            transit_info[key] = session_attributes.get(key)
         speech_output = make_transit_message(transit_info)
         reprompt_text = GV_MSG_PROMPT_LAST
 
         # 検索結果をセッションに保存
-        if transit_info is not None:
-            transit_info['searchResult'] = speech_output
-            update_session_attributes(session_attributes, transit_info)
-        else:
-            raise Exception
+        transit_info['searchResult'] = speech_output
+        transit_info['position'] = position
+        update_session_attributes(session_attributes, transit_info)
+        save_history(session_attributes, transit_info, position)
+        prefetch_adjacent_transit_info(transit_info)
     except:
         speech_output = GV_MSG_ERROR
         reprompt_text = GV_MSG_REPROMPT3
@@ -437,13 +3897,99 @@ def intent_NextPrevious(intent, session, operation='next'):
         card_title, speech_output, reprompt_text, should_end_session))
 
 
+def fetch_page_routes(session_attributes):
+    """セッションの検索結果ページに掲載されたルートを取得する。
+    最初の検索結果は検索条件で、前後の電車は検索結果ページのURLで、キャッシュにない場合は検索し直す。
+
+    Parameters
+    ----------
+    session_attributes : dict
+        既存のセッション情報。
+
+    Returns
+    -------
+    routes : list of Route
+        ルートのリスト（ページの掲載順）。
+    """
+    if not session_attributes.get('position'):
+        transit_info = fetch_transit_info(session_attributes['stationFrom'], session_attributes['stationTo'],
+                                          session_attributes['searchDateTime'], session_attributes['searchType'],
+                                          GV_WALK_SPEED)
+    else:
+        url = _compact_url(session_attributes['url'])
+        if url.startswith('/'):
+            cache_key = make_adjacent_cache_key(url)
+            transit_info = cache_get(cache_key)
+            if transit_info is None:
+                transit_info = run_once(cache_key, lambda: _fetch_adjacent_page(url, cache_key))
+        else:
+            res, page, fields = fetch_transit_page(url)
+            transit_info = parse_transit_info(page, max_routes=GV_MAX_ROUTES, fields=fields)
+    if transit_info is None:
+        raise Exception('No route found')
+    return transit_info['routes']
+
+
+def fare_to_int(fare):
+    """'1,234円' 形式の料金を数値に変換する。変換できない場合は 0 を返す。"""
+    digits = re.sub(r'\D', '', fare or '')
+    return int(digits) if digits else 0
+
+
+# -- 並べ替えの順序と、ルートを比較するキー
+GV_SORT_ORDERS = {
+    '早い順': lambda route: (route.arrival_time, route.fare_yen),
+    '安い順': lambda route: (route.fare_yen, route.arrival_time),
+    '乗り換えが少ない順': lambda route: (route.transfer_count, route.arrival_time),
+}
+
+
+def intent_SortRoutes(intent, session):
+    """インテント[SortRoutes]
+    ⑦直前の検索結果ページに掲載されたルートから、指定した順序（早い順、安い順、乗り換えが少ない順）で
+    最初のルートを返す。ルートはセッションから取り出し、Yahoo路線への再検索は行わない。
+    セッションにない場合（保存済みの前後の電車の履歴で応答した後など）は、検索結果ページを取得し直す。
+    """
+    card_title = intent['name']
+    should_end_session = False
+    session_attributes = load_session_attributes(session)
+
+    try:
+        order = intent['slots']['Order']['value']
+        if session_attributes.get('routes'):
+            routes = [Route.from_values(values) for values in session_attributes['routes']]
+        else:
+            with progressive_response():
+                routes = fetch_page_routes(session_attributes)
+        transit_info = min(routes, key=GV_SORT_ORDERS[order]).to_dict()
+
+        # 検索結果テキストを生成
+        for key in ['stationFrom', 'stationTo', 'url', 'searchDateTime', 'searchType',
+                    'prevUrl', 'nextUrl', 'position']:
+            transit_info[key] = session_attributes.get(key)
+        transit_info['order'] = order
+        speech_output = make_search_result(transit_info)
+        reprompt_text = GV_MSG_PROMPT_LAST
+
+        # 検索結果をセッションに保存
+        transit_info['searchResult'] = speech_output
+        transit_info['routes'] = routes
+        update_session_attributes(session_attributes, transit_info)
+    except:
+        speech_output = GV_MSG_ERROR
+        reprompt_text = GV_MSG_REPROMPT3
+
+    return build_response(session_attributes, build_speechlet_response(
+        card_title, speech_output, reprompt_text, should_end_session))
+
+
 def intent_Repeat(intent, session):
     """インテント[AMAZON.RepeatIntent]
     ④直前の路線情報結果を返す
     """
     card_title = intent['name']
     should_end_session = False
-    session_attributes = session['attributes'] if 'attributes' in session else {}
+    session_attributes = load_session_attributes(session)
 
     try:
         # セッションに保存されている路線情報の検索結果テキストを取り出す
@@ -466,7 +4012,7 @@ def intent_CheckCondition(intent, session):
     """
     card_title = intent['name']
     should_end_session = False
-    session_attributes = session['attributes'] if 'attributes' in session else {}
+    session_attributes = load_session_attributes(session)
 
     # 路線情報を確認
     speech_output = '検索条件は、'
@@ -479,10 +4025,7 @@ def intent_CheckCondition(intent, session):
         search_date_time = session_attributes.get('searchDateTime')
         search_type = session_attributes.get('searchType')
         if search_date_time is not None and search_type is not None:
-            search_date_time = re.sub(r'(\d+)-(\d+)-(\d+) (\d+):(\d+)', r'\1年\2月\3日 \4時\5分', search_date_time)
-            speech_output = speech_output + search_date_time + '、に' + search_type
-            if search_type == '始発' or search_type == '終電':
-                speech_output = re.sub('00時.*$', 'の、' + search_type, speech_output)
+            speech_output = speech_output + speak_search_datetime(search_date_time, search_type)
             reprompt_text = GV_MSG_PROMPT_LAST
         speech_output = speech_output + 'です。'
     else:
@@ -499,18 +4042,23 @@ def intent_LineNotify(intent, session):
     """
     card_title = intent['name']
     should_end_session = False
-    session_attributes = session['attributes'] if 'attributes' in session else {}
+    session_attributes = load_session_attributes(session)
 
     # 路線情報を確認
     search_result = session_attributes.get('searchResult')
     url = session_attributes.get('url')
     if search_result is not None and url is not None:
-        data = {'value1': search_result, 'value2': url}
-        r = requests.post(GV_IFTTT_URL, data=data)
-        if r.status_code == 200:
-            speech_output = 'Lineに通知しました。'
+        # 同じ検索結果は、同じセッションで一度だけ通知する
+        key = make_notify_key(session.get('sessionId'), search_result, url)
+        notified = session_attributes.get('notified') or []
+        try:
+            if key not in notified:
+                get_notify_queue().put({'key': key, 'value1': search_result, 'value2': url})
+                session_attributes['notified'] = (notified + [key])[-GV_NOTIFY_DEDUP_SIZE:]
+            speech_output = 'Lineに通知します。'
             reprompt_text = GV_MSG_PROMPT_LAST
-        else:
+        except Exception as e:
+            print('[ERR] Can not notify Line: ' + repr(e))
             speech_output = 'Lineへの通知に失敗しました。'
             reprompt_text = GV_MSG_ERROR_EXIT
             should_end_session = True
@@ -522,6 +4070,124 @@ def intent_LineNotify(intent, session):
         card_title, speech_output, reprompt_text, should_end_session))
 
 
+def intent_UsualRoute(intent, session):
+    """インテント[UsualRoute]
+    ⑧いつもの検索条件（この時間帯によく検索する駅、時刻）で路線情報を検索する
+    """
+    card_title = intent['name']
+    should_end_session = False
+    session_attributes = load_session_attributes(session)
+
+    try:
+        condition = predict_commute(get_user_id(session))
+    except Exception as e:
+        print('[WARN] Can not predict commute: ' + repr(e))
+        condition = None
+    if condition is None:
+        return build_response(session_attributes, build_speechlet_response(
+            card_title, GV_MSG_NO_USUAL, GV_MSG_REPROMPT1, should_end_session))
+
+    try:
+        station_from, station_to, search_date_time, search_type = condition
+        speech_output = search_and_save(session_attributes, session, station_from, station_to, search_date_time,
+                                        search_type)
+        reprompt_text = GV_MSG_PROMPT_LAST
+    except:
+        speech_output = GV_MSG_ERROR
+        reprompt_text = GV_MSG_PROMPT1
+
+    return build_response(session_attributes, build_speechlet_response(
+        card_title, speech_output, reprompt_text, should_end_session))
+
+
+# --------------- Intent dispatcher ------------------
+
+def _handle_unknown_intent(intent_request, session):
+    # raise ValueError('Invalid intent')
+    return handle_error_exit(session)
+
+
+# -- インテント名と処理の対応（処理は intent_request, session を受け取る）
+GV_INTENT_HANDLERS = {
+    'SetStation': lambda request, session: intent_SetStation(request['intent'], session),
+    'SetDateTime': lambda request, session: intent_SetDateTime(request['intent'], session),
+    'AMAZON.NextIntent': lambda request, session: intent_NextPrevious(request['intent'], session, 'next'),
+    'AMAZON.PreviousIntent': lambda request, session: intent_NextPrevious(request['intent'], session, 'prev'),
+    'AMAZON.HelpIntent': lambda request, session: get_welcome_response(),
+    'AMAZON.CancelIntent': lambda request, session: handle_session_end_request(),
+    'AMAZON.StopIntent': lambda request, session: handle_session_end_request(),
+    'AMAZON.RepeatIntent': lambda request, session: intent_Repeat(request['intent'], session),
+    'CheckCondition': lambda request, session: intent_CheckCondition(request['intent'], session),
+    'LineNotify': lambda request, session: intent_LineNotify(request['intent'], session),
+    'SortRoutes': lambda request, session: intent_SortRoutes(request['intent'], session),
+    'UsualRoute': lambda request, session: intent_UsualRoute(request['intent'], session),
+}
+
+
+def register_intent(intent_name, handler):
+    """インテントの処理を登録する。
+
+    Parameters
+    ----------
+    intent_name : str
+        インテント名。
+    handler : callable
+        handler(intent_request, session) -> response
+    """
+    GV_INTENT_HANDLERS[intent_name] = handler
+
+
+def _wrap_middleware(middleware, handler):
+    return lambda intent_request, session: middleware(intent_request, session, handler)
+
+
+def metrics_middleware(intent_request, session, handler):
+    """インテントの処理時間と、その内訳（HTTP通信、解析、メッセージ生成、セッション情報の変換）、
+    最初に発話するまでの時間（Progressive Response を送信した場合はその時刻、それ以外は処理時間）、
+    検索結果ページを受信したバイト数（BytesRead）、通信先のホスト毎のサーキットブレーカーの状態を CloudWatch Embedded Metric Format で出力する。
+    """
+    start_metrics()
+    start = time.perf_counter()
+    try:
+        return handler(intent_request, session)
+    finally:
+        total = time.perf_counter() - start
+        metrics = finish_metrics()
+        first_audio = metrics.pop('firstAudio', None)
+        bytes_read = metrics.pop('bytesRead', None)
+        values = dict((name.capitalize(), seconds * 1000) for name, seconds in metrics.items())
+        values['Total'] = total * 1000
+        values['TimeToFirstAudio'] = min(first_audio - start, total) * 1000 if first_audio else values['Total']
+        emit_metrics({'Intent': intent_request['intent']['name']}, values)
+        if bytes_read is not None:
+            emit_metrics({'Intent': intent_request['intent']['name']}, {'BytesRead': bytes_read}, 'Bytes')
+        for host, breaker in list(GV_CIRCUIT_BREAKERS.items()):
+            emit_metrics({'Host': host}, breaker.metrics(), 'Count')
+
+
+def profiler_middleware(intent_request, session, handler):
+    """リクエストIDが GV_PROFILE_REQUEST_IDS に含まれる場合、または GV_PROFILE_SAMPLE_RATE の割合で、
+    サンプリングプロファイラを有効にし、出現回数の多いスタックをログに出力する。
+    """
+    request_id = intent_request.get('requestId')
+    sampled = GV_PROFILE_SAMPLE_RATE > 0 and \
+        int(hashlib.sha1((request_id or '').encode('utf-8')).hexdigest()[:8], 16) < GV_PROFILE_SAMPLE_RATE * 0xffffffff
+    if request_id not in GV_PROFILE_REQUEST_IDS and not sampled:
+        return handler(intent_request, session)
+
+    profiler = SamplingProfiler(threading.current_thread().ident).start()
+    try:
+        return handler(intent_request, session)
+    finally:
+        print(json.dumps({'profile': {'requestId': request_id, 'intent': intent_request['intent']['name'],
+                                      'samples': profiler.stop().report()}}, ensure_ascii=False))
+
+
+# -- インテントの処理の前後に実行する処理（先頭が最も外側）
+# -- 各処理は middleware(intent_request, session, handler) -> response
+GV_INTENT_MIDDLEWARES = [metrics_middleware, profiler_middleware]
+
+
 # --------------- Events ------------------
 
 def on_session_started(session_started_request, session):
@@ -548,31 +4214,11 @@ def on_intent(intent_request, session):
     print('on_intent requestId=' + intent_request['requestId'] +
           ', sessionId=' + session['sessionId'])
 
-    intent = intent_request['intent']
-    intent_name = intent_request['intent']['name']
-
     # Dispatch to your skill's intent handlers
-    if intent_name == 'SetStation':
-        return intent_SetStation(intent, session)
-    elif intent_name == 'SetDateTime':
-        return intent_SetDateTime(intent, session)
-    elif intent_name == 'AMAZON.NextIntent':
-        return intent_NextPrevious(intent, session, 'next')
-    elif intent_name == 'AMAZON.PreviousIntent':
-        return intent_NextPrevious(intent, session, 'prev')
-    elif intent_name == 'AMAZON.HelpIntent':
-        return get_welcome_response()
-    elif intent_name == 'AMAZON.CancelIntent' or intent_name == 'AMAZON.StopIntent':
-        return handle_session_end_request()
-    elif intent_name == 'AMAZON.RepeatIntent':
-        return intent_Repeat(intent, session)
-    elif intent_name == 'CheckCondition':
-        return intent_CheckCondition(intent, session)
-    elif intent_name == 'LineNotify':
-        return intent_LineNotify(intent, session)
-    else:
-        # raise ValueError('Invalid intent')
-        return handle_error_exit(session)
+    handler = GV_INTENT_HANDLERS.get(intent_request['intent']['name'], _handle_unknown_intent)
+    for middleware in reversed(GV_INTENT_MIDDLEWARES):
+        handler = _wrap_middleware(middleware, handler)
+    return handler(intent_request, session)
 
 
 def on_session_ended(session_ended_request, session):
@@ -603,6 +4249,9 @@ def lambda_handler(event, context):
     #         'amzn1.echo-sdk-ams.app.[unique-value-here]'):
     #     raise ValueError('Invalid Application ID')
 
+    set_request_deadline(context)
+    set_progressive_context(event)
+
     if event['session']['new']:
         on_session_started({'requestId': event['request']['requestId']},
                            event['session'])
@@ -610,6 +4259,9 @@ def lambda_handler(event, context):
     if event['request']['type'] == 'LaunchRequest':
         return on_launch(event['request'], event['session'])
     elif event['request']['type'] == 'IntentRequest':
-        return on_intent(event['request'], event['session'])
+        response = on_intent(event['request'], event['session'])
+        if GV_ON_LAMBDA:
+            flush_notify_queue()
+        return response
     elif event['request']['type'] == 'SessionEndedRequest':
         return on_session_ended(event['request'], event['session'])
@@ -0,0 +1,386 @@
+# coding: UTF-8
+"""
+Yahoo!路線情報の非同期クライアント。
+
+yahoo_transit の検索（fetch_transit_info）、前後の電車の検索（fetch_adjacent_transit_info）、
+Line通知（deliver_notifications）のコルーチン版。検索結果の解析、キャッシュ、同じ検索条件の検索を1回にまとめる処理、
+有効期限が切れた結果での応答、サーキットブレーカーは yahoo_transit と共有する。
+
+- aiohttp がインストールされている場合は、aiohttp のコネクションプールで通信する。
+  ない場合は、yahoo_transit.http_request（requests）をスレッドプールで実行する。
+- 同時に送信するリクエスト数を concurrency で制限する。
+- ヘッジリクエスト: 最初のリクエストが最近の応答時間の p95 を過ぎても応答しない場合は、
+  同じリクエストをもう1回送信し、先に応答した方を使う。
+
+同期版の関数（fetch_transit_info など）は、バックグラウンドのイベントループで実行して結果を待つため、
+既存のインテントの処理からそのまま呼び出せる（環境変数 async_client=1 の場合、検索と前後の電車の検索に使う）。
+
+使い方:
+    async with AsyncTransitClient() as client:
+        results = await asyncio.gather(client.search('渋谷駅', '東京駅', '2018-06-01 08:00', '出発'),
+                                       client.search('新宿駅', '品川駅', '2018-06-01 08:00', '出発'))
+"""
+
+from __future__ import print_function
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent import futures
+
+import yahoo_transit
+
+# -- 同時に送信するリクエスト数
+GV_ASYNC_CONCURRENCY = 8
+# -- ヘッジリクエストを送信するまでの待ち時間: 最近の応答時間のこのパーセンタイル
+GV_HEDGE_PERCENTILE = 95
+# -- 待ち時間の計算に使う応答時間の数、計算に必要な最小の数
+GV_HEDGE_SAMPLES = 200
+GV_HEDGE_MIN_SAMPLES = 20
+# -- 応答時間が十分に集まるまでの待ち時間（秒）、待ち時間の下限（秒）
+GV_HEDGE_DEFAULT_DELAY = 1.0
+GV_HEDGE_MIN_DELAY = 0.05
+# -- 同期版の検索で、有効期限が切れた結果に切り替えてから結果を受け取るまでの余裕（秒）
+GV_ASYNC_STALE_MARGIN = 0.1
+# -- 同期版の関数で結果を待つ時間（秒）: 呼び出し元のスレッドで期限（set_request_deadline）が未設定の場合に使う
+GV_ASYNC_TIMEOUT = float(os.environ.get(
+    'async_timeout', 2 * (yahoo_transit.GV_HTTP_CONNECT_TIMEOUT + yahoo_transit.GV_HTTP_READ_TIMEOUT)))
+
+# -- 同期版の関数で使う、バックグラウンドのイベントループとクライアント
+GV_LOOP = None
+GV_LOOP_LOCK = threading.Lock()
+GV_DEFAULT_CLIENT = None
+
+
+class AsyncTransitClient(object):
+    """Yahoo!路線情報の非同期クライアント。
+
+    Parameters
+    ----------
+    concurrency : int, default GV_ASYNC_CONCURRENCY
+        同時に送信するリクエスト数（コネクションプールの大きさ）。
+    hedge : bool, default True
+        検索のリクエストにヘッジリクエストを使うか。
+    """
+
+    def __init__(self, concurrency=GV_ASYNC_CONCURRENCY, hedge=True):
+        self.concurrency = concurrency
+        self.hedge = hedge
+        self.semaphore = None
+        self.session = None
+        self.latencies = deque(maxlen=GV_HEDGE_SAMPLES)
+        self.stats = {'requests': 0, 'hedged': 0, 'hedgeWins': 0}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        """aiohttp のセッションを閉じる。"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _get_session(self):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        if self.session is None:
+            try:
+                import aiohttp
+            except ImportError:
+                return None
+            connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.concurrency)
+            timeout = aiohttp.ClientTimeout(sock_connect=yahoo_transit.GV_HTTP_CONNECT_TIMEOUT,
+                                            sock_read=yahoo_transit.GV_HTTP_READ_TIMEOUT)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self.session
+
+    async def request(self, method, url, use_deadline=True, record_success=True, **kwargs):
+        """HTTPリクエストを送信する。
+
+        Parameters
+        ----------
+        method : str
+            'GET', 'POST' など。
+        url : str
+            リクエスト先のURL。
+        use_deadline : bool, default True
+            aiohttp がない場合に、yahoo_transit.http_request に渡す。
+        record_success : bool, default True
+            5xx以外の応答をサーキットブレーカーに成功として記録するか（yahoo_transit.http_request と同じ）。
+        **kwargs
+            params, data。
+
+        Returns
+        -------
+        status, url, content : int, str, bytes
+            ステータスコード、リダイレクト後のURL、レスポンスの本文。
+        """
+        session = self._get_session()
+        async with self.semaphore:
+            start = time.monotonic()
+            if session is None:
+                loop = asyncio.get_running_loop()
+                res = await loop.run_in_executor(
+                    None, lambda: yahoo_transit.http_request(method, url, use_deadline, record_success, **kwargs))
+                result = res.status_code, res.url, res.content
+            else:
+                # requests を使う場合と同じく、ホスト毎のサーキットブレーカーに従う
+                breaker = yahoo_transit.get_circuit_breaker(url.split('/', 3)[2])
+                if not breaker.allow():
+                    raise yahoo_transit.CircuitOpenError('Circuit open: ' + url)
+                try:
+                    async with session.request(method, url, **kwargs) as res:
+                        result = res.status, str(res.url), await res.read()
+                except Exception:
+                    breaker.record_failure()
+                    raise
+                if result[0] >= 500:
+                    breaker.record_failure()
+                elif record_success:
+                    breaker.record_success()
+            self.latencies.append(time.monotonic() - start)
+            self.stats['requests'] += 1
+        return result
+
+    def hedge_delay(self):
+        """ヘッジリクエストを送信するまでの待ち時間（秒）。"""
+        if len(self.latencies) < GV_HEDGE_MIN_SAMPLES:
+            return GV_HEDGE_DEFAULT_DELAY
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, len(ordered) * GV_HEDGE_PERCENTILE // 100)
+        return max(GV_HEDGE_MIN_DELAY, ordered[index])
+
+    async def get(self, url, **kwargs):
+        """GETリクエストを送信する。hedge が有効な場合は、応答が遅ければ同じリクエストをもう1回送信する。"""
+        if not self.hedge:
+            return await self.request('GET', url, **kwargs)
+
+        first = asyncio.ensure_future(self.request('GET', url, **kwargs))
+        done, _ = await asyncio.wait([first], timeout=self.hedge_delay())
+        if done:
+            return first.result()
+
+        self.stats['hedged'] += 1
+        second = asyncio.ensure_future(self.request('GET', url, **kwargs))
+        pending = set([first, second])
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    if task is second:
+                        self.stats['hedgeWins'] += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    async def search(self, station_from, station_to, search_date_time, search_type,
+                     walk_speed=yahoo_transit.GV_WALK_SPEED, timeout=None):
+        """yahoo_transit.fetch_transit_info のコルーチン版。
+        同じ検索条件の検索は、同期版の検索（yahoo_transit.run_once）とあわせて1回にまとめる。
+        有効期限が切れた結果がある場合は、検索を GV_CACHE_STALE_WAIT 秒（timeout が短ければ timeout 秒）まで待ち、
+        終わらない、失敗した場合は古い結果を返す。検索は続け、失敗した場合は yahoo_transit.refresh_transit_info で
+        検索し直す。
+        """
+        search_date_time = yahoo_transit.format_search_datetime(search_date_time)
+        transit_info = yahoo_transit.find_cached_transit_info(station_from, station_to, search_date_time,
+                                                              search_type, walk_speed)
+        if transit_info is not None:
+            return transit_info
+
+        cache_key = yahoo_transit.make_cache_key(station_from, station_to, search_date_time, search_type, walk_speed)
+        stale_info = yahoo_transit.cache_get_stale(cache_key)
+        task = asyncio.ensure_future(run_once(cache_key, lambda: self._search(
+            station_from, station_to, search_date_time, search_type, walk_speed)))
+        if stale_info is None:
+            return await task
+
+        # 待ちきれなかった場合も検索は続け（shield）、終われば結果がキャッシュに保存される
+        task.add_done_callback(_consume_exception)
+        wait = yahoo_transit.GV_CACHE_STALE_WAIT
+        if timeout is not None:
+            wait = min(wait, timeout)
+        try:
+            transit_info = await asyncio.wait_for(asyncio.shield(task), max(0, wait))
+        except Exception as e:
+            print('[WARN] Search failed, falling back to stale cache: ' + repr(e))
+            transit_info = None
+        if transit_info is not None:
+            return transit_info
+
+        yahoo_transit.count_cache_stats('stale')
+        print('[INFO] Stale cache hit: ' + cache_key)
+        stale_info['searchDateTime'] = search_date_time
+        if task.done():
+            yahoo_transit.refresh_transit_info(station_from, station_to, search_date_time, search_type, walk_speed)
+        return stale_info
+
+    async def _search(self, station_from, station_to, search_date_time, search_type, walk_speed):
+        # yahoo_transit.search_transit_info と同じく、検索結果ページを解析してからサーキットブレーカーに記録する
+        payload = yahoo_transit.make_search_payload(station_from, station_to, search_date_time, search_type,
+                                                    walk_speed)
+        status, url, content = await self.get(yahoo_transit.GV_SEARCH_URL, record_success=False, params=payload)
+        return yahoo_transit.make_searched_transit_info(status, content, url, station_from, station_to,
+                                                        search_date_time, search_type, walk_speed)
+
+    async def fetch_adjacent(self, url, operation='next', adjacent_url=None):
+        """yahoo_transit.fetch_adjacent_transit_info のコルーチン版。
+        先読みした結果があればそれを使い、先読み中、検索中ならその結果を待つ。
+        """
+        if adjacent_url is None:
+            _, _, content = await self.get(url)
+            transit_info = yahoo_transit.parse_transit_info(content)
+            adjacent_url = transit_info and transit_info[operation + 'Url']
+            if adjacent_url is None:
+                return None
+
+        cache_key = yahoo_transit.make_adjacent_cache_key(adjacent_url)
+        transit_info = yahoo_transit.cache_get(cache_key)
+        if transit_info is not None:
+            yahoo_transit.GV_PREFETCH_STATS['hit'] += 1
+            return transit_info
+        return await run_once(cache_key, lambda: self._fetch_adjacent_page(adjacent_url, cache_key))
+
+    async def _fetch_adjacent_page(self, adjacent_url, cache_key):
+        _, url, content = await self.get(yahoo_transit.GV_BASE_URL + adjacent_url)
+        transit_info = yahoo_transit.parse_transit_info(content, max_routes=yahoo_transit.GV_MAX_ROUTES)
+        if transit_info is not None:
+            transit_info['url'] = url
+            yahoo_transit.cache_set(cache_key, transit_info, yahoo_transit.GV_PREFETCH_TTL)
+        return transit_info
+
+    async def notify(self, messages):
+        """yahoo_transit.deliver_notifications のコルーチン版。"""
+        data = yahoo_transit.make_notify_payload(messages)
+        try:
+            status, _, _ = await self.request('POST', yahoo_transit.get_ifttt_url(), use_deadline=False, data=data)
+        except Exception as e:
+            print('[ERR] Can not notify Line: ' + repr(e))
+            return False
+        if status != 200:
+            print('[ERR] Can not notify Line: HTTP ' + str(status))
+        return status == 200
+
+
+async def run_once(cache_key, func):
+    """yahoo_transit.run_once のコルーチン版。同じキャッシュのキーの検索を、同期版の検索とあわせて1回にまとめる。
+
+    Parameters
+    ----------
+    cache_key : str
+        キャッシュのキー。
+    func : callable
+        func() -> 路線情報を返すコルーチン。検索中でない場合に呼び出す。
+
+    Returns
+    -------
+    transit_info : dict
+        路線情報。見つからない場合は None。
+    """
+    with yahoo_transit.GV_INFLIGHT_LOCK:
+        future = yahoo_transit.GV_INFLIGHT.get(cache_key)
+        owner = future is None
+        if owner:
+            future = yahoo_transit.GV_INFLIGHT[cache_key] = futures.Future()
+    if not owner:
+        yahoo_transit.count_cache_stats('coalesced')
+        # 待っている側がキャンセルされても、検索中の Future はキャンセルしない
+        transit_info = await asyncio.shield(asyncio.wrap_future(future))
+        return dict(transit_info) if transit_info is not None else None
+
+    try:
+        transit_info = await func()
+        future.set_result(transit_info)
+        return transit_info
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with yahoo_transit.GV_INFLIGHT_LOCK:
+            del yahoo_transit.GV_INFLIGHT[cache_key]
+
+
+def _consume_exception(task):
+    if not task.cancelled():
+        task.exception()
+
+
+# --------------- Synchronous wrappers ----------------------
+
+def get_event_loop():
+    """同期版の関数で使う、バックグラウンドのスレッドで動くイベントループを返す。初回呼び出し時に作成する。"""
+    global GV_LOOP
+    with GV_LOOP_LOCK:
+        if GV_LOOP is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='yahoo-transit-async', daemon=True).start()
+            GV_LOOP = loop
+    return GV_LOOP
+
+
+def get_default_client():
+    """同期版の関数で共有するクライアントを返す。"""
+    global GV_DEFAULT_CLIENT
+    if GV_DEFAULT_CLIENT is None:
+        GV_DEFAULT_CLIENT = AsyncTransitClient()
+    return GV_DEFAULT_CLIENT
+
+
+def run_sync(coroutine, timeout=None):
+    """コルーチンをバックグラウンドのイベントループで実行し、結果を返す。
+
+    Parameters
+    ----------
+    coroutine : coroutine
+        実行するコルーチン。
+    timeout : float, default None
+        結果を待つ時間（秒）。省略した場合は、呼び出し元のスレッドの残り時間
+        （yahoo_transit.remaining_request_time）、期限が未設定の場合は GV_ASYNC_TIMEOUT。
+
+    Raises
+    ------
+    requests.Timeout
+        timeout 秒以内に終わらなかった場合。コルーチンはキャンセルする。
+    """
+    import requests
+    if timeout is None:
+        timeout = yahoo_transit.remaining_request_time()
+        if timeout is None:
+            timeout = GV_ASYNC_TIMEOUT
+    if timeout <= 0:
+        coroutine.close()
+        raise requests.Timeout('Request deadline exceeded')
+    future = asyncio.run_coroutine_threadsafe(coroutine, get_event_loop())
+    try:
+        return future.result(timeout)
+    except futures.TimeoutError:
+        future.cancel()
+        raise requests.Timeout('Async request timed out: %.2f seconds' % timeout)
+
+
+def fetch_transit_info(station_from, station_to, search_date_time, search_type,
+                       walk_speed=yahoo_transit.GV_WALK_SPEED):
+    """yahoo_transit.fetch_transit_info と同じ。ヘッジリクエストを使う。
+    呼び出し元のスレッドの残り時間まで待ち、有効期限が切れた結果がある場合は残り時間内に古い結果を返す。
+    """
+    remaining = yahoo_transit.remaining_request_time()
+    stale_wait = None if remaining is None else remaining - GV_ASYNC_STALE_MARGIN
+    return run_sync(get_default_client().search(station_from, station_to, search_date_time, search_type,
+                                                walk_speed, stale_wait), remaining)
+
+
+def fetch_adjacent_transit_info(url, operation='next', adjacent_url=None):
+    """yahoo_transit.fetch_adjacent_transit_info と同じ。ヘッジリクエストを使う。"""
+    return run_sync(get_default_client().fetch_adjacent(url, operation, adjacent_url))
+
+
+def deliver_notifications(messages):
+    """yahoo_transit.deliver_notifications と同じ。"""
+    return run_sync(get_default_client().notify(messages))
@@ -0,0 +1,258 @@
+# coding: UTF-8
+"""
+Yahoo!路線情報の一括検索。
+
+(出発駅, 到着駅, 日時, タイプ) の検索条件をまとめて受け取り、スレッドプールで並行して
+yahoo_transit.fetch_transit_info で検索する。同じ条件の検索は1回だけ行い、
+結果は検索が終わった順にJSONL（1行に1件）で出力する。
+Yahoo!路線情報への負荷を抑えるため、ホスト毎の1秒あたりのリクエスト数を制限する。
+
+入力はCSV（ヘッダ行: from,to,datetime,type[,walk]）、またはJSONL（1行に1件の同じキーを持つオブジェクト）。
+datetime は yyyy-mm-dd HH:MM形式、type は '出発', '到着', '始発', '終電'。
+
+使い方:
+    $ python yahoo_transit_batch.py queries.csv --workers 8 --rate 4 > results.jsonl
+    $ python yahoo_transit_batch.py queries.jsonl --output results.jsonl
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import sys
+import threading
+import time
+from concurrent import futures
+
+import yahoo_transit
+
+# -- 並行して検索する数
+GV_BATCH_WORKERS = 8
+# -- Yahoo!路線情報への1秒あたりの最大リクエスト数
+GV_BATCH_RATE = 4.0
+# -- 共有キャッシュから一括で取り出す検索条件の数
+GV_BATCH_CHUNK = 100
+# -- 並行して検索する数に対する、検索待ちを含めて同時に受け付ける検索の数の比率
+GV_BATCH_WINDOW_RATIO = 2
+# -- 検索条件の項目
+GV_QUERY_KEYS = ['from', 'to', 'datetime', 'type', 'walk']
+
+
+def read_queries(f, format=None):
+    """CSV、またはJSONLの検索条件を1件ずつ返す。
+
+    Parameters
+    ----------
+    f : file
+        入力ファイル（テキスト）。
+    format : str, default None
+        'csv', 'jsonl'。None の場合は最初の文字が '{' ならJSONL、それ以外はCSVとみなす。
+
+    Yields
+    ------
+    query : dict
+        from, to, datetime, type, walk（省略時は yahoo_transit.GV_WALK_SPEED）。
+        type, walk が不正な行は、検索せずにエラーとして出力するよう error を持つ。
+    """
+    if format is None:
+        head = f.readline()
+        format = 'jsonl' if head.lstrip().startswith('{') else 'csv'
+        f = _chain_lines(head, f)
+
+    if format == 'csv':
+        rows = csv.DictReader(f)
+    else:
+        rows = (json.loads(line) for line in f if line.strip())
+    for row in rows:
+        try:
+            yield make_query(row)
+        except ValueError as e:
+            # 不正な行で一括検索全体を止めないよう、その行だけエラーにする（run_batch）
+            query = dict((key, (row.get(key) or '').strip()) for key in GV_QUERY_KEYS[:4])
+            query['walk'] = row.get('walk')
+            query['error'] = repr(e)
+            yield query
+
+
+def _chain_lines(head, f):
+    yield head
+    for line in f:
+        yield line
+
+
+def make_query(row):
+    """入力の1行から検索条件を作成する。前後の空白を除き、歩く速度を数値にする。"""
+    query = dict((key, (row.get(key) or '').strip()) for key in GV_QUERY_KEYS[:4])
+    if query['type'] not in yahoo_transit.GV_SEARCH_TYPES:
+        raise ValueError('Unknown search type: ' + repr(query['type']))
+    query['walk'] = int(row.get('walk') or yahoo_transit.GV_WALK_SPEED)
+    return query
+
+
+def make_query_key(query):
+    """同じ検索をまとめるためのキー。
+    日時が近いだけの検索は、yahoo_transit の検索結果キャッシュで同じ結果を使い回す。
+    """
+    return tuple(query[key] for key in GV_QUERY_KEYS)
+
+
+def make_cache_keys(queries):
+    """検索条件の、yahoo_transit の検索結果キャッシュのキー。
+    日時が不正な検索条件は除く（検索時にエラーとして出力する）。
+    """
+    keys = []
+    for query in queries:
+        try:
+            keys.append(yahoo_transit.make_cache_key(query['from'], query['to'], query['datetime'], query['type'],
+                                                     query['walk']))
+        except ValueError:
+            continue
+    return keys
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def search(query):
+    """1件の検索条件で検索する。"""
+    return yahoo_transit.fetch_transit_info(query['from'], query['to'], query['datetime'], query['type'],
+                                            query['walk'])
+
+
+@contextlib.contextmanager
+def batch_http_settings(workers, rate):
+    """一括検索の間だけ、ホスト毎のリクエスト数を制限し、並行数に合わせたコネクションプールを使う。
+    終わったら、yahoo_transit の設定（レートリミッター、コネクションプールの大きさ、共有セッション）を元に戻す。
+    """
+    saved = (yahoo_transit.GV_HTTP_RATE_LIMITER, yahoo_transit.GV_HTTP_POOL_MAXSIZE, yahoo_transit.GV_HTTP_SESSION)
+    yahoo_transit.set_http_rate_limit(rate)
+    # -- 並行数よりコネクションプールが小さいと、接続を使い回せない。一括検索用のセッションを作り直す
+    if workers > yahoo_transit.GV_HTTP_POOL_MAXSIZE:
+        yahoo_transit.GV_HTTP_POOL_MAXSIZE = workers
+        yahoo_transit.GV_HTTP_SESSION = None
+    try:
+        yield
+    finally:
+        session = yahoo_transit.GV_HTTP_SESSION
+        if session is not None and session is not saved[2]:
+            session.close()
+        yahoo_transit.GV_HTTP_RATE_LIMITER, yahoo_transit.GV_HTTP_POOL_MAXSIZE, yahoo_transit.GV_HTTP_SESSION = saved
+
+
+def run_batch(queries, write, workers=GV_BATCH_WORKERS, rate=GV_BATCH_RATE):
+    """検索条件をまとめて検索し、終わった順に write(result) を呼び出す。
+    検索待ちを含めて workers * GV_BATCH_WINDOW_RATIO 件までしか受け付けず、検索が終わるまで入力を読み進めない。
+
+    Parameters
+    ----------
+    queries : iterable of dict
+        検索条件（read_queries の結果）。error を持つ検索条件は、検索せずにエラーとして出力する。
+    write : callable
+        結果1件を受け取る関数。result は index（入力の行番号、0から）, query, transitInfo、
+        失敗した場合は transitInfo の代わりに error を持つ。
+    workers : int, default GV_BATCH_WORKERS
+        並行して検索する数。
+    rate : float, default GV_BATCH_RATE
+        ホスト毎の1秒あたりの最大リクエスト数。0の場合は制限しない。
+
+    Returns
+    -------
+    stats : dict
+        queries（入力件数）, searches（実際に検索した件数）, errors, seconds。
+    """
+    start = time.time()
+    lock = threading.Lock()
+    # -- 検索待ちを含めた、受け付けた検索の数の上限
+    window = threading.BoundedSemaphore(workers * GV_BATCH_WINDOW_RATIO)
+    # -- { 検索のキー: [(index, query), ...] }
+    waiting = {}
+    stats = {'queries': 0, 'searches': 0, 'errors': 0}
+
+    def done(future):
+        window.release()
+        with lock:
+            requests = waiting.pop(future.key)
+        try:
+            transit_info = future.result()
+            error = None if transit_info is not None else 'No route found'
+        except Exception as e:
+            transit_info, error = None, repr(e)
+        for index, query in requests:
+            result = {'index': index, 'query': query}
+            if error is None:
+                result['transitInfo'] = transit_info
+            else:
+                result['error'] = error
+            with lock:
+                if error is not None:
+                    stats['errors'] += 1
+                write(result)
+
+    with batch_http_settings(workers, rate), futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk in chunked(enumerate(queries), GV_BATCH_CHUNK):
+            # 他のコンテナが検索済みの結果は、共有キャッシュからまとめて取り出してローカルのキャッシュに入れておく
+            if yahoo_transit.GV_SHARED_CACHE is not None:
+                yahoo_transit.cache_get_many(make_cache_keys(query for _, query in chunk if 'error' not in query))
+            for index, query in chunk:
+                error = query.pop('error', None)
+                if error is not None:
+                    with lock:
+                        stats['queries'] += 1
+                        stats['errors'] += 1
+                        write({'index': index, 'query': query, 'error': error})
+                    continue
+                key = make_query_key(query)
+                with lock:
+                    stats['queries'] += 1
+                    if key in waiting:
+                        waiting[key].append((index, query))
+                        continue
+                    waiting[key] = [(index, query)]
+                    stats['searches'] += 1
+                window.acquire()
+                future = executor.submit(search, query)
+                future.key = key
+                future.add_done_callback(done)
+
+    stats['seconds'] = round(time.time() - start, 3)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search Yahoo transit routes for many station pairs at once.')
+    parser.add_argument('input', help="検索条件のCSV、またはJSONL（'-' の場合は標準入力）")
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help='入力の形式（省略時は内容から判定）')
+    parser.add_argument('--output', help='結果を書き込むJSONLファイル（省略時は標準出力）')
+    parser.add_argument('--workers', type=int, default=GV_BATCH_WORKERS, help='並行して検索する数')
+    parser.add_argument('--rate', type=float, default=GV_BATCH_RATE, help='1秒あたりの最大リクエスト数（0: 制限なし）')
+    args = parser.parse_args()
+
+    source = sys.stdin if args.input == '-' else io.open(args.input, encoding='utf-8', newline='')
+    output = io.open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+
+    def write(result):
+        output.write(json.dumps(result, ensure_ascii=False, default=yahoo_transit.route_to_json) + '\n')
+        output.flush()
+
+    # yahoo_transit のログが結果に混ざらないよう、標準エラー出力に出す
+    with source, contextlib.redirect_stdout(sys.stderr):
+        stats = run_batch(read_queries(source, args.format), write, args.workers, args.rate)
+    print('[INFO] Batch finished: ' + json.dumps(stats), file=sys.stderr)
+    if output is not sys.stdout:
+        output.close()
+    return 1 if stats['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
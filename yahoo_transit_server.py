@@ -0,0 +1,296 @@
+# coding: UTF-8
+"""
+Alexaスキルのエンドポイントを、AWS Lambdaの代わりに自前のサーバーで動かす。
+
+Alexaからのリクエスト（POST、JSON）を yahoo_transit.lambda_handler で処理し、その結果をJSONで返す。
+同じプロセスのリクエストは、HTTPのコネクションプール、検索結果キャッシュなどを共有する。
+
+- 受け付けたリクエストは大きさ --queue-size のキューに入れ、--threads 個のワーカーで処理する。
+  キューが一杯の場合、キューで GV_SERVER_MAX_QUEUE_WAIT 秒以上待ったリクエストは、503 を返す。
+- Alexaの応答期限（yahoo_transit.GV_ALEXA_TIMEOUT_MS）は、キューで待った時間を含めて数える。
+- --processes を指定すると、同じポートを SO_REUSEPORT で共有する複数のプロセスで処理する（Linux）。
+  プロセス間で検索結果を共有するには、環境変数 shared_cache で共有キャッシュを設定する。
+- SIGTERM, SIGINT を受け取ると、新しい接続の受け付けをやめ、キューに入っているリクエストを処理し終えてから終了する。
+- GET /health は、キューの長さと処理件数などをJSONで返す。
+
+HTTPSは --certfile, --keyfile で終端する（リバースプロキシで終端する場合は不要）。
+Alexaのリクエストの署名の検証は行わないため、リバースプロキシなどで行うこと。
+環境変数 skill_application_id を設定すると、applicationId が異なるリクエストは 403 を返す。
+
+使い方:
+    $ python yahoo_transit_server.py --port 8080 --threads 8 --queue-size 64
+    $ python yahoo_transit_server.py --port 8443 --processes 4 --certfile cert.pem --keyfile key.pem
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import queue
+import signal
+import socket
+import ssl
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import yahoo_transit
+
+# -- リクエストを処理するスレッドの数と、処理を待つリクエストの最大数
+GV_SERVER_THREADS = 8
+GV_SERVER_QUEUE_SIZE = 64
+# -- キューでこの秒数以上待ったリクエストは、処理せずに 503 を返す
+GV_SERVER_MAX_QUEUE_WAIT = 2.0
+# -- 終了時に、処理中のリクエストを待つ時間（秒）
+GV_SERVER_GRACE = 10.0
+# -- 受け付けるリクエストの最大サイズ（バイト）
+GV_SERVER_MAX_BODY = 256 * 1024
+# -- 503 を返す際に、送信とリクエストの読み捨てを待つ時間（秒）
+GV_SERVER_REJECT_TIMEOUT = 0.05
+# -- 設定した場合、applicationId が異なるリクエストは 403 を返す
+GV_SKILL_APPLICATION_ID = os.environ.get('skill_application_id')
+
+
+class RequestContext(object):
+    """LambdaContext の代わり。リクエストを受け付けた時刻からの残り時間を返す。"""
+
+    def __init__(self, received):
+        self.received = received
+
+    def get_remaining_time_in_millis(self):
+        return int(yahoo_transit.GV_ALEXA_TIMEOUT_MS - (time.time() - self.received) * 1000)
+
+
+class SkillRequestHandler(BaseHTTPRequestHandler):
+    """Alexaのリクエストを lambda_handler で処理するハンドラ。接続はリクエスト毎に閉じる。"""
+
+    server_version = 'YahooTransit'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0 or length > GV_SERVER_MAX_BODY:
+            return self.send_json(413 if length > 0 else 400, {'error': 'Invalid request body'})
+        try:
+            event = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            return self.send_json(400, {'error': 'Invalid JSON'})
+        if GV_SKILL_APPLICATION_ID and \
+                event.get('session', {}).get('application', {}).get('applicationId') != GV_SKILL_APPLICATION_ID:
+            return self.send_json(403, {'error': 'Invalid application id'})
+
+        try:
+            response = yahoo_transit.lambda_handler(event, RequestContext(self.server.local.received))
+        except Exception as e:
+            print('[ERR] Request failed: ' + repr(e))
+            self.server.count('errors')
+            return self.send_json(500, {'error': 'Internal error'})
+        self.send_json(200, response or {'version': '1.0', 'response': {}})
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self.send_json(404, {'error': 'Not found'})
+        self.send_json(200, self.server.health())
+
+    def send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Connection', 'close')
+        if status == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count('status%d' % status)
+
+    def log_message(self, *args):
+        pass
+
+
+class SkillServer(HTTPServer):
+    """受け付けた接続を大きさの決まったキューに入れ、ワーカースレッドで処理するサーバー。
+
+    Parameters
+    ----------
+    address : (str, int)
+        待ち受けるアドレスとポート。
+    threads : int, default GV_SERVER_THREADS
+        リクエストを処理するスレッドの数。
+    queue_size : int, default GV_SERVER_QUEUE_SIZE
+        処理を待つリクエストの最大数。
+    reuse_port : bool, default False
+        SO_REUSEPORT を設定し、同じポートを複数のプロセスで共有する。
+    ssl_context : ssl.SSLContext, default None
+        HTTPSで待ち受ける場合のコンテキスト。
+    """
+
+    request_queue_size = 128
+    allow_reuse_address = True
+
+    def __init__(self, address, threads=GV_SERVER_THREADS, queue_size=GV_SERVER_QUEUE_SIZE, reuse_port=False,
+                 ssl_context=None):
+        self.reuse_port = reuse_port
+        HTTPServer.__init__(self, address, SkillRequestHandler)
+        if ssl_context is not None:
+            # ハンドシェイクは、接続を受け付けるスレッドではなくワーカーで行う
+            self.socket = ssl_context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+        self.queue = queue.Queue(queue_size)
+        self.stats = {'accepted': 0, 'rejected': 0, 'expired': 0, 'errors': 0}
+        self.stats_lock = threading.Lock()
+        # -- ワーカー毎の、処理中のリクエストを受け付けた時刻
+        self.local = threading.local()
+        self.workers = [threading.Thread(target=self._work, name='skill-worker-%d' % i, daemon=True)
+                        for i in range(threads)]
+        # -- 同時に処理するリクエスト数より小さいと、Yahoo!路線情報への接続を使い回せない
+        yahoo_transit.GV_HTTP_POOL_MAXSIZE = max(yahoo_transit.GV_HTTP_POOL_MAXSIZE, threads)
+        yahoo_transit.get_http_session()
+        for worker in self.workers:
+            worker.start()
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        HTTPServer.server_bind(self)
+
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def health(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats.update(pid=os.getpid(), queued=self.queue.qsize(), cache=yahoo_transit.get_cache_stats())
+        return stats
+
+    def process_request(self, request, client_address):
+        """接続をキューに入れる。キューが一杯の場合は、その場で 503 を返す。"""
+        try:
+            self.queue.put_nowait((request, client_address, time.time()))
+        except queue.Full:
+            self.count('rejected')
+            self._reject(request)
+            return
+        self.count('accepted')
+
+    def _reject(self, request):
+        try:
+            request.settimeout(GV_SERVER_REJECT_TIMEOUT)
+            request.sendall(b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\n'
+                            b'Connection: close\r\n\r\n')
+            # 読まずに閉じると、クライアントには 503 ではなく接続のリセットが届くため、届いている分は読み捨てる
+            request.shutdown(socket.SHUT_WR)
+            received = 0
+            while received < GV_SERVER_MAX_BODY:
+                data = request.recv(65536)
+                if not data:
+                    break
+                received += len(data)
+        except (OSError, ValueError):
+            pass
+        self.shutdown_request(request)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            request, client_address, received = item
+            try:
+                if time.time() - received > GV_SERVER_MAX_QUEUE_WAIT:
+                    self.count('expired')
+                    self._reject(request)
+                    continue
+                self.local.received = received
+                self.finish_request(request, client_address)
+            except Exception as e:
+                print('[ERR] Worker: ' + repr(e))
+            finally:
+                self.shutdown_request(request)
+                self.queue.task_done()
+
+    def drain(self, timeout=GV_SERVER_GRACE):
+        """キューに入っているリクエストを処理し終えるまで待ち、ワーカーを終了する。
+
+        Returns
+        -------
+        drained : bool
+            timeout 以内にすべてのワーカーが終了した場合 True。
+        """
+        for _ in self.workers:
+            self.queue.put(None)
+        deadline = time.time() + timeout
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.time()))
+        yahoo_transit.get_notify_queue().flush(max(0, deadline - time.time()))
+        return not any(worker.is_alive() for worker in self.workers)
+
+
+def serve(server, grace=GV_SERVER_GRACE):
+    """SIGTERM, SIGINT を受け取るまで待ち受け、受け取ったらキューを処理し終えてから終了する。"""
+    def stop(signum, frame):
+        # serve_forever を実行しているスレッドからは shutdown を呼べないため、別スレッドで止める
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print('[INFO] Listening on %s:%d (pid %d)' % (server.server_address[0], server.server_address[1], os.getpid()))
+    server.serve_forever()
+    server.socket.close()
+    drained = server.drain(grace)
+    print('[INFO] Stopped (pid %d, drained=%s): %s' % (os.getpid(), drained, json.dumps(server.health())))
+    return 0 if drained else 1
+
+
+def run_processes(args, ssl_context):
+    """args.processes 個の子プロセスで待ち受け、SIGTERM, SIGINT を子プロセスに伝える。"""
+    children = []
+    for _ in range(args.processes):
+        pid = os.fork()
+        if pid == 0:
+            server = SkillServer((args.host, args.port), args.threads, args.queue_size, True, ssl_context)
+            os._exit(serve(server, args.grace))
+        children.append(pid)
+
+    def stop(signum, frame):
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    status = 0
+    for child in children:
+        _, code = os.waitpid(child, 0)
+        status = status or os.waitstatus_to_exitcode(code)
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the Alexa skill over HTTP(S) without AWS Lambda.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--threads', type=int, default=GV_SERVER_THREADS, help='プロセス毎のワーカースレッドの数')
+    parser.add_argument('--queue-size', type=int, default=GV_SERVER_QUEUE_SIZE, help='処理を待つリクエストの最大数')
+    parser.add_argument('--processes', type=int, default=1, help='待ち受けるプロセスの数（2以上は SO_REUSEPORT）')
+    parser.add_argument('--grace', type=float, default=GV_SERVER_GRACE, help='終了時に処理中のリクエストを待つ秒数')
+    parser.add_argument('--certfile', help='HTTPSの証明書')
+    parser.add_argument('--keyfile', help='HTTPSの秘密鍵')
+    args = parser.parse_args()
+
+    ssl_context = None
+    if args.certfile:
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(args.certfile, args.keyfile)
+
+    if args.processes > 1:
+        return run_processes(args, ssl_context)
+    return serve(SkillServer((args.host, args.port), args.threads, args.queue_size, False, ssl_context), args.grace)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,363 @@
+# coding: UTF-8
+"""
+通勤経路の監視。
+
+登録した通勤経路（出発駅, 到着駅, 時刻, タイプ, 曜日）を定期的に検索し、
+前回の検索結果から変わった場合（到着が遅くなった、乗車する電車が変わった、料金が変わった）だけ、
+IFTTTのWebhook経由でLineに通知する。
+
+- 時刻の GV_WATCH_WINDOW 分前から時刻までの間だけ検索する。
+- 同じ駅、タイプで、時刻が検索結果キャッシュの同じ単位（GV_CACHE_BUCKET_MINUTES 分）に入る通勤経路は、
+  まとめて1回だけ検索する。
+- 検索結果ページは条件付きリクエスト（If-None-Match, If-Modified-Since）で取得し、
+  内容（のハッシュ）が前回と同じ場合は解析しない。
+- 前回の検索結果は、日付を含まない検索条件（watch_key）毎に、その日の分だけ保存する。
+  登録がなくなった通勤経路の検索結果は削除する。
+
+登録する通勤経路はJSON（リスト）、またはJSONL:
+    {"id": "alice", "from": "渋谷駅", "to": "海浜幕張駅", "time": "08:45", "type": "到着", "days": ["weekday"]}
+days は 'weekday', 'saturday', 'holiday'（yahoo_transit.get_day_type）のリストで、省略時は平日のみ。
+
+使い方:
+    # 5分毎に検索する
+    $ python yahoo_transit_watcher.py commutes.json --interval 300
+    # IFTTTの代わりにローカルのスタブに通知し、指定した時刻で1回だけ検索する
+    $ python yahoo_transit_watcher.py commutes.json --once --now '2018-06-01 08:30' --stub-webhook
+
+Lambdaで動かす場合は、EventBridgeのスケジュールから watcher_handler を呼び出す。
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs
+
+import yahoo_transit
+from yahoo_transit import GV_TZ_JST, Route
+
+# -- 通勤経路の時刻の何分前から検索するか
+GV_WATCH_WINDOW = int(os.environ.get('watch_window', 60))
+# -- 検索する間隔（秒）
+GV_WATCH_INTERVAL = int(os.environ.get('watch_interval', 300))
+# -- 前回の検索結果を保存するファイル
+GV_WATCH_STATE = os.environ.get('watch_state', '/tmp/yahoo_transit_watch.json')
+# -- 登録した通勤経路のファイル（watcher_handler の event に subscriptions がない場合）
+GV_WATCH_SUBSCRIPTIONS = os.environ.get('watch_subscriptions')
+
+
+def load_subscriptions(f):
+    """登録した通勤経路を読み込む（JSONのリスト、またはJSONL）。"""
+    text = f.read()
+    if text.lstrip().startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+class CommuteWatcher(object):
+    """登録した通勤経路を検索し、変わった場合だけ通知する。
+
+    Parameters
+    ----------
+    subscriptions : list of dict
+        通勤経路（id, from, to, time, type, days）。
+    state : dict, default None
+        前回の検索結果（save_state で保存したもの）。
+    window : int, default GV_WATCH_WINDOW
+        時刻の何分前から検索するか。
+    """
+
+    def __init__(self, subscriptions, state=None, window=GV_WATCH_WINDOW):
+        self.subscriptions = subscriptions
+        # -- { 検索のキー（watch_key）: {date, etag, lastModified, hash, route, url} }
+        self.state = state or {}
+        self.window = window
+        self.stats = {}
+
+    def due_groups(self, now):
+        """now に検索する通勤経路を、検索条件毎にまとめて返す。
+
+        Returns
+        -------
+        groups : OrderedDict
+            { 検索のキー（watch_key）: (検索日時, 通勤経路のリスト) }
+        """
+        groups = OrderedDict()
+        search_date = now.strftime('%Y-%m-%d')
+        day_type = yahoo_transit.get_day_type(search_date)
+        for subscription in self.subscriptions:
+            if day_type not in subscription.get('days', ['weekday']):
+                continue
+            search_dt = yahoo_transit.to_search_datetime(search_date + ' ' + subscription['time'])
+            if not search_dt - timedelta(minutes=self.window) <= now <= search_dt:
+                continue
+            key = watch_key(subscription, search_dt)
+            if key in groups:
+                groups[key] = (min(groups[key][0], search_dt), groups[key][1] + [subscription])
+            else:
+                groups[key] = (search_dt, [subscription])
+        return groups
+
+    def poll(self, now=None):
+        """検索する時間帯の通勤経路を検索し、変わった場合は通知する。
+
+        Parameters
+        ----------
+        now : datetime, default None
+            現在日時（JST）。None の場合は現在日時。
+
+        Returns
+        -------
+        stats : dict
+            今回の検索、通知の回数。
+        """
+        now = now or datetime.now(GV_TZ_JST)
+        self.stats = {'groups': 0, 'fetched': 0, 'notModified': 0, 'unchanged': 0, 'parsed': 0, 'notified': 0,
+                      'failed': 0}
+        for key, (search_dt, subscriptions) in self.due_groups(now).items():
+            self.stats['groups'] += 1
+            first = subscriptions[0]
+            try:
+                transit_info, validators = self.fetch(key, first['from'], first['to'], search_dt,
+                                                      first.get('type', '出発'))
+                if transit_info is None:
+                    continue
+                route = transit_info['routes'][0]
+                previous = self.get_entry(key, search_dt).get('route')
+                changes = diff_routes(Route.from_values(previous), route) if previous is not None else []
+                if changes:
+                    self.notify(subscriptions, transit_info, changes)
+            except Exception as e:
+                # 通知に失敗した場合は前回の検索結果を残し、次回の検索で変更を検出し直して通知する
+                print('[WARN] Can not watch ' + key + ': ' + repr(e))
+                self.stats['failed'] += 1
+                continue
+            self.state[key] = dict(validators, date=search_dt.strftime('%Y-%m-%d'), route=route.to_values())
+        self.prune(now)
+        yahoo_transit.get_notify_queue().flush(10)
+        return dict(self.stats)
+
+    def get_entry(self, key, search_dt):
+        """検索日時の日付の、前回の検索結果を返す。別の日の検索結果は使わない。"""
+        entry = self.state.get(key, {})
+        return entry if entry.get('date') == search_dt.strftime('%Y-%m-%d') else {}
+
+    def prune(self, now):
+        """登録されていない通勤経路（登録を削除した、以前の形式のキーなど）の検索結果を削除する。"""
+        search_date = now.strftime('%Y-%m-%d')
+        keys = set(watch_key(subscription, yahoo_transit.to_search_datetime(search_date + ' ' + subscription['time']))
+                   for subscription in self.subscriptions)
+        for key in [key for key in self.state if key not in keys]:
+            del self.state[key]
+
+    def fetch(self, key, station_from, station_to, search_dt, search_type):
+        """検索結果ページを条件付きで取得し、前回から変わった場合のみ解析する。
+        前回の検索結果（self.state）は更新しない（通知に成功した後に poll で更新する）。
+
+        Returns
+        -------
+        transit_info : dict
+            路線情報。検索結果ページが前回と同じ場合、または解析できない場合は None。
+        validators : dict
+            次回の条件付きリクエストに使う値（etag, lastModified, hash, url）。
+        """
+        entry = self.get_entry(key, search_dt)
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('lastModified'):
+            headers['If-Modified-Since'] = entry['lastModified']
+
+        payload = yahoo_transit.make_search_payload(station_from, station_to, search_dt, search_type)
+        res = yahoo_transit.http_request('GET', yahoo_transit.GV_SEARCH_URL, use_deadline=False, params=payload,
+                                         headers=headers)
+        self.stats['fetched'] += 1
+        if res.status_code == 304:
+            self.stats['notModified'] += 1
+            return None, None
+        digest = hashlib.sha1(res.content).hexdigest()
+        if digest == entry.get('hash'):
+            self.stats['unchanged'] += 1
+            return None, None
+
+        # Alexaからの検索にも使えるよう、検索結果キャッシュにも保存する
+        transit_info = yahoo_transit.make_transit_info(res.content, res.url, station_from, station_to, search_dt,
+                                                       search_type)
+        self.stats['parsed'] += 1
+        validators = {'etag': res.headers.get('ETag'), 'lastModified': res.headers.get('Last-Modified'),
+                      'hash': digest, 'url': res.url}
+        return transit_info, validators
+
+    def notify(self, subscriptions, transit_info, changes):
+        """変わった内容と、新しい検索結果を通勤経路の登録者毎に通知する。"""
+        text = ''.join(changes) + yahoo_transit.make_transit_message(transit_info)
+        for subscription in subscriptions:
+            message = '%s: %sから%s（%s%s）の通勤経路が変わりました。' % (
+                subscription.get('id', ''), transit_info['stationFrom'], transit_info['stationTo'],
+                subscription['time'], subscription.get('type', '出発')) + text
+            key = yahoo_transit.make_notify_key(subscription.get('id'), message, transit_info['url'])
+            yahoo_transit.get_notify_queue().put({'key': key, 'value1': message, 'value2': transit_info['url']})
+            self.stats['notified'] += 1
+
+
+def watch_key(subscription, search_dt):
+    """通勤経路の検索のキー（検索結果キャッシュのキーから日付を除いたもの）。
+    時刻が検索結果キャッシュの同じ単位に入る通勤経路は、同じキーになる。
+    """
+    key = yahoo_transit.make_cache_key(subscription['from'], subscription['to'], search_dt,
+                                       subscription.get('type', '出発')).split('|')
+    del key[2]
+    return '|'.join(key)
+
+
+def diff_routes(previous, current):
+    """前回と今回の最初のルートを比べ、通知する変更のメッセージを返す。
+
+    Parameters
+    ----------
+    previous, current : Route
+        前回、今回のルート。
+
+    Returns
+    -------
+    changes : list of str
+        到着が遅くなった、乗車する電車が変わった、料金が変わった場合のメッセージ。変わっていない場合は空。
+    """
+    changes = []
+    previous_arrival = yahoo_transit.time_to_minutes(previous.arrival_time)
+    current_arrival = yahoo_transit.time_to_minutes(current.arrival_time)
+    if previous_arrival is not None and current_arrival is not None and current_arrival > previous_arrival:
+        changes.append('到着が%sから%sに遅くなりました。' % (previous.arrival_time, current.arrival_time))
+    if (previous.start_time, previous.transport) != (current.start_time, current.transport):
+        changes.append('乗車する電車が%sの%sから、%sの%sに変わりました。' % (
+            previous.start_time, previous.transport, current.start_time, current.transport))
+    if previous.fare_yen != current.fare_yen:
+        changes.append('料金が%sから%sに変わりました。' % (previous.fare, current.fare))
+    return changes
+
+
+def load_state(path):
+    try:
+        with io.open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_state(path, state):
+    with io.open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+
+def run_scheduler(watcher, interval=GV_WATCH_INTERVAL, iterations=None, state_path=None):
+    """interval 秒毎に watcher.poll を呼び出す（ローカルで動かす場合）。
+
+    Parameters
+    ----------
+    watcher : CommuteWatcher
+        監視する通勤経路。
+    interval : int, default GV_WATCH_INTERVAL
+        検索する間隔（秒）。
+    iterations : int, default None
+        検索する回数。None の場合は止めるまで繰り返す。
+    state_path : str, default None
+        前回の検索結果を毎回保存するファイル。
+    """
+    count = 0
+    while iterations is None or count < iterations:
+        started = time.time()
+        try:
+            print('[INFO] Watch: ' + json.dumps(watcher.poll()))
+        finally:
+            if state_path:
+                save_state(state_path, watcher.state)
+        count += 1
+        if iterations is None or count < iterations:
+            time.sleep(max(0, interval - (time.time() - started)))
+
+
+def watcher_handler(event, context):
+    """通勤経路を1回検索する（EventBridgeのスケジュールから呼び出すLambdaのハンドラ）。
+    event の subscriptions、ない場合は環境変数 watch_subscriptions のファイルの通勤経路を検索する。
+    前回の検索結果は GV_WATCH_STATE に保存する（コンテナが変わると前回の結果がなくなるため、
+    最初の検索では通知しない）。
+    """
+    subscriptions = event.get('subscriptions')
+    if subscriptions is None:
+        with io.open(GV_WATCH_SUBSCRIPTIONS, encoding='utf-8') as f:
+            subscriptions = load_subscriptions(f)
+    watcher = CommuteWatcher(subscriptions, load_state(GV_WATCH_STATE))
+    try:
+        stats = watcher.poll()
+    finally:
+        save_state(GV_WATCH_STATE, watcher.state)
+    print('[INFO] Watch: ' + json.dumps(stats))
+    return stats
+
+
+# --------------- Stub webhook ----------------------
+
+class StubWebhookHandler(BaseHTTPRequestHandler):
+    """IFTTTのWebhookの代わりに、受け取った通知を表示する。"""
+
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        values = dict((key, value[0]) for key, value in parse_qs(body).items())
+        self.received.append(values)
+        print('[STUB] ' + values.get('value1', '') + ' ' + values.get('value2', ''), file=sys.stderr)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_webhook():
+    """ローカルにスタブのWebhookを起動し、通知の送信先にする。"""
+    server = HTTPServer(('127.0.0.1', 0), StubWebhookHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yahoo_transit.GV_IFTTT_URL = 'http://127.0.0.1:%d/trigger/yahoo_transit/with/key/stub' % server.server_address[1]
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Watch registered commutes and push route changes to LINE.')
+    parser.add_argument('subscriptions', help='登録した通勤経路（JSON、またはJSONL）')
+    parser.add_argument('--interval', type=int, default=GV_WATCH_INTERVAL, help='検索する間隔（秒）')
+    parser.add_argument('--once', action='store_true', help='1回だけ検索する')
+    parser.add_argument('--now', help="現在日時の代わりに使う日時（yyyy-mm-dd HH:MM、--once の場合）")
+    parser.add_argument('--state', default=GV_WATCH_STATE, help='前回の検索結果を保存するファイル')
+    parser.add_argument('--stub-webhook', action='store_true', help='IFTTTの代わりにローカルのスタブに通知する')
+    args = parser.parse_args()
+
+    with io.open(args.subscriptions, encoding='utf-8') as f:
+        watcher = CommuteWatcher(load_subscriptions(f), load_state(args.state))
+    if args.stub_webhook:
+        start_stub_webhook()
+
+    if args.once:
+        now = yahoo_transit.to_search_datetime(args.now) if args.now else None
+        try:
+            print('[INFO] Watch: ' + json.dumps(watcher.poll(now)))
+        finally:
+            save_state(args.state, watcher.state)
+    else:
+        run_scheduler(watcher, args.interval, state_path=args.state)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())